@@ -0,0 +1,19 @@
+"""Various tools useful across projects.
+
+Subpackages are imported on first access, so `import utils` is cheap.
+"""
+import importlib
+
+_submodules = {'atmos', 'python'}
+
+__all__ = sorted(_submodules)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
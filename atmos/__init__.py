@@ -0,0 +1,45 @@
+"""Atmospheric data utilities: ERA5 downloads, NetCDF regridding and unit conversions.
+
+The public names below are imported from their submodule on first access, so that e.g.
+`from utils.atmos import kelvin_to_celsius` does not import xarray or xesmf.
+"""
+import importlib
+
+_submodules = {'convert_units', 'download_engine', 'download_manifest', 'download_planner',
+               'download_scheduler', 'derived', 'era5_catalogue', 'era5_constants', 'era5_store', 'netcdf'}
+
+# Public name -> submodule defining it
+_exports = {
+    **dict.fromkeys(['AffineConversion', 'apply_affine', 'kelvin_to_celsius', 'celsius_to_kelvin',
+                     'kelvin_to_fahrenheit', 'fahrenheit_to_kelvin', 'celsius_to_fahrenheit',
+                     'fahrenheit_to_celsius', 'UnitRegistry', 'canonical_units', 'convert_dataset',
+                     'era5_name', 'ERA5_VARIABLES', 'ERA5_PREFERRED_UNITS'], 'convert_units'),
+    **dict.fromkeys(['standardise_coords', 'interpolate_irregular_to_regular_grid', 'regrid_files',
+                     'horizontal_grid', 'grid_hash', 'RegridderCache', 'SparseRegridder',
+                     'SharedRegridExecutor'], 'netcdf'),
+    **dict.fromkeys(['DIAGNOSTICS', 'plan_derived', 'derive', 'write_derived', 'derive_files'], 'derived'),
+    **dict.fromkeys(['DownloadManifest', 'atomic_target', 'request_hash'], 'download_manifest'),
+    **dict.fromkeys(['AdaptiveScheduler'], 'download_scheduler'),
+    **dict.fromkeys(['ChunkRequest', 'plan_requests', 'download_chunk'], 'download_planner'),
+    **dict.fromkeys(['DownloadEngine'], 'download_engine'),
+    **dict.fromkeys(['append_to_store'], 'era5_store'),
+    **dict.fromkeys(['ERA5Catalogue'], 'era5_catalogue'),
+    **dict.fromkeys(['STATIC_VARIABLES', 'split_static', 'add_constants', 'open_day'], 'era5_constants'),
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(f'{__name__}.{_exports[name]}'), name)
+    elif name in _submodules:
+        value = importlib.import_module(f'{__name__}.{name}')
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | _submodules)
@@ -1,17 +1,350 @@
-def kelvin_to_celsius(kelvin):
-    return kelvin - 273.15
+"""Unit conversions for atmospheric fields.
 
-def celsius_to_kelvin(celsius):
-    return celsius + 273.15
+Every conversion here is affine (y = x * scale + offset), so all of them go through `apply_affine`,
+which works on Python scalars, NumPy arrays and xarray objects, and:
+    - preserves floating point dtypes (float32 stays float32),
+    - allocates at most one output array (none with `out=`, which may be the input for in-place use),
+      and applies the multiply and add block by block while the block is still in cache,
+    - stays lazy on dask-backed xarray objects and updates their `units` attribute.
+"""
 
-def kelvin_to_fahrenheit(kelvin):
-    return (kelvin - 273.15) * 9/5 + 32
+# Elements per block when applying scale and offset, small enough to stay in cache.
+BLOCK_SIZE = 2**16
 
-def fahrenheit_to_kelvin(fahrenheit):
-    return (fahrenheit - 32) * 5/9 + 273.15
 
-def celsius_to_fahrenheit(celsius):
-    return celsius * 9/5 + 32
+class AffineConversion:
+    """A conversion y = x * scale + offset, to the units `units`."""
 
-def fahrenheit_to_celsius(fahrenheit):
-    return (fahrenheit - 32) * 5/9
\ No newline at end of file
+    def __init__(self, scale, offset=0., units=None):
+        self.scale = scale
+        self.offset = offset
+        self.units = units
+
+    def then(self, other):
+        """The conversion applying self, then other, collapsed into a single affine transform."""
+        return AffineConversion(self.scale * other.scale, self.offset * other.scale + other.offset, other.units)
+
+    def inverse(self, units=None):
+        """The conversion undoing this one, to `units`."""
+        return AffineConversion(1 / self.scale, -self.offset / self.scale, units)
+
+    def __call__(self, data, out=None):
+        return apply_affine(data, self.scale, self.offset, out=out, units=self.units)
+
+    def __repr__(self):
+        return f"AffineConversion(scale={self.scale!r}, offset={self.offset!r}, units={self.units!r})"
+
+
+def _apply_numpy(values, scale, offset, out=None):
+    import numpy as np
+
+    values = np.asarray(values)
+    dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.dtype('float64')
+    if out is None:
+        out = np.empty(values.shape, dtype=dtype)
+    elif out.shape != values.shape:
+        raise ValueError(f"out has shape {out.shape}, expected {values.shape}")
+    # Cast the constants so NumPy does not promote float32 data to float64
+    scale, offset = out.dtype.type(scale), out.dtype.type(offset)
+
+    if values.flags.c_contiguous and out.flags.c_contiguous and values.size > BLOCK_SIZE:
+        flat_in, flat_out = values.reshape(-1), out.reshape(-1)
+        for start in range(0, flat_in.size, BLOCK_SIZE):
+            block_in, block_out = flat_in[start:start + BLOCK_SIZE], flat_out[start:start + BLOCK_SIZE]
+            np.multiply(block_in, scale, out=block_out, casting='same_kind')
+            np.add(block_out, offset, out=block_out)
+    else:
+        np.multiply(values, scale, out=out, casting='same_kind')
+        np.add(out, offset, out=out)
+    return out
+
+
+def apply_affine(data, scale, offset=0., out=None, units=None):
+    """Apply y = data * scale + offset.
+
+    Args:
+        data (scalar, array-like, xarray.DataArray): values to convert.
+        scale (float): multiplicative factor.
+        offset (float, optional): additive offset. Defaults to 0.
+        out (numpy.ndarray, optional): array to write the result to; pass `data` itself to convert
+            in place. Not supported for dask-backed data. Defaults to None.
+        units (str, optional): new `units` attribute for xarray objects. Defaults to None (unchanged).
+    Returns:
+        The converted data, of the same type (and floating point dtype) as `data`.
+    """
+    if isinstance(data, (int, float)):
+        return data * scale + offset
+
+    if hasattr(data, 'variable') and hasattr(data, 'dims'):
+        # xarray.DataArray
+        if data.chunks is not None:
+            if out is not None:
+                raise ValueError("out= is not supported for dask-backed data.")
+            import numpy as np
+            dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype('float64')
+            # dask fuses the multiply and add into one task per chunk
+            result = data.copy(data=data.data.astype(dtype, copy=False) * dtype.type(scale) + dtype.type(offset))
+        else:
+            result = data.copy(data=_apply_numpy(data.values, scale, offset, out=out))
+        if units is not None:
+            result.attrs['units'] = units
+        return result
+
+    if hasattr(data, 'dask'):
+        # bare dask array
+        import numpy as np
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype('float64')
+        return data.astype(dtype, copy=False) * dtype.type(scale) + dtype.type(offset)
+
+    if hasattr(data, 'index') and hasattr(data, 'to_numpy'):
+        # pandas Series or DataFrame: convert the values, keeping the index and name or columns
+        values = _apply_numpy(data.to_numpy(), scale, offset, out=out)
+        labels = {'columns': data.columns} if data.ndim == 2 else {'name': data.name}
+        return type(data)(values, index=data.index, **labels)
+
+    result = _apply_numpy(data, scale, offset, out=out)
+    return result[()] if result.ndim == 0 and out is None else result
+
+
+KELVIN_TO_CELSIUS = AffineConversion(1., -273.15, 'degC')
+CELSIUS_TO_KELVIN = KELVIN_TO_CELSIUS.inverse('K')
+CELSIUS_TO_FAHRENHEIT = AffineConversion(9 / 5, 32., 'degF')
+FAHRENHEIT_TO_CELSIUS = CELSIUS_TO_FAHRENHEIT.inverse('degC')
+KELVIN_TO_FAHRENHEIT = KELVIN_TO_CELSIUS.then(CELSIUS_TO_FAHRENHEIT)
+FAHRENHEIT_TO_KELVIN = FAHRENHEIT_TO_CELSIUS.then(CELSIUS_TO_KELVIN)
+
+
+def kelvin_to_celsius(kelvin, out=None):
+    return KELVIN_TO_CELSIUS(kelvin, out=out)
+
+def celsius_to_kelvin(celsius, out=None):
+    return CELSIUS_TO_KELVIN(celsius, out=out)
+
+def kelvin_to_fahrenheit(kelvin, out=None):
+    return KELVIN_TO_FAHRENHEIT(kelvin, out=out)
+
+def fahrenheit_to_kelvin(fahrenheit, out=None):
+    return FAHRENHEIT_TO_KELVIN(fahrenheit, out=out)
+
+def celsius_to_fahrenheit(celsius, out=None):
+    return CELSIUS_TO_FAHRENHEIT(celsius, out=out)
+
+def fahrenheit_to_celsius(fahrenheit, out=None):
+    return FAHRENHEIT_TO_CELSIUS(fahrenheit, out=out)
+
+
+# Standard gravity (m s-2), used by the ECMWF to convert geopotential to geopotential height.
+STANDARD_GRAVITY = 9.80665
+
+# Alternative spellings of units, mapped to the spelling used in ERA5 NetCDF files.
+unit_aliases = {
+    'kelvin': 'K',
+    '°c': 'degC', 'celsius': 'degC', 'deg_c': 'degC',
+    '°f': 'degF', 'fahrenheit': 'degF', 'deg_f': 'degF',
+    'mb': 'hPa', 'mbar': 'hPa', 'millibar': 'hPa',
+    'm/s': 'm s**-1', 'm s-1': 'm s**-1', 'ms-1': 'm s**-1',
+    'km/h': 'km h**-1', 'km h-1': 'km h**-1', 'kph': 'km h**-1',
+    'knots': 'kn', 'knot': 'kn', 'kt': 'kn', 'kts': 'kn',
+    'm2 s-2': 'm**2 s**-2', 'm^2/s^2': 'm**2 s**-2', 'm2/s2': 'm**2 s**-2',
+    'percent': '%', '0-1': '(0 - 1)', '0 - 1': '(0 - 1)', '(0-1)': '(0 - 1)', '1': '(0 - 1)',
+    # Water equivalent depths, e.g. snow depth ('sd')
+    'm of water equivalent': 'm', 'mm of water equivalent': 'mm',
+    # Dimensionless categories, e.g. soil type ('slt')
+    'dimensionless': '~',
+}
+
+
+def canonical_units(units):
+    """The ERA5 spelling of `units`, e.g. 'm/s' -> 'm s**-1'."""
+    if units is None:
+        return None
+    units = str(units).strip()
+    return unit_aliases.get(units.lower(), units)
+
+
+class UnitRegistry:
+    """Conversions between units, looked up by name.
+
+    Direct conversions are registered as edges of a graph. The first lookup of a pair of units
+    finds the shortest chain of conversions between them and collapses it into a single
+    AffineConversion, which is cached, so applying a chain costs one multiply and one add per
+    element however many steps it has.
+    """
+
+    def __init__(self):
+        self._edges = {}
+        self._compiled = {}
+
+    def register(self, conversion, from_units, invertible=True):
+        """Register `conversion` from `from_units` to `conversion.units`, and its inverse."""
+        from_units, to_units = canonical_units(from_units), canonical_units(conversion.units)
+        self._edges.setdefault(from_units, {})[to_units] = AffineConversion(conversion.scale, conversion.offset, to_units)
+        if invertible:
+            self._edges.setdefault(to_units, {})[from_units] = conversion.inverse(from_units)
+        self._compiled.clear()
+
+    @property
+    def units(self):
+        """All known units."""
+        return set(self._edges) | {u for targets in self._edges.values() for u in targets}
+
+    def conversion(self, from_units, to_units) -> AffineConversion:
+        """The single conversion from `from_units` to `to_units`.
+
+        Raises:
+            KeyError: if there is no chain of registered conversions between them.
+        """
+        from_units, to_units = canonical_units(from_units), canonical_units(to_units)
+        key = (from_units, to_units)
+        if key in self._compiled:
+            return self._compiled[key]
+
+        # Breadth-first search, so the chain is as short as possible
+        chains = {from_units: AffineConversion(1., 0., from_units)}
+        frontier = [from_units]
+        while frontier and to_units not in chains:
+            next_frontier = []
+            for units in frontier:
+                for target, step in self._edges.get(units, {}).items():
+                    if target not in chains:
+                        chains[target] = chains[units].then(step)
+                        next_frontier.append(target)
+            frontier = next_frontier
+        if to_units not in chains:
+            raise KeyError(f"No conversion from {from_units!r} to {to_units!r}.")
+        self._compiled[key] = chains[to_units]
+        return chains[to_units]
+
+    def convert(self, data, from_units, to_units, out=None):
+        """Convert `data` from `from_units` to `to_units`, see `apply_affine`."""
+        return self.conversion(from_units, to_units)(data, out=out)
+
+
+registry = UnitRegistry()
+# Temperature
+registry.register(KELVIN_TO_CELSIUS, 'K')
+registry.register(CELSIUS_TO_FAHRENHEIT, 'degC')
+# Pressure
+registry.register(AffineConversion(0.01, units='hPa'), 'Pa')
+registry.register(AffineConversion(0.1, units='kPa'), 'hPa')
+# Length (snow depth, precipitation, geopotential height)
+registry.register(AffineConversion(1000., units='mm'), 'm')
+registry.register(AffineConversion(100., units='cm'), 'm')
+registry.register(AffineConversion(0.001, units='km'), 'm')
+registry.register(AffineConversion(0.1, units='dam'), 'gpm')
+# Speed, 1 knot = 1852 m per hour
+registry.register(AffineConversion(3.6, units='km h**-1'), 'm s**-1')
+registry.register(AffineConversion(3600 / 1852, units='kn'), 'm s**-1')
+# Geopotential to geopotential height, kept apart from 'm' so it does not chain into lengths
+registry.register(AffineConversion(1 / STANDARD_GRAVITY, units='gpm'), 'm**2 s**-2')
+# Fractions
+registry.register(AffineConversion(100., units='%'), '(0 - 1)')
+
+
+# Units of the ERA5 variables in download_yamls/, by CDS request name and NetCDF short name
+ERA5_VARIABLES = {
+    '10m_u_component_of_wind': ('u10', 'm s**-1'),
+    '10m_v_component_of_wind': ('v10', 'm s**-1'),
+    '2m_dewpoint_temperature': ('d2m', 'K'),
+    '2m_temperature': ('t2m', 'K'),
+    'land_sea_mask': ('lsm', '(0 - 1)'),
+    'mean_sea_level_pressure': ('msl', 'Pa'),
+    'sea_ice_cover': ('siconc', '(0 - 1)'),
+    'sea_surface_temperature': ('sst', 'K'),
+    'skin_temperature': ('skt', 'K'),
+    'snow_depth': ('sd', 'm of water equivalent'),
+    'soil_temperature_level_1': ('stl1', 'K'),
+    'soil_temperature_level_2': ('stl2', 'K'),
+    'soil_temperature_level_3': ('stl3', 'K'),
+    'soil_temperature_level_4': ('stl4', 'K'),
+    'soil_type': ('slt', '~'),
+    'surface_pressure': ('sp', 'Pa'),
+    'volumetric_soil_water_layer_1': ('swvl1', 'm**3 m**-3'),
+    'volumetric_soil_water_layer_2': ('swvl2', 'm**3 m**-3'),
+    'volumetric_soil_water_layer_3': ('swvl3', 'm**3 m**-3'),
+    'volumetric_soil_water_layer_4': ('swvl4', 'm**3 m**-3'),
+    'geopotential': ('z', 'm**2 s**-2'),
+    'relative_humidity': ('r', '%'),
+    'specific_humidity': ('q', 'kg kg**-1'),
+    'temperature': ('t', 'K'),
+    'u_component_of_wind': ('u', 'm s**-1'),
+    'v_component_of_wind': ('v', 'm s**-1'),
+}
+
+# Short name to CDS request name
+_era5_long_names = {short: long for long, (short, _) in ERA5_VARIABLES.items()}
+
+# Units we usually work in, for convert_dataset
+ERA5_PREFERRED_UNITS = {
+    '10m_u_component_of_wind': 'kn',
+    '10m_v_component_of_wind': 'kn',
+    '2m_dewpoint_temperature': 'degC',
+    '2m_temperature': 'degC',
+    'mean_sea_level_pressure': 'hPa',
+    'sea_surface_temperature': 'degC',
+    'skin_temperature': 'degC',
+    'snow_depth': 'mm',
+    'soil_temperature_level_1': 'degC',
+    'soil_temperature_level_2': 'degC',
+    'soil_temperature_level_3': 'degC',
+    'soil_temperature_level_4': 'degC',
+    'surface_pressure': 'hPa',
+    'geopotential': 'gpm',
+    'temperature': 'degC',
+    'u_component_of_wind': 'kn',
+    'v_component_of_wind': 'kn',
+}
+
+
+def era5_name(name):
+    """The CDS request name of an ERA5 variable, given either that or its NetCDF short name."""
+    return _era5_long_names.get(name, name)
+
+
+def convert_dataset(ds, units=None, registry=registry, inplace=False):
+    """Convert the variables of a dataset to new units, in a single pass over the data.
+
+    The conversion for each variable is looked up once and applied as a single affine kernel, so
+    each variable is read and written exactly once. Dask-backed variables stay lazy.
+
+    Args:
+        ds (xarray.Dataset): dataset to convert. Variables without a `units` attribute are assumed
+            to be in their ERA5 units.
+        units (dict, optional): target units by variable name; ERA5 variables may be given by
+            either their CDS or their NetCDF name. Variables not listed are left unchanged.
+            Defaults to ERA5_PREFERRED_UNITS.
+        registry (UnitRegistry, optional): registry to look conversions up in. Defaults to the
+            module registry.
+        inplace (bool, optional): overwrite the (numpy-backed, floating point) data of `ds`
+            rather than returning a new Dataset. Defaults to False.
+    Returns:
+        xarray.Dataset: the converted dataset (`ds` itself if inplace).
+    """
+    if units is None:
+        units = ERA5_PREFERRED_UNITS
+    units = {era5_name(name): target for name, target in units.items()}
+
+    converted = {}
+    for name, variable in ds.data_vars.items():
+        target = units.get(name, units.get(era5_name(name)))
+        if target is None:
+            continue
+        source = variable.attrs.get('units')
+        if source is None and era5_name(name) in ERA5_VARIABLES:
+            source = ERA5_VARIABLES[era5_name(name)][1]
+        if source is None:
+            raise ValueError(f"Variable {name!r} has no units attribute.")
+        if canonical_units(source) == canonical_units(target):
+            continue
+        conversion = registry.conversion(source, target)
+        if inplace and variable.chunks is None and variable.dtype.kind == 'f':
+            conversion(variable.values, out=variable.values)
+            variable.attrs['units'] = conversion.units
+        else:
+            converted[name] = conversion(variable)
+
+    if inplace:
+        for name, variable in converted.items():
+            ds[name] = variable
+        return ds
+    return ds.assign(converted)
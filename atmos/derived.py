@@ -0,0 +1,316 @@
+"""Diagnostics derived from ERA5 fields, computed in a single fused pass over the inputs.
+
+Wind speed and direction, relative humidity and geopotential height are element-wise functions
+of the downloaded variables. Rather than evaluating one xarray expression per diagnostic, which
+rereads the inputs and allocates several full-size temporaries each time, `derive`:
+    - plans the requested diagnostics, grouping those on the same grid and collecting each input
+      once (`plan_derived`),
+    - reads the inputs one slab (along the leading, usually time, dimension) at a time, and
+      computes every diagnostic of the slab block by block, so temporaries stay in cache,
+    - converts inputs and outputs between units with the affine conversions of convert_units, in
+      the same pass,
+    - stays lazy on dask-backed data, with one task per chunk computing all diagnostics.
+`write_derived` writes the diagnostics of a daily file to `ERA5_YYYYMMDD_<level type>_derived.nc`
+alongside it.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from utils.atmos.convert_units import BLOCK_SIZE, ERA5_VARIABLES, apply_affine, canonical_units, registry
+
+logger = logging.getLogger(__name__)
+
+# Elements of each input read from the source at once
+SLAB_SIZE = 2**22
+
+# Saturation vapour pressure over water (Tetens' formula), as used by the ECMWF IFS
+TETENS_A3 = 17.502
+TETENS_A4 = 32.19  # K
+TRIPLE_POINT = 273.16  # K
+
+
+def _wind_speed(u, v, out):
+    np.hypot(u, v, out=out)
+
+
+def _wind_direction(u, v, out):
+    """Meteorological convention: the direction the wind blows from, clockwise from north."""
+    np.arctan2(-u, -v, out=out)
+    np.degrees(out, out=out)
+    np.mod(out, out.dtype.type(360), out=out)
+
+
+def _relative_humidity(t, td, out):
+    """100 * e_s(Td) / e_s(T), with Tetens' formula for the saturation vapour pressure e_s."""
+    c = out.dtype.type
+    np.divide(td - c(TRIPLE_POINT), td - c(TETENS_A4), out=out)
+    out -= (t - c(TRIPLE_POINT)) / (t - c(TETENS_A4))
+    out *= c(TETENS_A3)
+    np.exp(out, out=out)
+    out *= c(100)
+
+
+def _geopotential_height(z, out):
+    conversion = registry.conversion('m**2 s**-2', 'gpm')
+    apply_affine(z, conversion.scale, conversion.offset, out=out)
+
+
+class Diagnostic:
+    """A variable computed element-wise from ERA5 inputs, given by CDS name and in their ERA5 units."""
+
+    def __init__(self, short_name, inputs, units, func, long_name):
+        self.short_name = short_name
+        self.inputs = inputs
+        self.units = units
+        self.func = func
+        self.long_name = long_name
+
+    def __repr__(self):
+        return f"Diagnostic({self.short_name!r}, inputs={self.inputs!r}, units={self.units!r})"
+
+
+# Diagnostics by name, named like ERA5 variables
+DIAGNOSTICS = {
+    '10m_wind_speed': Diagnostic('si10', ('10m_u_component_of_wind', '10m_v_component_of_wind'),
+                                 'm s**-1', _wind_speed, '10 metre wind speed'),
+    '10m_wind_direction': Diagnostic('wdir10', ('10m_u_component_of_wind', '10m_v_component_of_wind'),
+                                     'degree', _wind_direction, '10 metre wind direction'),
+    '2m_relative_humidity': Diagnostic('r2', ('2m_temperature', '2m_dewpoint_temperature'),
+                                       '%', _relative_humidity, '2 metre relative humidity'),
+    'wind_speed': Diagnostic('ws', ('u_component_of_wind', 'v_component_of_wind'),
+                             'm s**-1', _wind_speed, 'Wind speed'),
+    'wind_direction': Diagnostic('wdir', ('u_component_of_wind', 'v_component_of_wind'),
+                                 'degree', _wind_direction, 'Wind direction'),
+    'geopotential_height': Diagnostic('gh', ('geopotential',), 'gpm', _geopotential_height, 'Geopotential height'),
+}
+
+# Short name to diagnostic name
+_diagnostic_names = {d.short_name: name for name, d in DIAGNOSTICS.items()}
+
+
+class DerivedPlan:
+    """Diagnostics computed together from inputs on the same grid, and the unit conversions they need.
+
+    Attributes:
+        inputs (list): names of the input variables in the dataset, each read once.
+        input_conversions (list): AffineConversion to the ERA5 units of each input, or None.
+        steps (list): (diagnostic name, indices into `inputs`, AffineConversion of the output or None).
+        dtype (numpy.dtype): of the outputs, float32 when the inputs of every step are float32.
+    """
+
+    def __init__(self, dtype=np.dtype('float64')):
+        self.dtype = np.dtype(dtype)
+        self.inputs = []
+        self.input_conversions = []
+        self.steps = []
+
+    @property
+    def outputs(self):
+        return [name for name, _, _ in self.steps]
+
+    def __repr__(self):
+        return f"DerivedPlan(inputs={self.inputs!r}, outputs={self.outputs!r})"
+
+
+def _find_variable(ds, name):
+    """The variable of `ds` holding ERA5 variable `name`, under its CDS or NetCDF name, or None."""
+    if name in ds.data_vars:
+        return name
+    short = ERA5_VARIABLES.get(name, (None,))[0]
+    return short if short in ds.data_vars else None
+
+
+def plan_derived(ds, names=None, units=None) -> list:
+    """Plan the computation of diagnostics from a dataset.
+
+    Args:
+        ds (xarray.Dataset): dataset with ERA5 variables, under their CDS or NetCDF names.
+        names (list, optional): diagnostics, by name or short name. Defaults to None, every diagnostic
+            whose inputs are in `ds`.
+        units (dict, optional): units of the outputs by diagnostic name or short name, e.g.
+            {'10m_wind_speed': 'kn'}. Defaults to the units of each diagnostic.
+    Returns:
+        list: one DerivedPlan per group of inputs with the same dimensions and output dtype, so
+            that float32 diagnostics stay float32 next to inputs of other diagnostics in float64.
+    Raises:
+        KeyError: for an unknown diagnostic.
+        ValueError: if the inputs of a requested diagnostic are not in `ds`.
+    """
+    units = {_diagnostic_names.get(name, name): target for name, target in (units or {}).items()}
+    if names is None:
+        names = [name for name, d in DIAGNOSTICS.items() if all(_find_variable(ds, i) for i in d.inputs)]
+    plans = {}
+    for name in names:
+        name = _diagnostic_names.get(name, name)
+        if name not in DIAGNOSTICS:
+            raise KeyError(f"Unknown diagnostic {name!r}, expected one of {sorted(DIAGNOSTICS)}.")
+        diagnostic = DIAGNOSTICS[name]
+        inputs = [_find_variable(ds, i) for i in diagnostic.inputs]
+        missing = [i for i, found in zip(diagnostic.inputs, inputs) if found is None]
+        if missing:
+            raise ValueError(f"Cannot compute {name}: {', '.join(missing)} not in the dataset.")
+        dims = ds[inputs[0]].dims
+        if any(ds[i].dims != dims for i in inputs):
+            raise ValueError(f"Cannot compute {name}: its inputs {inputs} have different dimensions.")
+
+        dtype = _output_dtype(*[ds[i].dtype for i in inputs])
+        plan = plans.setdefault((dims, dtype), DerivedPlan(dtype))
+        indices = []
+        for cds_name, variable in zip(diagnostic.inputs, inputs):
+            if variable not in plan.inputs:
+                plan.inputs.append(variable)
+                source = ds[variable].attrs.get('units', ERA5_VARIABLES[cds_name][1])
+                era5_units = ERA5_VARIABLES[cds_name][1]
+                same = canonical_units(source) == canonical_units(era5_units)
+                plan.input_conversions.append(None if same else registry.conversion(source, era5_units))
+            indices.append(plan.inputs.index(variable))
+        target = units.get(name)
+        same = target is None or canonical_units(target) == canonical_units(diagnostic.units)
+        plan.steps.append((name, indices, None if same else registry.conversion(diagnostic.units, target)))
+    return list(plans.values())
+
+
+def _output_dtype(*dtypes):
+    """float32 inputs give float32 outputs, anything else float64."""
+    dtype = np.result_type(*dtypes)
+    return dtype if dtype in (np.float32, np.float64) else np.dtype('float64')
+
+
+def _fused_block(*inputs, plan, out=None):
+    """Every diagnostic of `plan` over one block of its inputs, stacked along a new first axis.
+
+    The inputs are processed BLOCK_SIZE elements at a time, converting each to its ERA5 units
+    once, then computing all diagnostics from it while it is still in cache.
+    """
+    shape = np.shape(inputs[0])
+    dtype = plan.dtype
+    if out is None:
+        out = np.empty((len(plan.steps),) + shape, dtype=dtype)
+    flat_inputs = [np.ascontiguousarray(x).reshape(-1) for x in inputs]
+    flat_out = out.reshape(len(plan.steps), -1)
+    scratch = [np.empty(min(BLOCK_SIZE, flat_out.shape[1]), dtype=dtype) for _ in inputs]
+
+    for start in range(0, flat_out.shape[1], BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, flat_out.shape[1])
+        block = []
+        for x, buffer, conversion in zip(flat_inputs, scratch, plan.input_conversions):
+            buffer = buffer[:stop - start]
+            if conversion is None:
+                buffer[...] = x[start:stop]
+            else:
+                apply_affine(x[start:stop], conversion.scale, conversion.offset, out=buffer)
+            block.append(buffer)
+        for (name, indices, conversion), result in zip(plan.steps, flat_out[:, start:stop]):
+            DIAGNOSTICS[name].func(*[block[i] for i in indices], out=result)
+            if conversion is not None:
+                apply_affine(result, conversion.scale, conversion.offset, out=result)
+    return out
+
+
+def derive(ds, names=None, units=None):
+    """Compute diagnostics from a dataset in a single pass over its inputs.
+
+    Args:
+        ds (xarray.Dataset): dataset with ERA5 variables, under their CDS or NetCDF names, e.g. a
+            lazily opened daily file. Inputs that are not in their ERA5 units (e.g. after
+            convert_dataset) are converted back as they are read.
+        names (list, optional): diagnostics to compute, see `plan_derived`. Defaults to every
+            diagnostic whose inputs are in `ds`.
+        units (dict, optional): units of the outputs, see `plan_derived`.
+    Returns:
+        xarray.Dataset: the diagnostics, under their short names, dask-backed if the inputs are.
+    """
+    import xarray as xr
+
+    derived = {}
+    for plan in plan_derived(ds, names, units):
+        variables = [ds[name] for name in plan.inputs]
+        dims = variables[0].dims
+        dtype = plan.dtype
+        if any(v.chunks is not None for v in variables):
+            import dask.array
+
+            variables = xr.unify_chunks(*[v if v.chunks is not None else v.chunk() for v in variables])
+            arrays = [v.data for v in variables]
+            # One task per chunk computes every diagnostic of the plan
+            stacked = dask.array.map_blocks(_fused_block, *arrays, plan=plan, new_axis=0,
+                                            chunks=((len(plan.steps),),) + arrays[0].chunks, dtype=dtype,
+                                            meta=np.empty((0,) * (arrays[0].ndim + 1), dtype=dtype))
+        else:
+            stacked = np.empty((len(plan.steps),) + variables[0].shape, dtype=dtype)
+            if variables[0].ndim == 0:
+                _fused_block(*[v.values for v in variables], plan=plan, out=stacked)
+            else:
+                # Read the inputs from the source one slab at a time
+                rows = max(1, SLAB_SIZE // max(1, variables[0][0].size))
+                for start in range(0, variables[0].shape[0], rows):
+                    slab = slice(start, start + rows)
+                    _fused_block(*[v[slab].values for v in variables], plan=plan, out=stacked[:, slab])
+        coords = {name: coord for name, coord in variables[0].coords.items() if set(coord.dims) <= set(dims)}
+        for (name, _, conversion), values in zip(plan.steps, stacked):
+            diagnostic = DIAGNOSTICS[name]
+            attrs = {'units': conversion.units if conversion is not None else diagnostic.units,
+                     'long_name': diagnostic.long_name}
+            derived[diagnostic.short_name] = xr.DataArray(values, dims=dims, coords=coords, attrs=attrs)
+    return xr.Dataset(derived, attrs=ds.attrs)
+
+
+def derived_path(path, suffix='derived') -> Path:
+    """The file `write_derived` writes the diagnostics of `path` to, e.g. ERA5_20200101_surface_derived.nc."""
+    path = Path(path)
+    return path.with_name(f'{path.stem}_{suffix}{path.suffix}')
+
+
+def write_derived(path, names=None, units=None, suffix='derived', overwrite=False):
+    """Compute the diagnostics of a file and write them alongside it.
+
+    The file is opened lazily, one time step per dask chunk when dask is installed, so that the
+    diagnostics are computed and written one time step at a time.
+
+    Args:
+        path (str or Path): source file, e.g. a daily ERA5 file.
+        names, units: see `derive`.
+        suffix (str, optional): added to the file name, see `derived_path`. Defaults to 'derived'.
+        overwrite (bool, optional): compute again if the output exists. Defaults to False.
+    Returns:
+        Path: the output file, or None if `path` has none of the inputs.
+    """
+    from utils.atmos.download_manifest import atomic_target
+    from utils.atmos.download_planner import _open_lazy
+
+    output = derived_path(path, suffix)
+    if output.exists() and not overwrite:
+        return output
+    ds, _ = _open_lazy(path)
+    with ds:
+        derived = derive(ds, names, units)
+        if not derived.data_vars:
+            logger.info(f"No diagnostics to compute from {path}.")
+            return None
+        with atomic_target(output) as tmp:
+            derived.to_netcdf(tmp)
+    logger.info(f"Wrote {', '.join(derived.data_vars)} to {output}")
+    return output
+
+
+def derive_files(files, names=None, units=None, suffix='derived', overwrite=False, processes=None) -> list:
+    """Write the diagnostics of many files alongside them, in a pool of worker processes.
+
+    Args:
+        files (list): source files, e.g. the daily ERA5 files of the archive.
+        names, units, suffix, overwrite: see `write_derived`.
+        processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+    Returns:
+        list: the output files, None for files with none of the inputs.
+    """
+    files = [Path(f) for f in files]
+    processes = min(processes or os.cpu_count() or 1, max(1, len(files)))
+    if processes <= 1:
+        return [write_derived(f, names, units, suffix, overwrite) for f in files]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(write_derived, f, names, units, suffix, overwrite) for f in files]
+        return [future.result() for future in futures]
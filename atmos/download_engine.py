@@ -0,0 +1,177 @@
+# Download engine for CDS requests.
+# Reuses one cdsapi.Client per worker thread instead of creating one per request, tracks
+# each request through its queued -> running -> downloading states, and writes per-request
+# timings (local wait, CDS queue time, transfer time, bytes/sec) to a JSON-lines metrics log.
+
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from utils.atmos.download_manifest import request_hash
+from utils.python import tracing
+
+logger = logging.getLogger(__name__)
+
+STATES = ('queued', 'running', 'downloading', 'done', 'failed')
+
+
+def _default_client_factory():
+    import cdsapi
+    return cdsapi.Client()
+
+
+class ClientPool:
+    """
+    One client per worker thread, created on first use and reused afterwards.
+    :param factory: zero-argument function creating a client, defaults to cdsapi.Client.
+    """
+
+    def __init__(self, factory=None):
+        self.factory = factory or _default_client_factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def get(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.factory()
+            with self._lock:
+                self.created += 1
+        return client
+
+
+class MetricsLog:
+    """
+    Thread-safe JSON-lines log, one event per line.
+    :param path: file to append to, or None to disable logging.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else None
+        self._lock = threading.Lock()
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, event: str, **fields):
+        if self.path is None:
+            return
+        record = {'time': time.time(), 'event': event, **fields}
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class DownloadEngine:
+    """
+    Drop-in replacement for cdsapi.Client.retrieve that reuses pooled clients and records metrics.
+
+    `retrieve(name, request, target)` first submits the request and waits for the CDS to
+    complete it (state 'running', timed as queue time), then downloads the result (state
+    'downloading', timed as transfer time). Because it has the same signature as
+    cdsapi.Client.retrieve, an engine can be passed anywhere a client is expected, e.g.
+    `DownloadManifest.retrieve` or `download_chunk`.
+
+    :param client_factory: zero-argument function creating a client, defaults to cdsapi.Client.
+    :param metrics_path: optional JSON-lines file for per-request metrics.
+    """
+
+    def __init__(self, client_factory=None, metrics_path=None):
+        self.pool = ClientPool(client_factory)
+        self.metrics = MetricsLog(metrics_path)
+        self._lock = threading.Lock()
+        self.states = {}
+        self.enqueued_at = {}
+        self.totals = {'bytes': 0, 'queue_time': 0., 'transfer_time': 0., 'requests': 0}
+        self.started = time.monotonic()
+
+    def _set_state(self, key: str, state: str, **fields):
+        with self._lock:
+            self.states[key] = state
+        self.metrics.write(state, request=key, **fields)
+
+    def enqueue(self, name: str, request: dict, target=None):
+        """Mark a request as waiting for a worker."""
+        key = request_hash(name, request)[:16]
+        with self._lock:
+            self.enqueued_at[key] = time.monotonic()
+        self._set_state(key, 'queued', dataset=name, target=target)
+
+    def retrieve(self, name: str, request: dict, target):
+        """
+        Submit a request, wait for the CDS to process it, and download the result to `target`.
+        :param name: the CDS dataset name.
+        :param request: the CDS request dictionary.
+        :param target: the file to download to.
+        """
+        key = request_hash(name, request)[:16]
+        client = self.pool.get()
+        start = time.monotonic()
+        with self._lock:
+            local_wait = start - self.enqueued_at.pop(key, start)
+        self._set_state(key, 'running', dataset=name, target=target)
+        try:
+            with tracing.span('cds.queue', 'download', dataset=name, target=str(target)):
+                result = client.retrieve(name, request)
+            submitted = time.monotonic()
+            self._set_state(key, 'downloading', dataset=name, target=target)
+            with tracing.span('cds.download', 'download', dataset=name, target=str(target)) as span:
+                result.download(str(target))
+                span.add_bytes(written=tracing.file_size(target))
+        except Exception as e:
+            self._set_state(key, 'failed', dataset=name, target=target, error=str(e),
+                            elapsed=time.monotonic() - start)
+            raise
+        finished = time.monotonic()
+
+        queue_time = submitted - start
+        transfer_time = finished - submitted
+        n_bytes = Path(target).stat().st_size
+        with self._lock:
+            self.totals['bytes'] += n_bytes
+            self.totals['queue_time'] += queue_time
+            self.totals['transfer_time'] += transfer_time
+            self.totals['requests'] += 1
+        self._set_state(key, 'done', dataset=name, target=target, local_wait=local_wait,
+                        queue_time=queue_time, transfer_time=transfer_time, bytes=n_bytes,
+                        bytes_per_s=n_bytes / transfer_time if transfer_time > 0 else None)
+        return result
+
+    def progress(self) -> dict:
+        """
+        Snapshot of the engine state.
+        :return: dict of request counts per state, total bytes, and average throughput.
+        """
+        with self._lock:
+            counts = {state: 0 for state in STATES}
+            for state in self.states.values():
+                counts[state] += 1
+            totals = dict(self.totals)
+        elapsed = time.monotonic() - self.started
+        return {
+            **counts,
+            'bytes': totals['bytes'],
+            'bytes_per_s': totals['bytes'] / elapsed if elapsed > 0 else 0.,
+            'transfer_bytes_per_s': totals['bytes'] / totals['transfer_time'] if totals['transfer_time'] > 0 else None,
+            'queue_time': totals['queue_time'],
+            'transfer_time': totals['transfer_time'],
+            'clients': self.pool.created,
+        }
+
+    def postfix(self) -> dict:
+        """Short progress summary for a tqdm progress bar."""
+        p = self.progress()
+        return {'queued': p['queued'], 'running': p['running'], 'downloading': p['downloading'],
+                'MB/s': round(p['bytes_per_s'] / 1e6, 2)}
+
+    def close(self):
+        """Write a final summary record to the metrics log."""
+        summary = self.progress()
+        self.metrics.write('summary', **summary)
+        logger.info(f"Downloaded {summary['bytes'] / 1e6:.1f} MB in {summary['done']} requests, "
+                    f"{summary['queue_time']:.0f}s waiting on the CDS queue and "
+                    f"{summary['transfer_time']:.0f}s transferring.")
+        return summary
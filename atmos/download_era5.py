@@ -1,5 +1,6 @@
 # This script is intended to download ERA5 data from the Copernicus Climate Change Service (C3S) Climate Data Store (CDS).
 # Currently only implemented for downloads of hourly data, grouped by day.
+# Days are requested in multi-day chunks (up to the CDS field limit) and split locally into daily files.
 
 # Before running:
 # 1. Install the required packages: `pip install cdsapi`
@@ -10,21 +11,37 @@
 
 # When running:
 # 1. Create a yaml configuration file, see `download_era5_config.yaml` for an example.
-# 2. Run the script with the following command:
-# python download_era5.py -c download_yamls/era5_nz.yaml -s 20200101 -e 20200102 -o /Users/oriordem/datasets/ERA5/
+# 2. Run the script as a module of the `utils` package, with the directory containing this checkout on PYTHONPATH:
+# PYTHONPATH=/path/to/parent/of/utils python -m utils.atmos.download_era5 -c download_yamls/era5_nz.yaml -s 20200101 -e 20200102 -o /Users/oriordem/datasets/ERA5/
 
 # To do: fix duplication of logging.
 
-import cdsapi
 from argparse import ArgumentParser
 from pathlib import Path
 import yaml
 import datetime 
-import xarray as xr
 import os
 import time
 import logging
 
+from utils.atmos.download_manifest import DownloadManifest, MANIFEST_NAME
+from utils.atmos.download_scheduler import AdaptiveScheduler, describe_task
+from utils.atmos.download_planner import ChunkRequest, ShardedRequest, plan_requests, download_chunk, download_shard
+from utils.atmos.download_engine import DownloadEngine
+from utils.atmos.era5_catalogue import ERA5Catalogue, CATALOGUE_NAME
+from utils.atmos.era5_constants import split_static, constants_path, CONSTANTS_DATE
+
+logger = logging.getLogger(__name__)
+
+
+def new_client():
+    """
+    Create a cdsapi.Client; cdsapi is only imported here, so the request builders can be used without it.
+    """
+    import cdsapi
+    return cdsapi.Client()
+
+
 # Set up logging
 def setup_logging():
     """
@@ -71,109 +88,218 @@ def get_commandline_args():
         "-p", "--parallel", action='store_true', dest="parallel", default=True,
         help="Use parallel downloading.",
     )
+    parser.add_argument(
+        "--verify_checksums", action='store_true', dest="verify_checksums", default=False,
+        help="Re-hash files already recorded as complete in the download manifest before skipping them.",
+    )
+    parser.add_argument(
+        "-n", "--max_in_flight", type=int, dest="max_in_flight", default=10,
+        help="Maximum number of concurrent CDS requests when downloading in parallel.",
+    )
+    parser.add_argument(
+        "--target_latency", type=float, dest="target_latency", default=None,
+        help="Request latency (seconds) above which the number of concurrent requests is reduced.",
+    )
+    parser.add_argument(
+        "--max_retries", type=int, dest="max_retries", default=5,
+        help="Number of times a failed request is retried before giving up.",
+    )
+    parser.add_argument(
+        "--max_fields", type=int, dest="max_fields", default=None,
+        help="Maximum fields (variables x levels x hours x days) per CDS request, defaults to the CDS limit.",
+    )
+    parser.add_argument(
+        "--tiles", type=int, nargs=2, dest="tiles", default=None, metavar=("N_LAT", "N_LON"),
+        help="Shard each day into N_LAT x N_LON lat-lon tiles (and by variables and levels if over the field limit), "
+             "downloaded in parallel and merged into the daily file. Useful for global downloads.",
+    )
+    parser.add_argument(
+        "--daily", action='store_true', dest="daily", default=False,
+        help="Submit one request per day instead of grouping days into larger requests.",
+    )
+    parser.add_argument(
+        "--metrics_log", type=str, dest="metrics_log", default=None,
+        help="JSON-lines file for per-request download metrics, defaults to download_metrics.jsonl in the output directory.",
+    )
+    parser.add_argument(
+        "--zarr_store", type=str, dest="zarr_store", default=None,
+        help="Directory in which to append the daily files to pressure.zarr and surface.zarr stores after downloading.",
+    )
+    parser.add_argument(
+        "--store_layout", type=str, dest="store_layout", default='timeseries',
+        choices=['timeseries', 'map', 'balanced'],
+        help="Chunk layout used when creating the zarr stores.",
+    )
+    parser.add_argument(
+        "--keep_static", action='store_true', dest="keep_static", default=False,
+        help="Download time-invariant fields (e.g. land_sea_mask) with every day, instead of once into a constants file.",
+    )
+    parser.add_argument(
+        "--reindex", action='store_true', dest="reindex", default=False,
+        help="Index files already in the output directory (e.g. from before the catalogue existed) in the catalogue.",
+    )
     return parser.parse_args()
 
 
-def get_pressure_files(_times_dt: list, _cfg: dict):
+def pressure_request(_times_dt, _cfg: dict):
+    """
+    Builds the CDS request for one day of pressure-level data.
+    :param _times_dt: the day to be downloaded.
+    :param _cfg: the dictionary of configuration settings.
+    :return: tuple of (dataset name, request dictionary, download file path).
+    """
+    dates_str = f'{_times_dt.strftime("%Y%m%d")}'
+    times = [f'{i:02d}:00' for i in range(0, 24)]
+    download_file = Path(_cfg['download_dir']) / 'pressure' / str(_times_dt.year) / str(_times_dt.month).zfill(2) / f'ERA5_{dates_str}_pressure.nc'
+    request = {
+        'product_type':'reanalysis',
+        'format':'netcdf',
+        'pressure_level': _cfg['pressure_levels'],
+        'date': dates_str.replace('-', '/'),
+        'area':[_cfg['Nort'], _cfg['West'], _cfg['Sout'], _cfg['East']],
+        'time':times,
+        'variable':_cfg['pressure_var'],
+    }
+    return 'reanalysis-era5-pressure-levels', request, download_file
+
+
+def get_pressure_files(_times_dt: list, _cfg: dict, manifest: DownloadManifest = None, client=None):
     """
     Downloads pressure-level files from the ECMWF Climate Data Store (CDS) using the cdsapi.
     :param _times_dt: the list of dates and times to be downloaded.
     :param cfg: the dictionary of configuration settings.
+    :param manifest: optional download manifest, the file is then written atomically and recorded.
+    :param client: optional client to reuse, e.g. a DownloadEngine. A new cdsapi.Client is created if not given.
     :return: None
     """
-    dates_str = f'{_times_dt.strftime("%Y%m%d")}'
-    times = [f'{i:02d}:00' for i in range(0, 24)]
-    download_file = Path(_cfg['download_dir']) / 'pressure' / str(_times_dt.year) / str(_times_dt.month).zfill(2) / f'ERA5_{dates_str}_pressure.nc'
+    dataset, request, download_file = pressure_request(_times_dt, _cfg)
+    dates_str = request['date']
     # Create the directory if it doesn't exist
     download_file.parent.mkdir(parents=True, exist_ok=True)
 
     # Download the data
-    c = cdsapi.Client()
-    c.retrieve('reanalysis-era5-pressure-levels',
-               {
-                   'product_type':'reanalysis',
-                   'format':'netcdf',
-                   'pressure_level': _cfg['pressure_levels'],
-                   'date': dates_str.replace('-', '/'),
-                   'area':[_cfg['Nort'], _cfg['West'], _cfg['Sout'], _cfg['East']],
-                   'time':times,
-                   'variable':_cfg['pressure_var'],
-               },
-               download_file
-               )
+    c = client if client is not None else new_client()
+    if manifest is not None:
+        manifest.retrieve(c, dataset, request, download_file)
+    else:
+        c.retrieve(dataset, request, download_file)
     
     logger.info(f"Downloaded pressure-level data for {dates_str} to {download_file}")
 
-    # # Wait for the download to finish
-    # while not download_file.is_file():
-    #     time.sleep(30)
-
-    # # Split files into daily files
-    # logger.info(f"Splitting pressure-level data into daily files.")
-    # ds = xr.open_dataset(download_file)
-    # for day, daily_ds in ds.groupby('time.dt.floor("D")'):
-    #     day = day.dt.strftime("%Y%m%d").values
-    #     # Create the directory if it doesn't exist
-    #     day_dir = Path(_cfg['download_dir']) / 'pressure' / str(day.year) / str(day.month)
-    #     day_dir.mkdir(parents=True, exist_ok=True)
-    #     # Save the daily file
-    #     daily_ds.to_netcdf(f'{day_dir} / ERA5-{day}-pl.nc')
-    #     daily_ds.close()
-    # logger.info(f"Saved daily pressure-level data to {day_dir} / ERA5-{day}-pl.nc")
-    # ds.close()
-    # # Remove the original file
-    # logger.info(f"Removing original pressure-level file: {download_file}")
-    # os.remove(download_file)
-    
-def get_surface_files(_times_dt, _cfg):
+
+def surface_request(_times_dt, _cfg: dict):
+    """
+    Builds the CDS request for one day of surface-level data.
+    Time-invariant fields are left out, see `constants_request`, unless `_cfg['keep_static']` is set.
+    :param _times_dt: the day to be downloaded.
+    :param _cfg: the dictionary of configuration settings.
+    :return: tuple of (dataset name, request dictionary, download file path).
+    """
+    dates_str = f'{_times_dt.strftime("%Y%m%d")}'
+    times = [f'{i:02d}:00' for i in range(0, 24)]
+    download_file = Path(_cfg['download_dir']) / 'surface' / str(_times_dt.year) / str(_times_dt.month).zfill(2) / f'ERA5_{dates_str}_surface.nc'
+    variables = _cfg['surface_var'] if _cfg.get('keep_static') else split_static(_cfg['surface_var'])[0]
+    request = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'variable': variables,
+        'date': dates_str.replace('-', '/'),
+        'area': [_cfg['Nort'], _cfg['West'], _cfg['Sout'], _cfg['East']],
+        'time': times
+    }
+    return 'reanalysis-era5-single-levels', request, download_file
+
+
+def constants_request(_cfg: dict):
+    """
+    Builds the CDS request for the time-invariant fields in `surface_var`, fetched once per area.
+    :param _cfg: the dictionary of configuration settings.
+    :return: tuple of (dataset name, request dictionary, download file path), or None if there are
+        no static fields to fetch separately.
+    """
+    static = split_static(_cfg['surface_var'])[1]
+    if not static or _cfg.get('keep_static'):
+        return None
+    area = [_cfg['Nort'], _cfg['West'], _cfg['Sout'], _cfg['East']]
+    request = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'variable': static,
+        'date': CONSTANTS_DATE,
+        'area': area,
+        'time': ['00:00'],
+    }
+    return 'reanalysis-era5-single-levels', request, constants_path(_cfg['download_dir'], area)
+
+
+def get_surface_files(_times_dt, _cfg, manifest: DownloadManifest = None, client=None):
     """
     Downloads surface-level files from the ECMWF Climate Data Store(CDS) using the cdsapi.
     : param _times_dt: the list of dates and times to be downloaded.
     : param cfg: the dictionary of configuration settings.
+    : param manifest: optional download manifest, the file is then written atomically and recorded.
+    : param client: optional client to reuse, e.g. a DownloadEngine. A new cdsapi.Client is created if not given.
     : return: None
     """
-    dates_str = f'{_times_dt.strftime("%Y%m%d")}'
-    times = [f'{i:02d}:00' for i in range(0, 24)]
-    download_file = Path(_cfg['download_dir']) / 'surface' / str(_times_dt.year) / str(_times_dt.month).zfill(2) / f'ERA5_{dates_str}_surface.nc'
+    dataset, request, download_file = surface_request(_times_dt, _cfg)
+    dates_str = request['date']
     # Create the directory if it doesn't exist
     download_file.parent.mkdir(parents=True, exist_ok=True)
 
     # Download the data
-    c = cdsapi.Client()
-    c.retrieve('reanalysis-era5-single-levels',
-               {
-                   'product_type': 'reanalysis',
-                   'format': 'netcdf',
-                   'variable': _cfg['surface_var'],
-                   'date': dates_str.replace('-', '/'),
-                   'area': [_cfg['Nort'], _cfg['West'], _cfg['Sout'], _cfg['East']],
-                   'time': times
-               },
-               download_file)
+    c = client if client is not None else new_client()
+    if manifest is not None:
+        manifest.retrieve(c, dataset, request, download_file)
+    else:
+        c.retrieve(dataset, request, download_file)
     logger.info(f"Downloaded surface-level data for {dates_str} to {download_file}")
 
-    # Wait for the download to finish
-    # while not download_file.is_file():
-    #     time.sleep(30)
 
-    # # Split files into daily files
-    # logger.info(f"Splitting surface-level data into daily files.")
-    # ds = xr.open_dataset(download_file)
-    # for day, daily_ds in ds.groupby('time.dt.floor("D")'):
-    #     day = day.dt.strftime("%Y%m%d").values
-    #     # Create the directory if it doesn't exist
-    #     day_dir = Path(_cfg['download_dir']) / 'surface' / str(day.year) / str(day.month)
-    #     day_dir.mkdir(parents=True, exist_ok=True)
-    #     # Save the daily file
-    #     daily_ds.to_netcdf(f'{day_dir} / ERA5-{day}-sl.nc')
-    #     daily_ds.close()
-    # logger.info(f"Saved daily surface-level data to {day_dir} / ERA5-{day}-sl.nc")
-    # ds.close()
+def get_constants_file(_cfg: dict, manifest: DownloadManifest = None, client=None):
+    """
+    Downloads the time-invariant fields of an area into its constants file, see `constants_request`.
+    : param _cfg: the dictionary of configuration settings.
+    : param manifest: optional download manifest, the file is then written atomically and recorded.
+    : param client: optional client to reuse, e.g. a DownloadEngine. A new cdsapi.Client is created if not given.
+    : return: None
+    """
+    dataset, request, download_file = constants_request(_cfg)
+    download_file.parent.mkdir(parents=True, exist_ok=True)
+    c = client if client is not None else new_client()
+    if manifest is not None:
+        manifest.retrieve(c, dataset, request, download_file)
+    else:
+        c.retrieve(dataset, request, download_file)
+    logger.info(f"Downloaded time-invariant fields to {download_file}")
 
-    # # Remove the original file
-    # logger.info(f"Removing original surface-level file {download_file}")
-    # os.remove(download_file)
 
+def get_chunk_files(_chunk: ChunkRequest, _cfg: dict, manifest: DownloadManifest = None, client=None):
+    """
+    Downloads a multi-day request planned by `plan_requests` and splits it into daily files.
+    :param _chunk: the ChunkRequest to download.
+    :param _cfg: the dictionary of configuration settings.
+    :param manifest: optional download manifest in which each daily file is recorded.
+    :param client: optional client to reuse, e.g. a DownloadEngine. A new cdsapi.Client is created if not given.
+    :return: None
+    """
+    c = client if client is not None else new_client()
+    download_chunk(c, _chunk, manifest)
+    logger.info(f"Downloaded {_chunk} data into {len(_chunk.days)} daily files.")
+
+
+def get_shard_file(_sharded: ShardedRequest, _index: int, _cfg: dict, manifest: DownloadManifest = None, client=None):
+    """
+    Downloads one shard of a day planned by `plan_requests`; the last shard to finish merges them into the daily file.
+    :param _sharded: the ShardedRequest.
+    :param _index: index of the shard to download.
+    :param _cfg: the dictionary of configuration settings.
+    :param manifest: optional download manifest in which the shards and daily file are recorded.
+    :param client: optional client to reuse, e.g. a DownloadEngine. A new cdsapi.Client is created if not given.
+    :return: None
+    """
+    c = client if client is not None else new_client()
+    download_shard(c, _sharded, _index, manifest)
+    logger.info(f"Downloaded shard {_index + 1} of {_sharded}.")
 
 
 if __name__ == "__main__":
@@ -199,6 +325,7 @@ if __name__ == "__main__":
     cfg['download_dir'] = output_dir
     cfg['start_date'] = args.start_date
     cfg['end_date'] = args.end_date
+    cfg['keep_static'] = args.keep_static
 
     # Sort out the start and end times.
     times_dt = []
@@ -210,45 +337,73 @@ if __name__ == "__main__":
         times_dt.append(new_dt)
         new_dt += datetime.timedelta(days=1)
 
-    if not args.parallel:
-        for day in times_dt:        
-            logger.info(f"Downloading data for {day.strftime('%Y-%m-%d')}")
-
-            # Download pressure-level files
-            logger.info("Downloading pressure-level files.")
-            get_pressure_files(day, cfg)
+    # Only submit the days that are missing or corrupt on disk; record the new files in the catalogue.
+    catalogue = ERA5Catalogue(output_dir / CATALOGUE_NAME)
+    if args.reindex:
+        catalogue.update()
+    manifest = DownloadManifest(output_dir / MANIFEST_NAME, catalogue=catalogue)
+    # One pooled client per worker, with per-request timings written to a JSON-lines log.
+    metrics_log = Path(args.metrics_log) if args.metrics_log else output_dir / 'download_metrics.jsonl'
+    engine = DownloadEngine(client_factory=new_client, metrics_path=metrics_log)
 
-            # Download surface-level files
-            logger.info("Downloading surface-level files.")
-            get_surface_files(day, cfg)
-    
-    else:
-        # Parallel downloads
-        import concurrent.futures
-        from tqdm import tqdm
-        
-        # Create a list of all tasks (each day produces 2 tasks)
-        all_tasks = []
+    # Group the missing days into as few CDS requests as the field limits allow.
+    all_tasks = []
+    n_missing = 0
+    # Time-invariant fields are fetched once per area rather than with every day.
+    constants = constants_request(cfg)
+    if constants is not None:
+        if manifest.is_complete(*constants, verify_checksum=args.verify_checksums):
+            logger.info(f"Skipping {constants[2]}, already downloaded.")
+        else:
+            all_tasks.append((get_constants_file, cfg, manifest, engine))
+    for build_request in (pressure_request, surface_request):
+        if not build_request(times_dt[0], cfg)[1]['variable']:
+            continue
+        missing_days = []
         for day in times_dt:
-            all_tasks.append((get_pressure_files, day, cfg))
-            all_tasks.append((get_surface_files, day, cfg))
-
-        # Define your batch size (number of concurrent requests)
-        batch_size = 10
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=batch_size) as executor:
-            # Process tasks in batches
-            for i in range(0, len(all_tasks), batch_size):
-                batch = all_tasks[i : i + batch_size]
-                futures = [
-                    executor.submit(task, day, cfg)
-                    for task, day, cfg in batch
-                ]
-                # Use tqdm to monitor progress of the current batch
-                for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
-                    try:
-                        future.result()
-                    except Exception as e:
-                        logger.error(f"Error downloading data: {e}")
+            dataset, request, download_file = build_request(day, cfg)
+            if manifest.is_complete(dataset, request, download_file, verify_checksum=args.verify_checksums):
+                logger.info(f"Skipping {download_file}, already downloaded.")
+                continue
+            missing_days.append(day)
+        n_missing += len(missing_days)
+        max_days = 1 if args.daily else 31
+        for chunk in plan_requests(missing_days, build_request, cfg, max_fields=args.max_fields, max_days=max_days,
+                                   tiles=args.tiles):
+            if isinstance(chunk, ShardedRequest):
+                # Shards are independent requests, so they queue and download in parallel
+                for i, (request, shard_file) in enumerate(chunk.shards):
+                    all_tasks.append((get_shard_file, chunk, i, cfg, manifest, engine))
+                    if not shard_file.exists():
+                        engine.enqueue(chunk.dataset, request, shard_file)
+                continue
+            all_tasks.append((get_chunk_files, chunk, cfg, manifest, engine))
+            if not chunk.chunk_file.exists():
+                engine.enqueue(chunk.dataset, chunk.request, chunk.chunk_file)
+    logger.info(f"{n_missing} of {2 * len(times_dt)} daily files need downloading, in {len(all_tasks)} requests.")
+
+    # Keep up to max_in_flight requests running, adapting to CDS latency and rate limits.
+    max_in_flight = args.max_in_flight if args.parallel else 1
+    scheduler = AdaptiveScheduler(max_in_flight=max_in_flight, target_latency=args.target_latency,
+                                  max_retries=args.max_retries)
+    failed = scheduler.run(all_tasks, progress=True, postfix=engine.postfix)
+    for task, e in failed:
+        logger.error(f"Error downloading {describe_task(task)}: {e}")
+    engine.close()
+    catalogue.close()
+
+    # Optionally append the daily files to consolidated, chunked zarr stores.
+    if args.zarr_store:
+        from utils.atmos.era5_store import append_to_store
+        for level_type in ('pressure', 'surface'):
+            files = sorted(output_dir.glob(f'{level_type}/*/*/ERA5_*_{level_type}.nc'))
+            store = Path(args.zarr_store) / f'{level_type}.zarr'
+            try:
+                n_steps = append_to_store(files, store, layout=args.store_layout)
+            except ValueError as e:
+                # e.g. a day that failed to download; it is appended by the run that retries it
+                logger.error(f"Not appending to {store}: {e}")
+                continue
+            logger.info(f"Appended {n_steps} time steps to {store}.")
     logger.info("All downloads completed.")
 
@@ -0,0 +1,186 @@
+# Persistent record of which CDS requests have already been downloaded.
+# Used by download_era5.py so that re-running a date range only submits
+# the days that are missing, partial or corrupt on disk.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils.atmos.era5_catalogue import FILE_PATTERN
+from utils.python import tracing
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.era5_manifest.json'
+
+
+def request_hash(dataset: str, request: dict) -> str:
+    """
+    Stable hash identifying a CDS request (dataset, variables, levels, area, date, ...).
+    :param dataset: the CDS dataset name, e.g. 'reanalysis-era5-single-levels'.
+    :param request: the request dictionary passed to cdsapi.Client.retrieve.
+    :return: hex digest string.
+    """
+    payload = json.dumps({'dataset': dataset, 'request': request}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+@tracing.traced('manifest.checksum', 'download')
+def file_checksum(path, chunk_size: int = 2**20) -> str:
+    """
+    Streaming sha256 of a file, so large downloads are never read into memory at once.
+    :param path: path of the file to hash.
+    :param chunk_size: number of bytes read per iteration.
+    :return: hex digest string.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+        tracing.add_bytes(read=f.tell())
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_target(target):
+    """
+    Yield a temporary path next to `target`, renamed onto `target` only if the block succeeds.
+    A crash part way through a download therefore never leaves a truncated file under the final name.
+    :param target: the final file path.
+    """
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f'.{target.name}.{os.getpid()}.{threading.get_ident()}.part')
+    try:
+        yield tmp
+        os.replace(tmp, target)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _is_readable_netcdf(path) -> bool:
+    """Check that a file untracked by the manifest is a readable, non-empty dataset."""
+    import xarray as xr
+    try:
+        with xr.open_dataset(path) as ds:
+            return len(ds.data_vars) > 0
+    except Exception:
+        return False
+
+
+class DownloadManifest:
+    """
+    JSON manifest of CDS requests, keyed by request hash.
+
+    Each entry records the target file, its status ('partial' or 'complete'), and for
+    complete downloads the file size and sha256 checksum. The manifest itself is
+    written atomically after every update, so it stays valid if the process is killed.
+
+    :param path: the manifest file.
+    :param catalogue: optional ERA5Catalogue, to which files are added as their downloads complete.
+    """
+
+    def __init__(self, path, catalogue=None):
+        self.path = Path(path)
+        self.catalogue = catalogue
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.is_file():
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        """Atomically write the manifest to disk."""
+        # Written under the lock too, so a save never replaces the file with an older snapshot
+        with self._lock, atomic_target(self.path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+
+    def status(self, dataset: str, request: dict, target, verify_checksum: bool = False) -> str:
+        """
+        Status of a request on disk.
+        :param dataset: the CDS dataset name.
+        :param request: the CDS request dictionary.
+        :param target: the file the request downloads to.
+        :param verify_checksum: re-hash the file and compare with the recorded checksum.
+        :return: one of 'complete', 'partial', 'corrupt' or 'missing'.
+        """
+        key = request_hash(dataset, request)
+        target = Path(target)
+        entry = self.entries.get(key)
+        if entry is None:
+            return 'missing'
+        if entry['status'] != 'complete':
+            return 'partial'
+        if not target.is_file() or target.stat().st_size != entry['size']:
+            return 'corrupt'
+        if verify_checksum and file_checksum(target) != entry['sha256']:
+            return 'corrupt'
+        return 'complete'
+
+    def is_complete(self, dataset: str, request: dict, target, verify_checksum: bool = False) -> bool:
+        """
+        Whether a request can be skipped.
+        Files already on disk but unknown to the manifest (e.g. from runs before the manifest
+        existed) are adopted if they open as a valid dataset.
+        :return: True if the target exists and matches the manifest.
+        """
+        status = self.status(dataset, request, target, verify_checksum=verify_checksum)
+        if status == 'missing' and Path(target).is_file() and _is_readable_netcdf(target):
+            logger.info(f"Adopting existing file {target} into the download manifest.")
+            self.mark_complete(dataset, request, target)
+            return True
+        if status in ('partial', 'corrupt'):
+            logger.warning(f"Found {status} download for {target}, it will be requested again.")
+        return status == 'complete'
+
+    def _update(self, dataset: str, request: dict, entry: dict):
+        with self._lock:
+            self.entries[request_hash(dataset, request)] = entry
+        self.save()
+
+    def forget(self, dataset: str, request: dict):
+        """Remove a request from the manifest, e.g. once its file has been deleted."""
+        with self._lock:
+            entry = self.entries.pop(request_hash(dataset, request), None)
+        self.save()
+        if self.catalogue is not None and entry is not None:
+            self.catalogue.remove(entry['target'])
+
+    def mark_partial(self, dataset: str, request: dict, target):
+        """Record that a request has been submitted but has not finished downloading."""
+        self._update(dataset, request, {'dataset': dataset, 'target': str(target), 'status': 'partial'})
+
+    def mark_complete(self, dataset: str, request: dict, target):
+        """Record a finished download together with its size and checksum."""
+        target = Path(target)
+        sha256 = file_checksum(target)
+        self._update(dataset, request, {
+            'dataset': dataset,
+            'target': str(target),
+            'status': 'complete',
+            'size': target.stat().st_size,
+            'sha256': sha256,
+        })
+        # Only daily files are catalogued, not the planner's multi-day chunk files or the constants file
+        if self.catalogue is not None and FILE_PATTERN.search(target.name):
+            self.catalogue.add(target, sha256=sha256)
+
+    def retrieve(self, client, dataset: str, request: dict, target):
+        """
+        Download a request with `client.retrieve`, writing to a temporary file and renaming
+        it onto `target` once complete, and record the outcome in the manifest.
+        :param client: a cdsapi.Client (or anything with the same `retrieve` signature).
+        :param dataset: the CDS dataset name.
+        :param request: the CDS request dictionary.
+        :param target: the final file path.
+        """
+        self.mark_partial(dataset, request, target)
+        with atomic_target(target) as tmp:
+            client.retrieve(dataset, request, str(tmp))
+        self.mark_complete(dataset, request, target)
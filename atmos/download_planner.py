@@ -0,0 +1,347 @@
+# Coalesces per-day ERA5 requests into multi-day CDS requests and splits the result
+# back into the daily `{pressure,surface}/YYYY/MM/ERA5_YYYYMMDD_*.nc` layout.
+# Per-request queue overhead on the CDS dominates wall time for long backfills, so
+# fewer, larger requests (up to the CDS field limit) finish much sooner.
+# Conversely, a single day that is over the limit (e.g. global pressure levels) is sharded
+# by variables, levels and lat-lon tiles into requests that download in parallel and are
+# merged back into the daily file.
+
+import copy
+import datetime
+import logging
+import math
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from utils.atmos.download_manifest import DownloadManifest, atomic_target
+from utils.python import tracing
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of fields (variable x level x time step x day) per CDS request.
+FIELD_LIMITS = {
+    'reanalysis-era5-single-levels': 120000,
+    'reanalysis-era5-pressure-levels': 60000,
+}
+DEFAULT_FIELD_LIMIT = 60000
+
+LEVEL_TYPES = {
+    'reanalysis-era5-single-levels': 'surface',
+    'reanalysis-era5-pressure-levels': 'pressure',
+}
+
+TIME_NAMES = ('valid_time', 'time')
+
+# ERA5 grid spacing in degrees, unless a request sets 'grid'
+GRID_STEP = 0.25
+
+
+@dataclass
+class ChunkRequest:
+    """A single CDS request covering several days, and the daily files it is split into."""
+    dataset: str
+    request: dict
+    chunk_file: Path
+    days: list
+    daily: list = field(default_factory=list)  # (dataset, request, target) per day
+
+    def __str__(self):
+        level_type = LEVEL_TYPES.get(self.dataset, self.dataset)
+        return f"{level_type} {self.days[0]:%Y%m%d}-{self.days[-1]:%Y%m%d}"
+
+
+@dataclass
+class ShardedRequest:
+    """A day too large for one CDS request, split into shards that are merged into its daily file."""
+    dataset: str
+    request: dict
+    target: Path
+    shards: list  # (request, shard file) per shard
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def __str__(self):
+        level_type = LEVEL_TYPES.get(self.dataset, self.dataset)
+        return f"{level_type} {request_dates(self.request)[0]:%Y%m%d} ({len(self.shards)} shards)"
+
+
+def _as_list(value) -> list:
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def count_fields(request: dict) -> int:
+    """
+    Number of fields a CDS request asks for, which is what the CDS cost limits count.
+    :param request: a CDS request dictionary with 'date' or 'year'/'month'/'day' keys.
+    :return: variables x levels x times x days.
+    """
+    n_days = len(request_dates(request))
+    n_vars = len(_as_list(request.get('variable', [])))
+    n_levels = len(_as_list(request.get('pressure_level', [None])))
+    n_times = len(_as_list(request.get('time', [None])))
+    return n_vars * n_levels * n_times * n_days
+
+
+def request_dates(request: dict) -> list:
+    """
+    Days covered by a CDS request.
+    :param request: a CDS request dictionary with 'date' or 'year'/'month'/'day' keys.
+    :return: sorted list of datetime.datetime.
+    """
+    if 'date' in request:
+        dates = []
+        for d in _as_list(request['date']):
+            # Either a single day, or a range written 'start/end' or 'start/to/end'.
+            parts = str(d).replace('-', '').split('/')
+            start = datetime.datetime.strptime(parts[0], '%Y%m%d')
+            end = datetime.datetime.strptime(parts[-1], '%Y%m%d')
+            dates += [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+        return sorted(dates)
+    dates = []
+    for y in _as_list(request['year']):
+        for m in _as_list(request['month']):
+            for d in _as_list(request['day']):
+                try:
+                    dates.append(datetime.datetime(int(y), int(m), int(d)))
+                except ValueError:
+                    # e.g. day 31 requested alongside a 30-day month
+                    continue
+    return sorted(dates)
+
+
+def _split(items: list, n_groups: int) -> list:
+    """Split a list into `n_groups` contiguous groups of nearly equal size."""
+    n_groups = max(1, min(n_groups, len(items)))
+    bounds = [round(i * len(items) / n_groups) for i in range(n_groups + 1)]
+    return [items[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def _tile_bounds(first: float, last: float, n_tiles: int, step: float) -> list:
+    """Split the grid points from `first` to `last` (inclusive, either direction) into `n_tiles`
+    contiguous ranges, as (first, last) pairs that neither overlap nor leave gaps."""
+    n_points = int(round(abs(last - first) / step)) + 1
+    sign = 1 if last >= first else -1
+    return [(first + sign * step * group[0], first + sign * step * group[-1])
+            for group in _split(list(range(n_points)), n_tiles)]
+
+
+def shard_request(dataset: str, request: dict, target, max_fields: int = None, tiles=(1, 1)) -> ShardedRequest:
+    """
+    Shard a one-day request by variables and levels until each shard is under the field limit,
+    and optionally by lat-lon tiles, which reduces the size of each shard but not its field count.
+    :param dataset: the CDS dataset name.
+    :param request: the CDS request for one day, as built by `pressure_request` or `surface_request`.
+    :param target: the daily file the shards are merged into.
+    :param max_fields: fields per request, defaults to the CDS limit for the dataset.
+    :param tiles: number of tiles in latitude and longitude.
+    :return: ShardedRequest.
+    """
+    limit = max_fields or FIELD_LIMITS.get(dataset, DEFAULT_FIELD_LIMIT)
+    variables = _as_list(request['variable'])
+    levels = _as_list(request['pressure_level']) if 'pressure_level' in request else None
+    fields_per_variable = count_fields(dict(request, variable=variables[:1]))
+    if fields_per_variable <= limit:
+        variable_groups = _split(variables, math.ceil(len(variables) / (limit // fields_per_variable)))
+        level_groups = [levels]
+    else:
+        # Even a single variable is over the limit: one variable per shard, split its levels
+        variable_groups = [[v] for v in variables]
+        fields_per_level = fields_per_variable // len(levels) if levels else fields_per_variable
+        level_groups = _split(levels, math.ceil(len(levels) / max(1, limit // fields_per_level))) if levels else [None]
+
+    north, west, south, east = request['area']
+    step = float(_as_list(request.get('grid', GRID_STEP))[0])
+    n_lat, n_lon = tiles
+    areas = [[n, w, s, e] for n, s in _tile_bounds(north, south, n_lat, step)
+             for w, e in _tile_bounds(west, east, n_lon, step)]
+
+    target = Path(target)
+    shards = []
+    for variable_group in variable_groups:
+        for level_group in level_groups:
+            for area in areas:
+                shard = copy.deepcopy(request)
+                shard['variable'] = variable_group
+                if level_group is not None:
+                    shard['pressure_level'] = level_group
+                shard['area'] = area
+                shard_file = target.parent / f'.{target.stem}.shard{len(shards):03d}.nc'
+                shards.append((shard, shard_file))
+    return ShardedRequest(dataset, request, target, shards)
+
+
+def plan_requests(days: list, build_request, cfg: dict, max_fields: int = None, max_days: int = 31,
+                  tiles=None) -> list:
+    """
+    Group days into the fewest CDS requests that stay under the field limit.
+    Requests never span a month boundary, matching the archive layout and the
+    way the CDS stores ERA5. Days that are over the limit on their own, or all days
+    if `tiles` are given, are sharded instead, see `shard_request`.
+    :param days: the days to download (need not be contiguous).
+    :param build_request: function (day, cfg) -> (dataset, request, download_file) for one day,
+        e.g. `pressure_request` or `surface_request` from download_era5.py.
+    :param cfg: the dictionary of configuration settings.
+    :param max_fields: fields per request, defaults to the CDS limit for the dataset.
+    :param max_days: maximum number of days per request.
+    :param tiles: optional number of tiles in latitude and longitude to shard each day into.
+    :return: list of ChunkRequest and ShardedRequest.
+    """
+    by_month = {}
+    for day in sorted(days):
+        by_month.setdefault((day.year, day.month), []).append((day, build_request(day, cfg)))
+
+    chunks = []
+    for (year, month), month_days in by_month.items():
+        dataset, first_request, _ = month_days[0][1]
+        limit = max_fields or FIELD_LIMITS.get(dataset, DEFAULT_FIELD_LIMIT)
+        if tiles is not None or count_fields(first_request) > limit:
+            chunks += [shard_request(*daily, max_fields=limit, tiles=tiles or (1, 1)) for _, daily in month_days]
+            continue
+        per_request = max(1, min(max_days, limit // max(1, count_fields(first_request))))
+        for i in range(0, len(month_days), per_request):
+            group = month_days[i:i + per_request]
+            group_days = [day for day, _ in group]
+            request = copy.deepcopy(first_request)
+            request.pop('date', None)
+            request['year'] = str(year)
+            request['month'] = str(month).zfill(2)
+            request['day'] = [str(day.day).zfill(2) for day in group_days]
+            target = group[0][1][2]
+            level_type = LEVEL_TYPES.get(dataset, 'data')
+            chunk_file = target.parent / f'.ERA5_{group_days[0]:%Y%m%d}-{group_days[-1]:%Y%m%d}_{level_type}.chunk.nc'
+            chunks.append(ChunkRequest(dataset, request, chunk_file, group_days, [r for _, r in group]))
+    return chunks
+
+
+def _open_lazy(path):
+    """Open a file without loading data, one time step per dask chunk if dask is available."""
+    import xarray as xr
+    ds = xr.open_dataset(path)
+    time_name = next((t for t in TIME_NAMES if t in ds.dims), None)
+    try:
+        import dask  # noqa: F401
+    except ImportError:
+        return ds, time_name
+    if time_name is not None:
+        ds.close()
+        ds = xr.open_dataset(path, chunks={time_name: 1})
+    return ds, time_name
+
+
+@tracing.traced('era5.split_chunk', 'download')
+def split_chunk(chunk: ChunkRequest, manifest: DownloadManifest = None):
+    """
+    Split a downloaded multi-day file into the daily files of the archive layout.
+    Data is read lazily and written one time step at a time, so memory use is bounded
+    by a single time step rather than the whole chunk.
+    :param chunk: the ChunkRequest whose `chunk_file` has been downloaded.
+    :param manifest: optional download manifest in which to record each daily file.
+    """
+    ds, time_name = _open_lazy(chunk.chunk_file)
+    if tracing.enabled():
+        tracing.add_bytes(read=tracing.file_size(chunk.chunk_file))
+    with ds:
+        if time_name is None:
+            raise ValueError(f"No time dimension found in {chunk.chunk_file}")
+        days = ds[time_name].values.astype('datetime64[D]')
+        for dataset, request, target in chunk.daily:
+            day = np.datetime64(request_dates(request)[0].date(), 'D')
+            index = np.flatnonzero(days == day)
+            if index.size == 0:
+                raise ValueError(f"{chunk.chunk_file} has no data for {day}")
+            daily_ds = ds.isel({time_name: slice(index[0], index[-1] + 1)})
+            # The chunk file's on-disk chunk sizes may not fit a single day.
+            for variable in daily_ds.variables.values():
+                variable.encoding.pop('chunksizes', None)
+            with atomic_target(target) as tmp:
+                daily_ds.to_netcdf(tmp)
+            if tracing.enabled():
+                tracing.add_bytes(written=tracing.file_size(target))
+            if manifest is not None:
+                manifest.mark_complete(dataset, request, target)
+            logger.info(f"Saved daily data to {target}")
+
+
+def download_chunk(client, chunk: ChunkRequest, manifest: DownloadManifest = None):
+    """
+    Download a ChunkRequest and split it into daily files.
+    A chunk file left over from an interrupted run is split without downloading it again.
+    :param client: a cdsapi.Client (or anything with the same `retrieve` signature).
+    :param chunk: the ChunkRequest to download.
+    :param manifest: optional download manifest.
+    """
+    chunk.chunk_file.parent.mkdir(parents=True, exist_ok=True)
+    if manifest is None:
+        with atomic_target(chunk.chunk_file) as tmp:
+            client.retrieve(chunk.dataset, chunk.request, str(tmp))
+    elif not manifest.is_complete(chunk.dataset, chunk.request, chunk.chunk_file):
+        manifest.retrieve(client, chunk.dataset, chunk.request, chunk.chunk_file)
+    logger.info(f"Downloaded {chunk} to {chunk.chunk_file}, splitting into daily files.")
+
+    split_chunk(chunk, manifest)
+
+    # Remove the original file
+    chunk.chunk_file.unlink()
+    if manifest is not None:
+        manifest.forget(chunk.dataset, chunk.request)
+
+
+@tracing.traced('era5.merge_shards', 'download')
+def merge_shards(sharded: ShardedRequest, manifest: DownloadManifest = None):
+    """
+    Merge the downloaded shards of a day into its daily file.
+    Shards are opened lazily and combined by their coordinates (variables, levels and tiles),
+    and the daily file is written one time step at a time, so memory use is bounded by a single
+    time step of one shard rather than the whole day.
+    :param sharded: the ShardedRequest whose shard files have all been downloaded.
+    :param manifest: optional download manifest in which to record the daily file.
+    """
+    import xarray as xr
+
+    datasets = [_open_lazy(shard_file)[0] for _, shard_file in sharded.shards]
+    if tracing.enabled():
+        tracing.add_bytes(read=sum(tracing.file_size(shard_file) for _, shard_file in sharded.shards))
+    try:
+        ds = xr.combine_by_coords(datasets, combine_attrs='override')
+        for variable in ds.variables.values():
+            variable.encoding.pop('chunksizes', None)
+        with atomic_target(sharded.target) as tmp:
+            ds.to_netcdf(tmp)
+        if tracing.enabled():
+            tracing.add_bytes(written=tracing.file_size(sharded.target))
+    finally:
+        for d in datasets:
+            d.close()
+    if manifest is not None:
+        manifest.mark_complete(sharded.dataset, sharded.request, sharded.target)
+    logger.info(f"Merged {len(sharded.shards)} shards into {sharded.target}")
+
+
+def download_shard(client, sharded: ShardedRequest, index: int, manifest: DownloadManifest = None):
+    """
+    Download one shard of a day; whichever shard finishes last merges them into the daily file.
+    Shards downloaded before an interrupted run are not requested again.
+    :param client: a cdsapi.Client (or anything with the same `retrieve` signature).
+    :param sharded: the ShardedRequest.
+    :param index: which of its shards to download.
+    :param manifest: optional download manifest.
+    """
+    request, shard_file = sharded.shards[index]
+    shard_file.parent.mkdir(parents=True, exist_ok=True)
+    if manifest is None:
+        if not shard_file.exists():
+            with atomic_target(shard_file) as tmp:
+                client.retrieve(sharded.dataset, request, str(tmp))
+    elif not manifest.is_complete(sharded.dataset, request, shard_file):
+        manifest.retrieve(client, sharded.dataset, request, shard_file)
+
+    with sharded._lock:
+        if not all(f.exists() for _, f in sharded.shards):
+            return
+        merge_shards(sharded, manifest)
+        for request, shard_file in sharded.shards:
+            shard_file.unlink()
+            if manifest is not None:
+                manifest.forget(sharded.dataset, request)
@@ -0,0 +1,193 @@
+# Work-queue scheduler for CDS downloads.
+# Keeps up to N requests in flight at all times (rather than waiting on whole batches),
+# adapts N to the observed request latency and to rate-limit errors, and retries
+# failed requests with jittered exponential backoff.
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_MESSAGES = ('429', 'too many requests', 'rate limit', 'queue limit', 'too many queued')
+
+
+def is_rate_limit_error(exc: Exception) -> bool:
+    """
+    Whether an exception raised by cdsapi indicates that we are being rate limited.
+    :param exc: the exception raised by a download task.
+    :return: True for HTTP 429 responses and CDS queue/rate limit messages.
+    """
+    response = getattr(exc, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    message = str(exc).lower()
+    return any(m in message for m in RATE_LIMIT_MESSAGES)
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng=random) -> float:
+    """
+    Exponential backoff with jitter: half of the delay is fixed, half is random,
+    so retries from many workers do not hit the CDS at the same moment.
+    :param attempt: number of failed attempts so far (>= 1).
+    :param base: delay after the first failure, in seconds.
+    :param cap: maximum delay, in seconds.
+    :return: delay in seconds.
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def describe_task(task) -> str:
+    """Short description of a (function, *args) task for log messages."""
+    func, *args = task
+    first = args[0] if args else ''
+    if hasattr(first, 'strftime'):
+        first = first.strftime('%Y-%m-%d')
+    elif isinstance(first, dict):
+        # e.g. the configuration settings, too long for a log message
+        first = ''
+    return f"{func.__name__}({first})"
+
+
+class _Job:
+    __slots__ = ('task', 'attempt', 'ready_at')
+
+    def __init__(self, task):
+        self.task = task
+        self.attempt = 0
+        self.ready_at = 0.0
+
+
+class AdaptiveScheduler:
+    """
+    Run download tasks with an adaptive number of requests in flight.
+
+    Tasks are tuples of (function, *args), as built in the `download_era5.py` main block.
+    The in-flight limit grows by one after each success while the smoothed request
+    latency stays below `target_latency` (always, if no target is given), shrinks by one
+    when latency exceeds it, and halves on rate-limit errors.
+    """
+
+    def __init__(self, max_in_flight: int = 10, min_in_flight: int = 1, initial_in_flight: int = None,
+                 target_latency: float = None, max_retries: int = 5, backoff_base: float = 30.,
+                 backoff_max: float = 1800., latency_smoothing: float = 0.3, seed: int = None):
+        """
+        :param max_in_flight: upper bound on concurrent requests (and worker threads).
+        :param min_in_flight: lower bound on concurrent requests.
+        :param initial_in_flight: starting limit, defaults to half of `max_in_flight`.
+        :param target_latency: request latency (seconds) above which concurrency is reduced.
+        :param max_retries: retries per task before it is reported as failed.
+        :param backoff_base: retry delay after the first failure, in seconds.
+        :param backoff_max: maximum retry delay, in seconds.
+        :param latency_smoothing: weight of the newest sample in the latency moving average.
+        :param seed: seed for the backoff jitter, for reproducible runs.
+        """
+        if not 1 <= min_in_flight <= max_in_flight:
+            raise ValueError("Need 1 <= min_in_flight <= max_in_flight.")
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        if initial_in_flight is None:
+            initial_in_flight = max(min_in_flight, max_in_flight // 2)
+        self.limit = min(max(initial_in_flight, min_in_flight), max_in_flight)
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency_smoothing = latency_smoothing
+        self.latency = None
+        self.rng = random.Random(seed)
+        self.stats = {'completed': 0, 'retried': 0, 'rate_limited': 0, 'failed': 0, 'peak_in_flight': 0}
+
+    def _record_success(self, elapsed: float):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency += self.latency_smoothing * (elapsed - self.latency)
+        if self.target_latency is None or self.latency <= self.target_latency:
+            self.limit = min(self.max_in_flight, self.limit + 1)
+        else:
+            self.limit = max(self.min_in_flight, self.limit - 1)
+
+    def _record_rate_limit(self):
+        self.limit = max(self.min_in_flight, self.limit // 2)
+
+    def run(self, tasks, progress: bool = False, postfix=None) -> list:
+        """
+        Run all tasks to completion.
+        :param tasks: iterable of (function, *args) tuples.
+        :param progress: show a tqdm progress bar.
+        :param postfix: optional function returning a dict shown after the progress bar,
+            e.g. `DownloadEngine.postfix`.
+        :return: list of (task, exception) for tasks that still failed after all retries.
+        """
+        counter = itertools.count()
+        queue = []
+        for task in tasks:
+            heapq.heappush(queue, (0.0, next(counter), _Job(task)))
+        failed = []
+        in_flight = {}
+
+        bar = None
+        if progress:
+            from tqdm import tqdm
+            bar = tqdm(total=len(queue))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while queue or in_flight:
+                # Top up to the current limit with every job whose backoff has expired.
+                now = time.monotonic()
+                while queue and len(in_flight) < self.limit and queue[0][0] <= now:
+                    _, _, job = heapq.heappop(queue)
+                    func, *args = job.task
+                    future = executor.submit(func, *args)
+                    in_flight[future] = (job, time.monotonic())
+                self.stats['peak_in_flight'] = max(self.stats['peak_in_flight'], len(in_flight))
+
+                timeout = None
+                if queue and len(in_flight) < self.limit:
+                    timeout = max(0., queue[0][0] - time.monotonic())
+                if not in_flight:
+                    time.sleep(timeout)
+                    continue
+
+                done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                if bar is not None and postfix is not None:
+                    bar.set_postfix(postfix(), refresh=False)
+                for future in done:
+                    job, start = in_flight.pop(future)
+                    elapsed = time.monotonic() - start
+                    exc = future.exception()
+                    if exc is None:
+                        self._record_success(elapsed)
+                        self.stats['completed'] += 1
+                        if bar is not None:
+                            bar.update(1)
+                        continue
+
+                    job.attempt += 1
+                    rate_limited = is_rate_limit_error(exc)
+                    if rate_limited:
+                        self.stats['rate_limited'] += 1
+                        self._record_rate_limit()
+                    if job.attempt > self.max_retries:
+                        logger.error(f"Giving up on {describe_task(job.task)} after {job.attempt} attempts: {exc}")
+                        self.stats['failed'] += 1
+                        failed.append((job.task, exc))
+                        if bar is not None:
+                            bar.update(1)
+                        continue
+                    delay = backoff_delay(job.attempt, self.backoff_base, self.backoff_max, self.rng)
+                    logger.warning(f"{'Rate limited' if rate_limited else 'Error'} on {describe_task(job.task)} "
+                                   f"(attempt {job.attempt}, limit now {self.limit}), retrying in {delay:.0f}s: {exc}")
+                    self.stats['retried'] += 1
+                    job.ready_at = time.monotonic() + delay
+                    heapq.heappush(queue, (job.ready_at, next(counter), job))
+
+        if bar is not None:
+            bar.close()
+        return failed
@@ -0,0 +1,284 @@
+# SQLite index of the daily ERA5 files written by download_era5.py.
+# The archive layout, `{pressure,surface}/YYYY/MM/ERA5_YYYYMMDD_*.nc`, is only navigable by globbing,
+# and finding the files covering a period, variable or area means opening them. The catalogue keeps
+# one record per file (date, level type, variables, levels, area, size, checksum) so that queries are
+# answered from an indexed table, and `ERA5Catalogue.open` lazily opens only the files that match.
+# The download manifest adds files to the catalogue as their downloads complete.
+
+import datetime
+import json
+import logging
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CATALOGUE_NAME = '.era5_catalogue.sqlite'
+TIME_NAMES = ('valid_time', 'time')
+LEVEL_NAMES = ('pressure_level', 'level')
+FILE_PATTERN = re.compile(r'ERA5_(\d{8})_(\w+)\.nc$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    level_type TEXT NOT NULL,
+    time_name TEXT,
+    n_times INTEGER,
+    variables TEXT,
+    levels TEXT,
+    lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_date ON files (level_type, date);
+CREATE TABLE IF NOT EXISTS file_variables (
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    variable TEXT NOT NULL,
+    PRIMARY KEY (variable, path)
+);
+"""
+
+
+def _as_date(value) -> str:
+    """ISO date string of a date, datetime, numpy datetime64 or 'YYYYMMDD'/'YYYY-MM-DD' string."""
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%Y-%m-%d')
+    value = str(value)
+    if re.fullmatch(r'\d{8}', value):
+        return f'{value[:4]}-{value[4:6]}-{value[6:]}'
+    return value[:10]
+
+
+def _short_names(variables):
+    """NetCDF short names of variables given by CDS or short name."""
+    from utils.atmos.convert_units import ERA5_VARIABLES
+    return [ERA5_VARIABLES[v][0] if v in ERA5_VARIABLES else v for v in variables]
+
+
+def read_file_record(path) -> dict:
+    """Catalogue record of one daily file, reading only its metadata and coordinates.
+
+    Args:
+        path (str or Path): an `ERA5_YYYYMMDD_<level type>.nc` file.
+    Returns:
+        dict: the columns of the `files` table, with `variables` and `levels` as lists.
+    """
+    import xarray as xr
+
+    path = Path(path)
+    match = FILE_PATTERN.search(path.name)
+    if match is None:
+        raise ValueError(f"{path.name} is not named like ERA5_YYYYMMDD_<level type>.nc")
+    stat = path.stat()
+    with xr.open_dataset(path) as ds:
+        time_name = next((t for t in TIME_NAMES if t in ds.dims), None)
+        level_name = next((l for l in LEVEL_NAMES if l in ds.coords), None)
+        lat, lon = ds['latitude'].values, ds['longitude'].values
+        return {
+            'date': _as_date(match[1]),
+            'level_type': match[2],
+            'time_name': time_name,
+            'n_times': ds.sizes[time_name] if time_name else None,
+            'variables': sorted(ds.data_vars),
+            'levels': [float(l) for l in ds[level_name].values] if level_name else [],
+            'lat_min': float(lat.min()), 'lat_max': float(lat.max()),
+            'lon_min': float(lon.min()), 'lon_max': float(lon.max()),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+
+
+class ERA5Catalogue:
+    """SQLite catalogue of an ERA5 archive, with a query API returning lazily opened datasets.
+
+    Paths are stored relative to `root`, so the archive and its catalogue can be moved together.
+    The catalogue is safe to share between the threads of one process.
+
+    Args:
+        path (str or Path): the SQLite file, created if it does not exist.
+        root (str or Path, optional): root directory of the archive. Defaults to the directory
+            containing `path`.
+    """
+
+    def __init__(self, path, root=None):
+        self.path = Path(path)
+        self.root = Path(root) if root is not None else self.path.parent
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def _key(self, path) -> str:
+        path = Path(path)
+        try:
+            return path.resolve().relative_to(self.root.resolve()).as_posix()
+        except ValueError:
+            return str(path.resolve())
+
+    def add(self, path, sha256: str = None):
+        """Add or replace the record of a file.
+
+        Args:
+            path (str or Path): the daily file.
+            sha256 (str, optional): its checksum, if already known (e.g. from the download manifest).
+        """
+        record = read_file_record(path)
+        key = self._key(path)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE path = ?', (key,))
+            self._db.execute(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, record['date'], record['level_type'], record['time_name'], record['n_times'],
+                 json.dumps(record['variables']), json.dumps(record['levels']),
+                 record['lat_min'], record['lat_max'], record['lon_min'], record['lon_max'],
+                 record['size'], record['mtime'], sha256))
+            self._db.executemany('INSERT INTO file_variables VALUES (?, ?)',
+                                 [(key, v) for v in record['variables']])
+
+    def remove(self, path):
+        """Remove the record of a file, e.g. once it has been deleted."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE path = ?', (self._key(path),))
+
+    def update(self, root=None) -> int:
+        """Index files of the archive that are new or have changed since they were catalogued.
+
+        Only the files that are new, or whose size or modification time changed, are opened;
+        records of files that no longer exist are removed.
+
+        Args:
+            root (str or Path, optional): directory to scan. Defaults to the catalogue root.
+        Returns:
+            int: number of files (re-)indexed.
+        """
+        root = Path(root) if root is not None else self.root
+        with self._lock:
+            known = {path: (size, mtime) for path, size, mtime in
+                     self._db.execute('SELECT path, size, mtime FROM files')}
+        n_indexed = 0
+        seen = set()
+        for path in sorted(root.glob('*/*/*/ERA5_*.nc')):
+            key = self._key(path)
+            seen.add(key)
+            stat = path.stat()
+            if known.get(key) == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                self.add(path)
+                n_indexed += 1
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not index {path}: {e}")
+        gone = [key for key in known if key not in seen and not (self.root / key).exists()]
+        if gone:
+            with self._lock, self._db:
+                self._db.executemany('DELETE FROM files WHERE path = ?', [(key,) for key in gone])
+        logger.info(f"Indexed {n_indexed} files, removed {len(gone)} missing files from {self.path}.")
+        return n_indexed
+
+    def query(self, start=None, end=None, variables=None, level_type=None, area=None) -> list:
+        """Records of the files matching a query, ordered by level type and date.
+
+        Args:
+            start, end (date, datetime or str, optional): first and last day, inclusive.
+            variables (list, optional): files containing any of these variables, by CDS or NetCDF name.
+            level_type (str, optional): 'pressure' or 'surface'.
+            area (list, optional): [north, west, south, east], as in CDS requests; files overlapping it.
+        Returns:
+            list: one dict per file, with `path` absolute.
+        """
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('date >= ?')
+            params.append(_as_date(start))
+        if end is not None:
+            clauses.append('date <= ?')
+            params.append(_as_date(end))
+        if level_type is not None:
+            clauses.append('level_type = ?')
+            params.append(level_type)
+        if area is not None:
+            north, west, south, east = area
+            clauses.append('lat_max >= ? AND lat_min <= ? AND lon_max >= ? AND lon_min <= ?')
+            params += [south, north, west, east]
+        if variables is not None:
+            names = _short_names(variables)
+            clauses.append(f"path IN (SELECT path FROM file_variables WHERE variable IN ({', '.join('?' * len(names))}))")
+            params += names
+        sql = 'SELECT * FROM files' + (' WHERE ' + ' AND '.join(clauses) if clauses else '') + ' ORDER BY level_type, date'
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+        records = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            record['path'] = self.root / record['path']
+            record['variables'] = json.loads(record['variables'])
+            record['levels'] = json.loads(record['levels'])
+            records.append(record)
+        return records
+
+    def open(self, start=None, end=None, variables=None, level_type=None, area=None, levels=None, chunks=None):
+        """Lazily open the data matching a query as a single dataset.
+
+        Only the matching files are opened, without reading their data; variables that were not
+        asked for are dropped as each file is opened, and the result is cut to the time range,
+        area and levels. Surface and pressure-level files are combined with a merge.
+
+        Args:
+            start, end, variables, level_type, area: as for `query`.
+            levels (list, optional): pressure levels to select.
+            chunks (dict, optional): dask chunks, see xarray.open_mfdataset. Defaults to one chunk per file.
+        Returns:
+            xarray.Dataset: dask-backed dataset.
+        """
+        import numpy as np
+        import xarray as xr
+
+        records = self.query(start, end, variables, level_type, area)
+        if not records:
+            raise FileNotFoundError(f"No files in {self.path} match the query.")
+        wanted = None if variables is None else set(_short_names(variables))
+
+        datasets = []
+        for group_type in dict.fromkeys(r['level_type'] for r in records):
+            group = [r for r in records if r['level_type'] == group_type]
+            time_name = group[0]['time_name']
+            drop = sorted({v for r in group for v in r['variables']} - wanted) if wanted else None
+            ds = xr.open_mfdataset([r['path'] for r in group], combine='nested', concat_dim=time_name,
+                                   data_vars='minimal', coords='minimal', compat='override',
+                                   chunks=chunks if chunks is not None else {}, drop_variables=drop)
+            if start is not None or end is not None:
+                first = np.datetime64(_as_date(start)) if start is not None else None
+                last = np.datetime64(_as_date(end)) + np.timedelta64(1, 'D') - np.timedelta64(1, 's') \
+                    if end is not None else None
+                ds = ds.sel({time_name: slice(first, last)})
+            if area is not None:
+                north, west, south, east = area
+                lat = ds['latitude'].values
+                ds = ds.sel(latitude=slice(north, south) if lat[0] > lat[-1] else slice(south, north),
+                            longitude=slice(west, east))
+            if levels is not None:
+                level_name = next((l for l in LEVEL_NAMES if l in ds.coords), None)
+                if level_name is not None:
+                    ds = ds.sel({level_name: [float(l) for l in levels]})
+            datasets.append(ds)
+        return datasets[0] if len(datasets) == 1 else xr.merge(datasets, compat='override', join='outer')
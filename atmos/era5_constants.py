@@ -0,0 +1,117 @@
+# Time-invariant ERA5 fields, downloaded once per area instead of with every hour of every day.
+# Fields such as the land-sea mask and soil type are identical at every time step, so listing them
+# in `surface_var` used to fetch 24 copies per day. download_era5.py strips them from the daily
+# surface requests and fetches them once into `constants/ERA5_constants_<N>_<W>_<S>_<E>.nc`;
+# `open_day` broadcasts them back along time when a daily file is opened.
+
+import logging
+import re
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# CDS request name -> NetCDF short name of the time-invariant single-level fields.
+# 'geopotential' is the surface geopotential (orography) when requested from the single-level dataset.
+STATIC_VARIABLES = {
+    'land_sea_mask': 'lsm',
+    'soil_type': 'slt',
+    'geopotential': 'z',
+    'angle_of_sub_gridscale_orography': 'anor',
+    'anisotropy_of_sub_gridscale_orography': 'isor',
+    'slope_of_sub_gridscale_orography': 'slor',
+    'standard_deviation_of_orography': 'sdor',
+    'standard_deviation_of_filtered_subgrid_orography': 'sdfor',
+    'lake_cover': 'cl',
+    'lake_depth': 'dl',
+    'low_vegetation_cover': 'cvl',
+    'high_vegetation_cover': 'cvh',
+    'type_of_low_vegetation': 'tvl',
+    'type_of_high_vegetation': 'tvh',
+}
+
+CONSTANTS_DIR = 'constants'
+CONSTANTS_PATTERN = re.compile(r'ERA5_constants_(-?[\d.]+)_(-?[\d.]+)_(-?[\d.]+)_(-?[\d.]+)\.nc$')
+# The constants are requested for a fixed time, so the request (and its manifest entry) never changes
+CONSTANTS_DATE = '20000101'
+TIME_NAMES = ('valid_time', 'time')
+
+
+def split_static(variables) -> tuple:
+    """Split CDS variable names into (time-varying, static) lists, keeping their order."""
+    variables = list(variables)
+    return [v for v in variables if v not in STATIC_VARIABLES], [v for v in variables if v in STATIC_VARIABLES]
+
+
+def constants_path(download_dir, area) -> Path:
+    """The constants file of an area [north, west, south, east] in an archive."""
+    return Path(download_dir) / CONSTANTS_DIR / f"ERA5_constants_{'_'.join(f'{float(a):g}' for a in area)}.nc"
+
+
+def find_constants(root, ds):
+    """The constants file in archive `root` whose area covers the grid of `ds`, or None."""
+    lat, lon = ds['latitude'].values, ds['longitude'].values
+    for path in sorted((Path(root) / CONSTANTS_DIR).glob('ERA5_constants_*.nc')):
+        match = CONSTANTS_PATTERN.search(path.name)
+        if match is None:
+            continue
+        north, west, south, east = map(float, match.groups())
+        if south <= lat.min() and lat.max() <= north and west <= lon.min() and lon.max() <= east:
+            return path
+    return None
+
+
+def add_constants(ds, constants):
+    """Add the fields of a constants file to a dataset, broadcast along its time dimension.
+
+    The broadcast is a view, so no copy of the constant fields is made per time step. Variables
+    already in `ds` (e.g. in files downloaded before the constants were split off) are kept.
+
+    Args:
+        ds (xarray.Dataset): data on the same grid as, or a subset of, the constants.
+        constants (str, Path or xarray.Dataset): the constants file, or the dataset read from it.
+    Returns:
+        xarray.Dataset: `ds` with the constant fields added.
+    """
+    import xarray as xr
+
+    if not isinstance(constants, xr.Dataset):
+        with xr.open_dataset(constants) as c:
+            return add_constants(ds, c.load())
+    constants = constants.isel({t: 0 for t in TIME_NAMES if t in constants.dims}, drop=True)
+    constants = constants.drop_vars([c for c in constants.coords if c not in ('latitude', 'longitude')])
+    constants = constants.sel(latitude=ds['latitude'], longitude=ds['longitude'], method='nearest', tolerance=1e-6)
+    time_name = next((t for t in TIME_NAMES if t in ds.dims), None)
+    new = {}
+    for name, variable in constants.data_vars.items():
+        if name in ds.variables:
+            continue
+        variable = variable.assign_coords(latitude=ds['latitude'], longitude=ds['longitude'])
+        if time_name is not None:
+            variable = variable.expand_dims({time_name: ds[time_name]})
+        new[name] = variable
+    return ds.assign(new)
+
+
+def open_day(path, constants=None, **kwargs):
+    """Open a daily file with the static fields broadcast back along time.
+
+    Args:
+        path (str or Path): an `ERA5_YYYYMMDD_surface.nc` file.
+        constants (str, Path or bool, optional): the constants file to add. Defaults to None, to look
+            for one covering the file's area in the archive containing it; False to add none.
+        **kwargs: passed on to xarray.open_dataset.
+    Returns:
+        xarray.Dataset
+    """
+    import xarray as xr
+
+    path = Path(path)
+    ds = xr.open_dataset(path, **kwargs)
+    if constants is False:
+        return ds
+    if constants is None:
+        # Files are laid out as <root>/surface/YYYY/MM/ERA5_YYYYMMDD_surface.nc
+        constants = find_constants(path.parents[3], ds) if len(path.parents) > 3 else None
+        if constants is None:
+            return ds
+    return add_constants(ds, constants)
@@ -0,0 +1,213 @@
+# Consolidated, chunked and compressed Zarr stores built from the daily ERA5 files.
+# Reading a point time series from the daily `ERA5_YYYYMMDD_*.nc` files means opening one file
+# per day. `append_to_store` copies the daily files into a single Zarr store with a configurable
+# chunk layout, writing disjoint, chunk-aligned time blocks from a pool of worker processes.
+# Days already in the store are skipped, so nightly runs only append the new days; a day missing
+# from the sequence, or arriving after later days were stored, is reported rather than skipped.
+# Requires the optional `zarr` and `dask` dependencies.
+
+import logging
+import math
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+TIME_NAMES = ('valid_time', 'time')
+
+# Chunk sizes per dimension; 'time' stands for whichever time dimension the files use,
+# -1 means the whole dimension, and dimensions not listed are not chunked.
+CHUNK_LAYOUTS = {
+    # Long time series at a few points: a month of hourly data per chunk, small tiles.
+    'timeseries': {'time': 744, 'latitude': 32, 'longitude': 32, 'pressure_level': 1},
+    # Whole fields at a few times: one time step per chunk, full maps.
+    'map': {'time': 1, 'latitude': -1, 'longitude': -1, 'pressure_level': 1},
+    # A compromise for mixed access: a week per chunk, medium tiles.
+    'balanced': {'time': 168, 'latitude': 128, 'longitude': 128, 'pressure_level': 1},
+}
+
+
+def _time_name(ds):
+    name = next((t for t in TIME_NAMES if t in ds.dims), None)
+    if name is None:
+        raise ValueError(f"No time dimension ({', '.join(TIME_NAMES)}) found in dataset.")
+    return name
+
+
+def resolve_chunks(ds, layout='timeseries') -> dict:
+    """Chunk size for every dimension of `ds`.
+
+    Args:
+        ds (xarray.Dataset): dataset to be stored.
+        layout (str or dict, optional): a key of CHUNK_LAYOUTS, or a dict in the same format.
+            Defaults to 'timeseries'.
+    Returns:
+        dict: dimension name to chunk size.
+    """
+    if isinstance(layout, str):
+        layout = CHUNK_LAYOUTS[layout]
+    time_name = _time_name(ds)
+    chunks = {}
+    for dim, size in ds.sizes.items():
+        chunk = layout.get('time' if dim == time_name else dim, -1)
+        chunks[dim] = size if chunk == -1 else chunk
+    # The time dimension grows, so its chunk size must not be clipped to the first batch.
+    return {dim: (c if dim == time_name else min(c, ds.sizes[dim])) for dim, c in chunks.items()}
+
+
+def _compression_encoding(clevel: int) -> dict:
+    """Blosc/zstd compression in the form expected by the installed zarr version."""
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        return {'compressors': [BloscCodec(cname='zstd', clevel=clevel, shuffle='shuffle')]}
+    from numcodecs import Blosc
+    return {'compressor': Blosc(cname='zstd', clevel=clevel, shuffle=Blosc.SHUFFLE)}
+
+
+def _file_day(path):
+    """Day encoded in an `ERA5_YYYYMMDD_*.nc` file name, or None."""
+    match = re.search(r'ERA5_(\d{8})_', Path(path).name)
+    return np.datetime64(f'{match[1][:4]}-{match[1][4:6]}-{match[1][6:]}', 'D') if match else None
+
+
+def _missing_days(times) -> list:
+    """Days with time steps missing from `times`, assuming the smallest interval in them is the time step."""
+    if len(times) < 2:
+        return []
+    step = np.diff(times).min()
+    expected = np.arange(times[0], times[-1] + step, step)
+    missing = np.setdiff1d(expected, times)
+    return [str(day) for day in np.unique(missing.astype('datetime64[D]'))]
+
+
+def _file_times(path, time_name):
+    with xr.open_dataset(path) as ds:
+        return ds[time_name].values
+
+
+def _write_block(store, files, time_name, start, stop, offsets):
+    """Worker: write store time indices [start, stop) from the daily files covering them."""
+    datasets = [xr.open_dataset(f) for f in files]
+    try:
+        ds = xr.concat(datasets, dim=time_name, data_vars='minimal', coords='minimal', compat='override')
+        ds = ds.isel({time_name: slice(start - offsets[0], stop - offsets[0])})
+        ds = ds.drop_vars([v for v in ds.variables if time_name not in ds[v].dims])
+        for variable in ds.variables.values():
+            variable.encoding = {}
+        ds.to_zarr(store, region={time_name: slice(start, stop)})
+    finally:
+        for d in datasets:
+            d.close()
+    return stop - start
+
+
+def append_to_store(files, store, layout='timeseries', clevel: int = 5, processes: int = None) -> int:
+    """Append daily NetCDF files to a chunked, compressed Zarr store, in parallel.
+
+    Files whose time steps are already in the store are skipped, so the same call can be
+    repeated every night over the whole archive. New time steps must continue on from the last
+    one already stored, without gaps: a day that is missing, or that arrives after later days
+    were stored, raises a ValueError naming it rather than leaving a hole in the store.
+
+    Args:
+        files (list): daily NetCDF files, e.g. `surface/YYYY/MM/ERA5_YYYYMMDD_surface.nc`.
+        store (str or Path): path of the Zarr store, created if it does not exist.
+        layout (str or dict, optional): chunk layout, a key of CHUNK_LAYOUTS or a dict of
+            dimension to chunk size. Only used when creating the store. Defaults to 'timeseries'.
+        clevel (int, optional): compression level. Defaults to 5.
+        processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+    Returns:
+        int: number of time steps appended.
+    Raises:
+        ValueError: if days are missing between the stored and new time steps, or arrived late.
+    """
+    store = Path(store)
+    files = sorted(Path(f) for f in files)
+    if not files:
+        return 0
+
+    with xr.open_dataset(files[0]) as first:
+        time_name = _time_name(first)
+
+    # Skip days that are already stored.
+    stored_times = None
+    n_stored = 0
+    if store.exists():
+        with xr.open_zarr(store) as existing:
+            stored_times = existing[time_name].values
+            n_stored = len(stored_times)
+    if stored_times is not None:
+        # Avoid opening files from days that are already stored, using the file name.
+        last_day = stored_times[-1].astype('datetime64[D]')
+        stored_days = set(np.unique(stored_times.astype('datetime64[D]')).tolist())
+        late = [f for f in files if _file_day(f) is not None and _file_day(f) < last_day
+                and _file_day(f).tolist() not in stored_days]
+        if late:
+            raise ValueError(f"{', '.join(str(_file_day(f)) for f in late)} arrived after later days were stored "
+                             f"in {store}; the store can only be extended at its end, so rebuild it from the daily files.")
+        files = [f for f in files if _file_day(f) is None or _file_day(f) >= last_day]
+    file_times = [_file_times(f, time_name) for f in files]
+    last_stored = stored_times[-1] if stored_times is not None else None
+    new = [(f, t) for f, t in zip(files, file_times) if last_stored is None or t[-1] > last_stored]
+    if not new:
+        logger.info(f"No new data to append to {store}.")
+        return 0
+    if last_stored is not None and new[0][1][0] <= last_stored:
+        raise ValueError(f"{new[0][0]} overlaps data already in {store}.")
+    # The new time steps must continue the store's time axis without gaps.
+    times = np.concatenate(([] if stored_times is None else [stored_times[-2:]]) + [t for _, t in new])
+    missing = _missing_days(times)
+    if missing:
+        raise ValueError(f"Time steps on {', '.join(missing)} are missing before appending to {store}; "
+                         f"download those days first.")
+
+    # Write metadata and coordinates for the new time steps, leaving the data to the workers.
+    # Nothing is computed here, so the dask chunks of the template need not match the store.
+    template = xr.open_mfdataset([f for f, _ in new], combine='nested', concat_dim=time_name,
+                                 data_vars='minimal', coords='minimal', compat='override')
+    try:
+        if last_stored is None:
+            chunks = resolve_chunks(template, layout)
+            template = template.chunk(chunks)
+            encoding = {}
+            for name, variable in template.data_vars.items():
+                encoding[name] = {'chunks': tuple(chunks[d] for d in variable.dims), **_compression_encoding(clevel)}
+            for variable in template.variables.values():
+                variable.encoding = {}
+            template.to_zarr(store, mode='w-', compute=False, encoding=encoding, safe_chunks=False)
+            time_chunk = chunks[time_name]
+        else:
+            with xr.open_zarr(store) as existing:
+                variable = next(iter(existing.data_vars.values()))
+                time_chunk = variable.encoding['chunks'][variable.dims.index(time_name)]
+            for variable in template.variables.values():
+                variable.encoding = {}
+            template.to_zarr(store, append_dim=time_name, compute=False, safe_chunks=False)
+    finally:
+        template.close()
+
+    # Split the new time steps into blocks aligned with the zarr chunks, so that no two
+    # workers ever write to the same chunk.
+    offsets = np.cumsum([0] + [len(t) for _, t in new]) + n_stored
+    total = offsets[-1]
+    steps_per_task = time_chunk * max(1, math.ceil(len(new[0][1]) / time_chunk))
+    blocks = []
+    start = n_stored
+    while start < total:
+        stop = min(total, (start // steps_per_task + 1) * steps_per_task)
+        first = np.searchsorted(offsets, start, side='right') - 1
+        last = np.searchsorted(offsets, stop, side='left')
+        blocks.append(([f for f, _ in new[first:last]], start, stop, offsets[first:last + 1].tolist()))
+        start = stop
+
+    logger.info(f"Appending {total - n_stored} time steps from {len(new)} files to {store} in {len(blocks)} blocks.")
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_write_block, str(store), block_files, time_name, a, b, block_offsets)
+                   for block_files, a, b, block_offsets in blocks]
+        written = sum(f.result() for f in futures)
+    return written
@@ -1,57 +1,721 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
 import xarray as xr
-import xesmf as xe
 
-# List of common coordinate names
+from utils.python import tracing
+
+logger = logging.getLogger(__name__)
+
+# List of common coordinate names, in order of preference
 coordinate_names = {
     'latitude': ['lat', 'latitude', 'xlat', 'xlat_u', 'xlat_v'],
-    'longitude': ['lon', 'longitude', 'xlon', 'xlong', 'xlong_u', 'xlong_v' 'long'],
+    'longitude': ['lon', 'longitude', 'xlon', 'xlong', 'xlong_u', 'xlong_v', 'long'],
     'time': ['time', 'xtime'],
 }
 
+# Reverse lookup of lower-case alias to (standard name, preference), built once
+_coordinate_aliases = {alias: (standard, rank)
+                       for standard, aliases in coordinate_names.items()
+                       for rank, alias in enumerate(aliases)}
+
+
+def _best_alias(names):
+    """For each standard name, the most preferred of `names` that is an alias of it."""
+    best = {}
+    for name in names:
+        match = _coordinate_aliases.get(str(name).lower())
+        if match is not None:
+            standard, rank = match
+            if standard not in best or rank < best[standard][1]:
+                best[standard] = (name, rank)
+    return {standard: name for standard, (name, _) in best.items()}
+
+
+@tracing.traced('standardise_coords', 'netcdf')
 def standardise_coords(ds):
-    """Standardises coordinate names in a dataset."""
-    for coord in ds.coords:
-        for key, _ in coordinate_names.items():
-            if coord.lower() in coordinate_names[key]:
-                ds = ds.rename({coord: key})
-    return ds
+    """Standardises coordinate and dimension names in a dataset.
+
+    All renames are collected first and applied in a single `rename`. Where several coordinates
+    are aliases of the same name (e.g. WRF's XLAT, XLAT_U and XLAT_V) only the most preferred one
+    is renamed. A dimension is renamed too if it has no coordinate of its own, or if the renamed
+    coordinate lies along it (e.g. WRF's XTIME on Time becomes the 'time' index). The
+    `coordinates` attribute/encoding of data variables is updated to the new names. The data
+    arrays of `ds` are shared, never copied; only the variable and index objects are new.
+
+    Args:
+        ds (xarray.Dataset): dataset to standardise.
+    Returns:
+        xarray.Dataset: dataset with standardised names (`ds` itself if nothing needed renaming).
+    """
+    coords = _best_alias(ds.coords)
+    dims = _best_alias(ds.dims)
+
+    rename = {}
+    promote = []
+    for standard in coordinate_names:
+        coord = coords.get(standard)
+        if coord is not None and coord != standard and standard not in ds.variables:
+            rename[coord] = standard
+        else:
+            coord = standard if standard in ds.variables else None
+        dim = dims.get(standard)
+        if dim is None or dim == standard or dim in rename:
+            continue
+        if coord is None:
+            rename[dim] = standard
+        elif ds[coord].dims == (dim,):
+            rename[dim] = standard
+            promote.append(standard)
+    if not rename:
+        return ds
+
+    renamed = ds.rename(rename)
+    for name in promote:
+        if name not in renamed.xindexes:
+            renamed = renamed.set_xindex(name)
+
+    # Data-variable-level coordinate references (CF/WRF 'coordinates' attribute)
+    for variable in renamed.data_vars.values():
+        for mapping in (variable.attrs, variable.encoding):
+            if isinstance(mapping.get('coordinates'), str):
+                mapping['coordinates'] = ' '.join(rename.get(c, c) for c in mapping['coordinates'].split())
+    return renamed
+
+
+def grid_hash(ds):
+    """Hash of the horizontal grid of a dataset (latitude, longitude and any cell bounds).
+
+    Args:
+        ds (xarray.Dataset): dataset with standardised 'latitude' and 'longitude' coordinates.
+    Returns:
+        str: hex digest identifying the grid.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in ('latitude', 'longitude', 'lat_b', 'lon_b'):
+        if name in ds.variables:
+            values = np.ascontiguousarray(ds[name].values, dtype='float64')
+            digest.update(f'{name}{values.shape}'.encode())
+            digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+# Interpolation methods of the sparse backend; 'bilinear' and 'nearest_s2d' match xesmf's methods
+SPARSE_METHODS = ('bilinear', 'nearest_s2d', 'idw')
+# Number of neighbours used by inverse distance weighting
+IDW_NEIGHBOURS = 4
+
+
+def _unit_vectors(lat, lon):
+    """Points on the unit sphere, so that KD-tree distances are chord lengths (no wrap-around or pole issues)."""
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _grid_2d(grid):
+    """2-D latitude and longitude arrays and their dimension names, for a regular or curvilinear grid."""
+    lat, lon = grid['latitude'], grid['longitude']
+    if lat.ndim == 1:
+        lon2d, lat2d = np.meshgrid(lon.values, lat.values)
+        return lat2d, lon2d, lat.dims + lon.dims
+    return lat.values, lon.values, lat.dims
+
+
+def _bilinear_weights(src_lat, src_lon, dst_lat, dst_lon, nearest, iterations=8, tolerance=1e-6):
+    """Bilinear weights of each target point in the source cell containing it.
+
+    The four cells around the nearest source node are tried in turn. For each, the bilinear map
+    from the unit square to the cell (in a local plane around the target point) is inverted with
+    Newton's method, vectorised over all target points.
+
+    Returns:
+        tuple: (rows, columns, weights) of the target points found in a cell.
+    """
+    ny, nx = src_lat.shape
+    n_target = dst_lat.size
+    j0, i0 = np.divmod(nearest, nx)
+    found = np.zeros(n_target, dtype=bool)
+    rows, cols, weights = [], [], []
+    cos_lat = np.cos(np.deg2rad(dst_lat))
+    for dj in (0, -1):
+        for di in (0, -1):
+            j = np.clip(j0 + dj, 0, ny - 2)
+            i = np.clip(i0 + di, 0, nx - 2)
+            corners = [(j, i), (j, i + 1), (j + 1, i + 1), (j + 1, i)]
+            # Corner positions relative to the target point, in a local equirectangular plane
+            x = np.stack([((src_lon[c] - dst_lon + 180) % 360 - 180) * cos_lat for c in corners])
+            y = np.stack([src_lat[c] - dst_lat for c in corners])
+            s = np.full(n_target, 0.5)
+            t = np.full(n_target, 0.5)
+            for _ in range(iterations):
+                w = np.stack([(1 - s) * (1 - t), s * (1 - t), s * t, (1 - s) * t])
+                fx, fy = (w * x).sum(axis=0), (w * y).sum(axis=0)
+                dxs = (x[1] - x[0]) * (1 - t) + (x[2] - x[3]) * t
+                dys = (y[1] - y[0]) * (1 - t) + (y[2] - y[3]) * t
+                dxt = (x[3] - x[0]) * (1 - s) + (x[2] - x[1]) * s
+                dyt = (y[3] - y[0]) * (1 - s) + (y[2] - y[1]) * s
+                det = dxs * dyt - dxt * dys
+                det = np.where(det == 0, np.nan, det)
+                s = s - (fx * dyt - fy * dxt) / det
+                t = t - (fy * dxs - fx * dys) / det
+            inside = ~found & (s >= -tolerance) & (s <= 1 + tolerance) & (t >= -tolerance) & (t <= 1 + tolerance)
+            s, t = np.clip(s, 0, 1), np.clip(t, 0, 1)
+            w = np.stack([(1 - s) * (1 - t), s * (1 - t), s * t, (1 - s) * t])
+            target = np.flatnonzero(inside)
+            for k, (cj, ci) in enumerate(corners):
+                rows.append(target)
+                cols.append(cj[target] * nx + ci[target])
+                weights.append(w[k, target])
+            found |= inside
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+
+
+class SparseRegridder:
+    """ESMF-free regridder, with weights built from a KD-tree and applied as a sparse matrix multiply.
+
+    Works for regular and curvilinear (e.g. WRF XLAT/XLONG) source and target grids, and can be used
+    wherever an xe.Regridder is: it is called on a Dataset or DataArray, and its weights are written
+    with `to_netcdf` in the same (row, col, S) format as xesmf. Target points outside the source grid
+    are NaN (xesmf sets them to 0 unless `unmapped_to_nan=True`).
+
+    Args:
+        source (xarray.Dataset): source grid, with standardised coordinate names.
+        target (xarray.Dataset): target grid, with standardised coordinate names.
+        method (str, optional): 'bilinear', 'nearest_s2d' (nearest source point) or 'idw' (inverse
+            distance weighting of the IDW_NEIGHBOURS nearest source points). Defaults to 'bilinear'.
+            Only a label when `weights` are given, which may come from any xesmf method.
+        weights (str or scipy.sparse matrix, optional): weights file written by `to_netcdf` or by
+            xesmf, or a matrix, to skip building the weights. Defaults to None.
+    """
+
+    # Arrays written by `to_memmap`
+    _memmap_arrays = ('data', 'indices', 'indptr', 'unmapped', 'latitude', 'longitude')
+
+    def __init__(self, source, target, method='bilinear', weights=None):
+        import scipy.sparse
+
+        if weights is None and method not in SPARSE_METHODS:
+            raise ValueError(f"Method {method!r} is not supported by the sparse backend, use one of {SPARSE_METHODS}.")
+        self.method = method
+        src_lat, src_lon, self.source_dims = _grid_2d(source)
+        dst_lat, dst_lon, self.target_dims = _grid_2d(target)
+        self.source_shape, self.target_shape = src_lat.shape, dst_lat.shape
+        self.target_coords = {name: target[name] for name in ('latitude', 'longitude')}
+        n_source, n_target = src_lat.size, dst_lat.size
+
+        if weights is None:
+            weights = self._build_weights(src_lat, src_lon, dst_lat.ravel(), dst_lon.ravel())
+        elif not scipy.sparse.issparse(weights):
+            with xr.open_dataset(weights) as w:
+                # xesmf's format: 1-based row (target) and column (source) indices
+                weights = scipy.sparse.coo_matrix((w['S'].values, (w['row'].values - 1, w['col'].values - 1)),
+                                                  shape=(n_target, n_source))
+        self.weights = scipy.sparse.csr_matrix(weights)
+        self.unmapped = np.diff(self.weights.indptr) == 0
+
+    def _build_weights(self, src_lat, src_lon, dst_lat, dst_lon):
+        import scipy.sparse
+        from scipy.spatial import cKDTree
+
+        n_source, n_target = src_lat.size, dst_lat.size
+        tree = cKDTree(_unit_vectors(src_lat.ravel(), src_lon.ravel()))
+        points = _unit_vectors(dst_lat, dst_lon)
+        if self.method == 'nearest_s2d':
+            _, nearest = tree.query(points)
+            rows, cols, values = np.arange(n_target), nearest, np.ones(n_target)
+        elif self.method == 'idw':
+            distance, nearest = tree.query(points, k=min(IDW_NEIGHBOURS, n_source))
+            distance, nearest = distance.reshape(n_target, -1), nearest.reshape(n_target, -1)
+            exact = distance[:, :1] == 0
+            inverse = np.where(exact, np.where(distance == 0, 1., 0.), 1 / np.where(distance == 0, 1., distance))
+            values = (inverse / inverse.sum(axis=1, keepdims=True)).ravel()
+            rows, cols = np.repeat(np.arange(n_target), nearest.shape[1]), nearest.ravel()
+        else:
+            _, nearest = tree.query(points)
+            rows, cols, values = _bilinear_weights(src_lat, src_lon, dst_lat, dst_lon, nearest)
+        return scipy.sparse.coo_matrix((values, (rows, cols)), shape=(n_target, n_source))
+
+    def to_netcdf(self, filename):
+        """Write the weights in xesmf's format."""
+        w = self.weights.tocoo()
+        xr.Dataset({'S': ('n_s', w.data), 'row': ('n_s', w.row + 1), 'col': ('n_s', w.col + 1)}).to_netcdf(filename)
+
+    def to_memmap(self, directory):
+        """Write the weights and target grid as .npy files that `from_memmap` maps into memory.
+
+        Args:
+            directory (str or Path): directory for the files, created if it does not exist.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        arrays = {'data': self.weights.data, 'indices': self.weights.indices, 'indptr': self.weights.indptr,
+                  'unmapped': self.unmapped, 'latitude': self.target_coords['latitude'].values,
+                  'longitude': self.target_coords['longitude'].values}
+        for name, values in arrays.items():
+            np.save(directory / f'{name}.npy', values)
+        meta = {'method': self.method, 'source_dims': list(self.source_dims), 'source_shape': self.source_shape,
+                'target_dims': list(self.target_dims), 'target_shape': self.target_shape,
+                'shape': self.weights.shape,
+                'coord_dims': {name: list(c.dims) for name, c in self.target_coords.items()}}
+        # Written last, so that its presence means the arrays are complete
+        (directory / 'regridder.json').write_text(json.dumps(meta))
+
+    @classmethod
+    def from_memmap(cls, directory):
+        """A regridder whose weights and target grid are read-only memory maps of the files written by
+        `to_memmap`. Processes mapping the same files share one copy of them in the page cache.
+        """
+        import scipy.sparse
+
+        directory = Path(directory)
+        meta = json.loads((directory / 'regridder.json').read_text())
+        arrays = {name: np.load(directory / f'{name}.npy', mmap_mode='r') for name in cls._memmap_arrays}
+        regridder = cls.__new__(cls)
+        regridder.method = meta['method']
+        regridder.source_dims, regridder.target_dims = tuple(meta['source_dims']), tuple(meta['target_dims'])
+        regridder.source_shape, regridder.target_shape = tuple(meta['source_shape']), tuple(meta['target_shape'])
+        regridder.target_coords = {name: xr.DataArray(arrays[name], dims=dims, name=name)
+                                   for name, dims in meta['coord_dims'].items()}
+        # The index arrays keep the dtype scipy chose when building them, so nothing is copied
+        regridder.weights = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                                    shape=tuple(meta['shape']), copy=False)
+        regridder.unmapped = arrays['unmapped']
+        return regridder
+
+    def _apply(self, data):
+        """Regrid an array whose last dimensions are the source grid."""
+        leading = data.shape[:data.ndim - len(self.source_dims)]
+        flat = data.reshape(-1, self.weights.shape[1])
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype('float64')
+        result = np.asarray(self.weights @ flat.T).T.astype(dtype, copy=False)
+        result[:, self.unmapped] = np.nan
+        return result.reshape(leading + self.target_shape)
+
+    def regrid_dataarray(self, da, keep_attrs=True):
+        dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else np.dtype('float64')
+        # Give the output dimensions temporary names, in case they clash with the source dimensions
+        out_dims = [f'__{d}' for d in self.target_dims]
+        result = xr.apply_ufunc(
+            self._apply, da, input_core_dims=[list(self.source_dims)], output_core_dims=[out_dims],
+            exclude_dims=set(self.source_dims), dask='parallelized', output_dtypes=[dtype],
+            dask_gufunc_kwargs={'output_sizes': dict(zip(out_dims, self.target_shape))}, keep_attrs=keep_attrs)
+        result = result.rename(dict(zip(out_dims, self.target_dims)))
+        return result.assign_coords(self.target_coords)
+
+    def __call__(self, data, keep_attrs=True):
+        """Regrid a DataArray, or every data variable of a Dataset that lies on the source grid."""
+        if isinstance(data, xr.DataArray):
+            return self.regrid_dataarray(data, keep_attrs=keep_attrs)
+        source_coords = [c for c in data.coords if set(data[c].dims) & set(self.source_dims)]
+        regridded = {name: self.regrid_dataarray(variable.drop_vars(source_coords, errors='ignore'), keep_attrs)
+                     for name, variable in data.data_vars.items() if set(self.source_dims) <= set(variable.dims)}
+        result = xr.Dataset(regridded, attrs=data.attrs if keep_attrs else {})
+        return result.assign_coords(self.target_coords)
+
+
+def _regridder_class(backend):
+    """The regridder class of a backend; xesmf is only imported when it is used."""
+    if backend == 'xesmf':
+        import xesmf as xe
+        return xe.Regridder
+    if backend == 'sparse':
+        return SparseRegridder
+    raise ValueError(f"Unknown regridding backend {backend!r}, expected 'xesmf' or 'sparse'.")
+
+
+class RegridderCache:
+    """Two-tier cache of regridders (xe.Regridder or SparseRegridder).
+
+    Regridders are kept in an in-memory LRU, and optionally their sparse weights are written
+    to `weights_dir`, so that later processes on the same source and target grids skip weight
+    generation entirely. Entries are keyed by a hash of the source grid, target grid, method
+    and any other Regridder keyword arguments.
+
+    Args:
+        maxsize (int, optional): number of regridders kept in memory. Defaults to 8.
+        weights_dir (str or Path, optional): directory for weight files. Defaults to None (memory only).
+    """
 
+    def __init__(self, maxsize=8, weights_dir=None):
+        self.maxsize = maxsize
+        self.weights_dir = Path(weights_dir) if weights_dir else None
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._regridders = OrderedDict()
 
-def interpolate_irregular_to_regular_grid(irregular_data, regular_data, regrid_kwargs={}):
+    def key(self, source, target, method='bilinear', **regrid_kwargs):
+        """Cache key for a source grid, target grid, method and Regridder kwargs."""
+        options = repr(sorted(regrid_kwargs.items()))
+        return hashlib.blake2b(f'{grid_hash(source)}-{grid_hash(target)}-{method}-{options}'.encode(),
+                               digest_size=16).hexdigest()
+
+    def weights_file(self, key, method='bilinear'):
+        """Path of the on-disk weights for a key, or None if there is no disk tier."""
+        if self.weights_dir is None:
+            return None
+        return self.weights_dir / f'{method}_{key}.nc'
+
+    def get(self, source, target, method='bilinear', backend='xesmf', **regrid_kwargs):
+        """Return a Regridder from source to target grid, building it only on a cache miss.
+
+        Args:
+            source (xarray.Dataset): source grid, with standardised coordinate names.
+            target (xarray.Dataset): target grid, with standardised coordinate names.
+            method (str, optional): interpolation method. Defaults to 'bilinear'.
+            backend (str, optional): 'xesmf', or 'sparse' for SparseRegridder. Defaults to 'xesmf'.
+            **regrid_kwargs: further keyword arguments for xe.Regridder.
+        Returns:
+            xe.Regridder or SparseRegridder
+        """
+        new_regridder = _regridder_class(backend)
+        # Weights of other backends are kept apart from xesmf's, which keep their original names
+        label = method if backend == 'xesmf' else f'{backend}-{method}'
+        key = self.key(source, target, label, **regrid_kwargs)
+        if key in self._regridders:
+            self._regridders.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return self._regridders[key]
+
+        weights_file = self.weights_file(key, label)
+        if weights_file is not None and weights_file.is_file():
+            regridder = new_regridder(source, target, method, weights=str(weights_file), **regrid_kwargs)
+            self.stats['disk_hits'] += 1
+        else:
+            regridder = new_regridder(source, target, method, **regrid_kwargs)
+            self.stats['misses'] += 1
+            if weights_file is not None:
+                # Write to a temporary file first so that concurrent processes never read a partial file.
+                weights_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp = weights_file.with_name(f'.{weights_file.name}.{os.getpid()}')
+                regridder.to_netcdf(str(tmp))
+                os.replace(tmp, weights_file)
+
+        self._regridders[key] = regridder
+        if len(self._regridders) > self.maxsize:
+            self._regridders.popitem(last=False)
+        return regridder
+
+    def clear(self):
+        """Empty the in-memory tier and reset the counters (weight files are kept)."""
+        self._regridders.clear()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+
+def horizontal_grid(ds):
+    """Extract the horizontal grid of a dataset as a dataset of 'latitude' and 'longitude' only.
+
+    WRF stores XLAT/XLONG with a leading Time dimension; the grid is static, so only the first
+    entry along any non-horizontal dimension is kept.
+
+    Args:
+        ds (xarray.Dataset): dataset with standardised 'latitude' and 'longitude' coordinates.
+    Returns:
+        xarray.Dataset: the grid, with 1-D or 2-D latitude and longitude.
+    """
+    lat, lon = ds['latitude'], ds['longitude']
+    if lat.ndim == 1 and lon.ndim == 1:
+        horizontal_dims = lat.dims + lon.dims
+    else:
+        horizontal_dims = lat.dims[-2:]
+    grid = xr.Dataset(coords={'latitude': lat, 'longitude': lon})
+    extra = [d for d in grid.dims if d not in horizontal_dims]
+    grid = grid.isel({d: 0 for d in extra}, drop=True)
+    return grid.drop_vars([c for c in grid.coords if c not in ('latitude', 'longitude')])
+
+
+# Shared by default across calls; set UTILS_REGRID_WEIGHTS_DIR to also keep weights on disk.
+regridder_cache = RegridderCache(weights_dir=os.environ.get('UTILS_REGRID_WEIGHTS_DIR'))
+
+
+def interpolate_irregular_to_regular_grid(irregular_data, regular_data, regrid_kwargs=None, cache=regridder_cache,
+                                          backend='xesmf'):
     """Interpolates irregularly spaced data to a regular grid.
 
     Args:
-        irregular_data (xarray.Dataset): Dataset containing irregularly spaced data.
+        irregular_data (xarray.Dataset): Dataset containing irregularly spaced data. Any number
+            of leading dimensions (e.g. time x level x y x x) and data variables are regridded
+            in one call; dask-backed inputs stay lazy.
         regular_data (xarray.Dataset): Dataset containing regular grid data.
-        regrid_kwargs (dict, optional): Keyword arguments for xe.Regridder. Defaults to {}. 
+        regrid_kwargs (dict, optional): Keyword arguments for xe.Regridder. Defaults to None. 
             Useful kwargs include:
                 - method: what interpolation method to use.
                 - filename: path to a file with weights, or where to save weights if the file does not exist.
                 - reuse_weights: whether to reuse existing weights if they exist.
+        cache (RegridderCache, optional): cache of regridders to reuse across calls, None to always
+            build a new regridder. Defaults to the module-level `regridder_cache`.
+        backend (str, optional): 'xesmf', or 'sparse' for the ESMF-free SparseRegridder, which supports
+            the 'bilinear', 'nearest_s2d' and 'idw' methods and no other kwargs. Defaults to 'xesmf'.
     Returns:
         xarray.Dataset: Dataset containing irregular data interpolated to a regular grid.
     """
 
-    # ! TODO: this currently requires use like wrf_ds['T2'].isel({'Time':0}), needs further testing to see if multiple timesteps can work.
-
     # Convert coordinates to standard names
     irregular_data = standardise_coords(irregular_data)
     regular_data = standardise_coords(regular_data)
 
-    # Create regular target dataset
-    target_ds = xr.Dataset({
-    'latitude': regular_data['latitude'],
-    'longitude': regular_data['longitude'],
-    })
+    # The weights only depend on the horizontal grids, not on the time steps or levels
+    source_grid = horizontal_grid(irregular_data)
+    target_ds = horizontal_grid(regular_data)
+
+    # Create regridder, copying the kwargs so the caller's dict is never modified
+    regrid_kwargs = dict(regrid_kwargs or {})
+    method = regrid_kwargs.pop('method', 'bilinear')
+
+    with tracing.span('regrid.weights', 'netcdf', method=method, backend=backend):
+        if cache is None:
+            regridder = _regridder_class(backend)(source_grid, target_ds, method, **regrid_kwargs)
+        else:
+            regridder = cache.get(source_grid, target_ds, method, backend, **regrid_kwargs)
+
+    # For dask-backed inputs this only builds the graph; the work is done when the result is computed
+    with tracing.span('regrid.apply', 'netcdf'):
+        return _apply_regridder(regridder, irregular_data, source_grid)
+
+
+def _apply_regridder(regridder, irregular_data, source_grid):
+    """Regrid a standardised dataset with a regridder built for its horizontal grid."""
+    # Dask-backed inputs may be chunked along time/level, but not across the horizontal grid
+    horizontal_dims = set(source_grid['latitude'].dims + source_grid['longitude'].dims)
+    if any(v.chunks is not None for v in irregular_data.data_vars.values()):
+        irregular_data = irregular_data.chunk({d: -1 for d in horizontal_dims})
+
+    # Regrid every data variable over all leading (time, level, ...) dimensions at once
+    # with a single sparse matrix multiply per variable
+    return regridder(irregular_data, keep_attrs=True)
+
+
+def _regrid_file_group(files, output, target_grid, regrid_kwargs, weights_dir, concat_dim, time_chunk, backend):
+    """Worker: lazily open a group of files, regrid them chunk by chunk and write one output file."""
+    import dask
+
+    start = time.monotonic()
+    cache = RegridderCache(maxsize=1, weights_dir=weights_dir)
+    # One chunk in memory at a time per worker
+    with dask.config.set(scheduler='synchronous'):
+        with xr.open_mfdataset(files, combine='nested', concat_dim=concat_dim, chunks={concat_dim: time_chunk},
+                               data_vars='minimal', coords='minimal', compat='override') as ds:
+            regridded = interpolate_irregular_to_regular_grid(ds, target_grid, regrid_kwargs, cache=cache,
+                                                              backend=backend)
+            _to_netcdf_atomic(regridded, output)
+    return output, time.monotonic() - start
+
+
+def _to_netcdf_atomic(ds, output):
+    """Write to a temporary file renamed on success, so an interrupted run leaves no partial output."""
+    tmp = output.with_name(f'.{output.name}.{os.getpid()}')
+    try:
+        ds.to_netcdf(tmp)
+        os.replace(tmp, output)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def regrid_files(pattern, regular_data, output_dir, regrid_kwargs=None, files_per_task=1, time_chunk=24,
+                 processes=None, weights_dir=None, overwrite=False, backend='xesmf'):
+    """Regrid a multi-file archive to a regular grid without loading it into memory.
+
+    Files matching `pattern` are split into groups of `files_per_task` consecutive files, and the
+    groups are regridded in parallel across processes. Each worker opens its files lazily,
+    standardises coordinates, regrids `time_chunk` time steps at a time and streams the result to
+    one NetCDF file per group in `output_dir`. The regridding weights are generated once, in this
+    process, and read from disk by the workers. With many workers, SharedRegridExecutor avoids
+    holding a copy of the weights in each of them.
+
+    Args:
+        pattern (str or list): glob pattern (or list) of NetCDF files, e.g. 'wrfout_d01_2020-*'.
+        regular_data (xarray.Dataset): Dataset containing the regular target grid.
+        output_dir (str or Path): directory for the regridded files.
+        regrid_kwargs (dict, optional): Keyword arguments for xe.Regridder. Defaults to None.
+        files_per_task (int, optional): number of consecutive files per output file. Defaults to 1.
+        time_chunk (int, optional): time steps held in memory at once per worker. Defaults to 24.
+        processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+        weights_dir (str or Path, optional): where to keep the weights, defaults to a temporary directory.
+        overwrite (bool, optional): regrid again if an output file exists. Defaults to False, so an
+            interrupted run can be resumed.
+        backend (str, optional): 'xesmf' or 'sparse', see interpolate_irregular_to_regular_grid. Defaults to 'xesmf'.
+    Returns:
+        list: paths of the regridded files.
+    """
+    files = sorted(glob.glob(pattern)) if isinstance(pattern, (str, Path)) else sorted(str(f) for f in pattern)
+    if not files:
+        raise FileNotFoundError(f"No files match {pattern}")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    regrid_kwargs = dict(regrid_kwargs or {})
+    options = dict(regrid_kwargs)
+    method = options.pop('method', 'bilinear')
+
+    with xr.open_dataset(files[0]) as first:
+        concat_dim = next((d for d in ('Time', 'time', 'valid_time') if d in first.dims), None)
+        if concat_dim is None:
+            raise ValueError(f"No time dimension found in {files[0]}")
+        source_grid = horizontal_grid(standardise_coords(first))
+    target_grid = horizontal_grid(standardise_coords(regular_data))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        weights_dir = weights_dir or tmp_dir
+        # Build the weights once; workers find them in the disk tier of their own cache
+        cache = RegridderCache(maxsize=1, weights_dir=weights_dir)
+        with tracing.span('regrid.weights', 'netcdf', method=method, backend=backend):
+            cache.get(source_grid, target_grid, method, backend, **options)
+
+        groups = [files[i:i + files_per_task] for i in range(0, len(files), files_per_task)]
+        outputs = [output_dir / f'{Path(group[0]).stem}_regridded.nc' for group in groups]
+        tasks = []
+        for group, output in zip(groups, outputs):
+            if output.exists() and not overwrite:
+                logger.info(f"Skipping {output}, already regridded.")
+                continue
+            tasks.append((group, output))
+
+        # Workers are not traced; the span covers the whole parallel run
+        with tracing.span('regrid.files', 'netcdf', files=len(files), tasks=len(tasks)) as span, \
+                ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_regrid_file_group, group, output, target_grid, regrid_kwargs,
+                                       weights_dir, concat_dim, time_chunk, backend)
+                       for group, output in tasks]
+            for future, (group, _) in zip(futures, tasks):
+                output, elapsed = future.result()
+                span.add_bytes(read=sum(tracing.file_size(f) for f in group), written=tracing.file_size(output))
+                logger.info(f"Regridded {output} in {elapsed:.1f}s")
+
+    return outputs
+
+
+# The regridder of a SharedRegridExecutor worker process, set by the pool initializer
+_shared_regridder = None
+
+
+def _attach_shared_regridder(directory):
+    """Pool initializer: map the shared weights and target grid into this worker."""
+    global _shared_regridder
+    _shared_regridder = SparseRegridder.from_memmap(directory)
+
+
+def _regrid_shared(files, output, source_hash, concat_dim, time_chunk):
+    """Worker: regrid a group of files with the shared regridder and write one output file."""
+    import dask
+
+    start = time.monotonic()
+    with dask.config.set(scheduler='synchronous'):
+        with xr.open_mfdataset(files, combine='nested', concat_dim=concat_dim, chunks={concat_dim: time_chunk},
+                               data_vars='minimal', coords='minimal', compat='override') as ds:
+            n_steps = ds.sizes[concat_dim]
+            ds = standardise_coords(ds)
+            source_grid = horizontal_grid(ds)
+            if grid_hash(source_grid) != source_hash:
+                raise ValueError(f"{files[0]} is not on the grid the shared weights were built for.")
+            _to_netcdf_atomic(_apply_regridder(_shared_regridder, ds, source_grid), output)
+    n_bytes = sum(os.path.getsize(f) for f in files)
+    return os.getpid(), output, n_steps, n_bytes, time.monotonic() - start
+
+
+class SharedRegridExecutor:
+    """Regrid many files with one set of weights, shared zero-copy by a pool of worker processes.
+
+    The weights are built once, in this process, and written with the target grid to .npy files
+    that every worker maps read-only when it starts (see SparseRegridder.from_memmap). All workers
+    thus share one copy of the weights in the page cache, so memory use stays flat as workers are
+    added, where regrid_files loads a copy of the weights in every worker. Weights built by xesmf
+    are converted to a SparseRegridder, so target points outside the source grid are NaN.
+
+    Example:
+        with SharedRegridExecutor(xr.open_dataset(files[0]), era5_grid, processes=32) as executor:
+            executor.map(files, 'regridded')
+        print(executor.throughput)
+
+    Args:
+        source (xarray.Dataset): a dataset on the source grid, e.g. the first file to regrid.
+        target (xarray.Dataset): a dataset on the regular target grid.
+        regrid_kwargs (dict, optional): 'method' and other regridder kwargs. Defaults to None.
+        backend (str, optional): 'sparse' or 'xesmf', to build the weights. Defaults to 'sparse'.
+        processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+        directory (str or Path, optional): where to write the memory-mapped files. Defaults to a
+            temporary directory, removed by `close`.
+    """
+
+    def __init__(self, source, target, regrid_kwargs=None, backend='sparse', processes=None, directory=None):
+        source_grid = horizontal_grid(standardise_coords(source))
+        target_grid = horizontal_grid(standardise_coords(target))
+        self.source_hash = grid_hash(source_grid)
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='regrid_') if directory is None else None
+        self.directory = Path(directory if directory is not None else self._tmp_dir.name)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        regrid_kwargs = dict(regrid_kwargs or {})
+        method = regrid_kwargs.pop('method', 'bilinear')
+        regridder = _regridder_class(backend)(source_grid, target_grid, method, **regrid_kwargs)
+        if not isinstance(regridder, SparseRegridder):
+            weights_file = self.directory / 'weights.nc'
+            regridder.to_netcdf(str(weights_file))
+            regridder = SparseRegridder(source_grid, target_grid, method, weights=str(weights_file))
+        regridder.to_memmap(self.directory)
+
+        self.processes = processes or os.cpu_count() or 1
+        # Worker process id -> files, time steps, bytes read and seconds spent regridding
+        self.throughput = {}
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=_attach_shared_regridder,
+                                             initargs=(str(self.directory),))
+
+    def map(self, files, output_dir, files_per_task=1, time_chunk=24, overwrite=False):
+        """Regrid files in the worker pool, one output file per group of `files_per_task` files.
+
+        Args:
+            files (str or list): glob pattern (or list) of NetCDF files on the source grid.
+            output_dir (str or Path): directory for the regridded files.
+            files_per_task, time_chunk, overwrite: as for regrid_files.
+        Returns:
+            list: paths of the regridded files.
+        """
+        pattern = files
+        files = sorted(glob.glob(pattern)) if isinstance(pattern, (str, Path)) else sorted(str(f) for f in pattern)
+        if not files:
+            raise FileNotFoundError(f"No files match {pattern}")
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        with xr.open_dataset(files[0]) as first:
+            concat_dim = next((d for d in ('Time', 'time', 'valid_time') if d in first.dims), None)
+        if concat_dim is None:
+            raise ValueError(f"No time dimension found in {files[0]}")
+
+        groups = [files[i:i + files_per_task] for i in range(0, len(files), files_per_task)]
+        outputs = [output_dir / f'{Path(group[0]).stem}_regridded.nc' for group in groups]
+        futures = [self._executor.submit(_regrid_shared, group, output, self.source_hash, concat_dim, time_chunk)
+                   for group, output in zip(groups, outputs) if overwrite or not output.exists()]
+        for future in as_completed(futures):
+            pid, output, n_steps, n_bytes, elapsed = future.result()
+            stats = self.throughput.setdefault(pid, {'files': 0, 'time_steps': 0, 'bytes': 0, 'seconds': 0.})
+            stats['files'] += 1
+            stats['time_steps'] += n_steps
+            stats['bytes'] += n_bytes
+            stats['seconds'] += elapsed
+            logger.info(f"Worker {pid} regridded {output} in {elapsed:.1f}s")
+        self.log_throughput()
+        return outputs
 
-    # Create regridder
-    if 'method' not in regrid_kwargs:
-        regrid_kwargs['method'] = 'bilinear'
-        
-    regridder = xe.Regridder(irregular_data, target_ds, **regrid_kwargs)
+    def log_throughput(self):
+        for pid, stats in sorted(self.throughput.items()):
+            seconds = max(stats['seconds'], 1e-9)
+            logger.info(f"Worker {pid}: {stats['files']} files, {stats['time_steps'] / seconds:.1f} time steps/s, "
+                        f"{stats['bytes'] / seconds / 1e6:.1f} MB/s")
 
-    # Regrid the data
-    regridded_data = regridder(irregular_data)
+    def close(self):
+        """Shut down the worker pool and remove the temporary memory-mapped files."""
+        self._executor.shutdown()
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
 
-    return regridded_data
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,38 @@
+"""Benchmarks, run with pytest-benchmark:
+
+    pytest benchmarks                          # run, and save the results
+    pytest benchmarks --benchmark-compare      # also compare with the last saved run
+    pytest benchmarks --benchmark-compare-fail=mean:10%   # fail on a 10% regression
+
+Each run is saved as JSON in benchmarks/.results, named after the git commit, so timings can be
+compared between commits. The default `pytest` run only collects tests/ (see pyproject.toml).
+"""
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+from utils.benchmarks.data import era5_grid
+
+if importlib.util.find_spec('pytest_benchmark') is None:
+    collect_ignore_glob = ['test_*.py']
+
+RESULTS = Path(__file__).parent / '.results'
+
+
+def pytest_configure(config):
+    # Runs before pytest-benchmark sets up its session, so these act as defaults for it.
+    if hasattr(config.option, 'benchmark_autosave'):
+        from pytest_benchmark.utils import get_tag
+
+        if not config.option.benchmark_save:
+            # Named after the commit, as --benchmark-autosave does
+            config.option.benchmark_autosave = get_tag()
+        if config.option.benchmark_storage == 'file://./.benchmarks':
+            config.option.benchmark_storage = f'file://{RESULTS}'
+
+
+@pytest.fixture(scope='session')
+def nz_grid():
+    """ERA5 0.25 degree grid over New Zealand, as in download_yamls/era5_nz.yaml."""
+    return era5_grid(west=165., east=180., south=-50., north=-32.)
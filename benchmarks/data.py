@@ -0,0 +1,24 @@
+"""Synthetic datasets at realistic ERA5 and WRF sizes."""
+import numpy as np
+import xarray as xr
+
+
+def era5_grid(resolution=0.25, west=-180., east=180., south=-90., north=90.):
+    """Regular ERA5-like latitude/longitude grid."""
+    return xr.Dataset(coords={'latitude': np.arange(north, south - resolution / 2, -resolution),
+                              'longitude': np.arange(west, east, resolution)})
+
+
+def wrf_like(ny=300, nx=400, n_times=24, n_vars=3, seed=0):
+    """WRF-like curvilinear output: XLAT/XLONG (Time, south_north, west_east), `n_vars` variables."""
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(np.linspace(-48, -33, ny), np.linspace(165, 179, nx), indexing='ij')
+    # Rotate the grid slightly so it is genuinely curvilinear
+    lat, lon = y + 0.05 * (x - 172), x - 0.05 * (y + 40)
+    dims = ['Time', 'south_north', 'west_east']
+    data_vars = {f'VAR{i}': (dims, rng.random((n_times, ny, nx), dtype='float32')) for i in range(n_vars)}
+    return xr.Dataset(data_vars, coords={
+        'XLAT': (dims, np.broadcast_to(lat, (n_times, ny, nx)).astype('float32')),
+        'XLONG': (dims, np.broadcast_to(lon, (n_times, ny, nx)).astype('float32')),
+        'XTIME': ('Time', np.datetime64('2020-01-01T00', 'h') + np.arange(n_times)),
+    })
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import xarray as xr
+from utils.atmos.convert_units import kelvin_to_celsius, kelvin_to_fahrenheit, convert_dataset
+
+# A day of hourly global 0.25 degree ERA5 fields
+SHAPE = (24, 721, 1440)
+
+
+@pytest.fixture(scope='module')
+def temperature():
+    return (np.random.default_rng(0).random(SHAPE, dtype='float32') * 100 + 230)
+
+
+def test_kelvin_to_fahrenheit_float32(benchmark, temperature):
+    result = benchmark(kelvin_to_fahrenheit, temperature)
+    assert result.dtype == np.float32
+
+
+def test_kelvin_to_celsius_in_place(benchmark, temperature):
+    data = temperature.copy()
+    benchmark(kelvin_to_celsius, data, out=data)
+
+
+def test_convert_dataset(benchmark, temperature):
+    dims = ['valid_time', 'latitude', 'longitude']
+    ds = xr.Dataset({name: (dims, temperature, {'units': units})
+                     for name, units in [('t2m', 'K'), ('msl', 'Pa'), ('u10', 'm s**-1'), ('sd', 'm')]})
+    benchmark(convert_dataset, ds)
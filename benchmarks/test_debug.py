@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from utils.python.debug import sns_plot_and_save, hist_plot_and_save, plt_plot_and_save, plot_frames
+
+
+@pytest.fixture(scope='module')
+def global_field():
+    return np.random.default_rng(0).random((721, 1440), dtype='float32')
+
+
+def test_sns_plot_and_save_global(benchmark, global_field, tmp_path):
+    benchmark.pedantic(sns_plot_and_save, args=(global_field,), kwargs={'path': tmp_path / 'fig.png'}, rounds=3)
+
+
+def test_plt_plot_and_save_global(benchmark, global_field, tmp_path):
+    benchmark.pedantic(plt_plot_and_save, args=(global_field,), kwargs={'path': tmp_path / 'fig.png'}, rounds=3)
+
+
+def test_hist_plot_and_save_global(benchmark, global_field, tmp_path):
+    benchmark.pedantic(hist_plot_and_save, args=(global_field.ravel(),), kwargs={'path': tmp_path / 'fig.png'},
+                       rounds=3)
+
+
+def test_plot_frames(benchmark, tmp_path):
+    frames = np.random.default_rng(0).random((48, 73, 60), dtype='float32')
+    benchmark.pedantic(plot_frames, args=(frames,), kwargs={'path': str(tmp_path / 'frame_{:03d}.png')}, rounds=1)
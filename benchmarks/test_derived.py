@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import xarray as xr
+from utils.atmos.derived import derive
+
+# A day of hourly ERA5 fields over New Zealand at 0.25 degrees
+SHAPE = (24, 73, 61)
+
+
+@pytest.fixture(scope='module')
+def surface():
+    rng = np.random.default_rng(0)
+    dims = ['valid_time', 'latitude', 'longitude']
+    t2m = (rng.random(SHAPE, dtype='float32') * 30 + 270)
+    return xr.Dataset({'u10': (dims, rng.normal(0, 10, SHAPE).astype('float32')),
+                       'v10': (dims, rng.normal(0, 10, SHAPE).astype('float32')),
+                       't2m': (dims, t2m),
+                       'd2m': (dims, t2m - rng.random(SHAPE, dtype='float32') * 10)})
+
+
+def expressions(ds):
+    """The same diagnostics as separate xarray expressions, as before derive."""
+    def saturation(t):
+        return 611.21 * np.exp(17.502 * (t - 273.16) / (t - 32.19))
+    return xr.Dataset({'si10': np.hypot(ds['u10'], ds['v10']),
+                       'wdir10': (270 - np.degrees(np.arctan2(ds['v10'], ds['u10']))) % 360,
+                       'r2': 100 * saturation(ds['d2m']) / saturation(ds['t2m'])})
+
+
+def test_derive_fused(benchmark, surface):
+    benchmark(derive, surface)
+
+
+def test_derive_expressions(benchmark, surface):
+    benchmark(expressions, surface)
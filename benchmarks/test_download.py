@@ -0,0 +1,39 @@
+import datetime
+import pytest
+from utils.atmos.download_engine import DownloadEngine
+from utils.atmos.download_era5 import pressure_request
+from utils.atmos.download_planner import plan_requests
+from utils.atmos.download_scheduler import AdaptiveScheduler
+from utils.tests.fake_cds import FakeCDSClient
+
+DATASET = 'reanalysis-era5-single-levels'
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    levels = ['1', '2', '3', '5', '7', '10', '20', '30', '50', '70', '100', '125', '150', '175', '200', '225',
+              '250', '300', '350', '400', '450', '500', '550', '600', '650', '700', '750', '775', '800', '825',
+              '850', '875', '900', '925', '950', '975', '1000']
+    return {'download_dir': tmp_path, 'Nort': 90, 'West': -180, 'Sout': -90, 'East': 180,
+            'pressure_var': ['geopotential', 'relative_humidity', 'specific_humidity', 'temperature',
+                             'u_component_of_wind', 'v_component_of_wind'],
+            'pressure_levels': levels}
+
+
+def test_plan_ten_years(benchmark, cfg):
+    days = [datetime.datetime(2010, 1, 1) + datetime.timedelta(days=i) for i in range(3653)]
+    chunks = benchmark(plan_requests, days, pressure_request, cfg)
+    assert sum(len(c.days) for c in chunks) == 3653
+
+
+def test_scheduler_with_latency(benchmark, tmp_path):
+    """200 requests of 20 ms each through the engine and scheduler, at up to 10 in flight."""
+    def run():
+        engine = DownloadEngine(client_factory=lambda: FakeCDSClient(latency=0.02))
+        requests = [{'date': f'2020{i:04d}'} for i in range(200)]
+        for request in requests:
+            engine.enqueue(DATASET, request)
+        tasks = [(engine.retrieve, DATASET, request, tmp_path / f"{request['date']}.nc") for request in requests]
+        return AdaptiveScheduler(max_in_flight=10, initial_in_flight=10).run(tasks)
+
+    assert benchmark.pedantic(run, rounds=3) == []
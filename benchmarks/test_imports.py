@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import pytest
+
+# Import-time budget (seconds) per module. The budgets are several times the time measured on a
+# laptop, to catch regressions such as a new top-level import of a heavy dependency.
+# tests/test_imports.py checks which dependencies each module imports.
+BUDGETS = {
+    'utils': 0.1,
+    'utils.atmos': 0.1,
+    'utils.python': 0.1,
+    'utils.atmos.convert_units': 0.1,
+    'utils.atmos.download_manifest': 0.2,
+    'utils.atmos.download_scheduler': 0.2,
+    'utils.atmos.download_engine': 0.2,
+    'utils.atmos.download_planner': 1.,
+    'utils.atmos.download_era5': 1.,
+    'utils.atmos.netcdf': 3.,
+    'utils.atmos.era5_catalogue': 0.2,
+    'utils.atmos.derived': 0.2,
+    'utils.atmos.era5_constants': 0.2,
+    'utils.atmos.era5_store': 3.,
+    'utils.python.debug': 1.,
+    'utils.python.display': 0.1,
+    'utils.python.histogram': 1.,
+    'utils.python.tracing': 0.1,
+}
+
+MEASURE = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def import_time(module):
+    """Seconds to import `module` in a fresh interpreter."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    out = subprocess.run([sys.executable, '-c', MEASURE.format(module=module)],
+                         env=env, capture_output=True, text=True, check=True).stdout
+    return float(out)
+
+
+@pytest.mark.parametrize("module", BUDGETS)
+def test_import_budget(module):
+    # Best of three, to be robust to a busy machine
+    elapsed = min(import_time(module) for _ in range(3))
+    assert elapsed < BUDGETS[module], f"import {module} took {elapsed:.3f}s, budget {BUDGETS[module]}s"
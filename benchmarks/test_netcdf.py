@@ -0,0 +1,62 @@
+import importlib.util
+import pytest
+from utils.atmos.netcdf import standardise_coords, interpolate_irregular_to_regular_grid, RegridderCache
+from utils.benchmarks.data import wrf_like
+
+requires_xesmf = pytest.mark.skipif(importlib.util.find_spec('xesmf') is None, reason="xesmf is not installed")
+
+
+@pytest.fixture(scope='module')
+def wrf():
+    return wrf_like()
+
+
+@pytest.fixture(scope='module')
+def many_variables():
+    """A WRF-like dataset with 300 variables (wrfout files have several hundred)."""
+    return wrf_like(ny=20, nx=30, n_times=4, n_vars=300)
+
+
+def test_standardise_coords_many_variables(benchmark, many_variables):
+    result = benchmark(standardise_coords, many_variables)
+    assert 'latitude' in result.coords
+
+
+@requires_xesmf
+def test_regrid_weights(benchmark, wrf, nz_grid):
+    """Weight generation, i.e. a cold cache."""
+    benchmark.pedantic(interpolate_irregular_to_regular_grid, args=(wrf.isel(Time=[0]), nz_grid),
+                       kwargs={'cache': None}, rounds=3)
+
+
+@requires_xesmf
+def test_regrid_day_cached(benchmark, wrf, nz_grid):
+    """Regridding a day of hourly output with cached weights."""
+    cache = RegridderCache()
+    interpolate_irregular_to_regular_grid(wrf.isel(Time=[0]), nz_grid, cache=cache)
+    result = benchmark(interpolate_irregular_to_regular_grid, wrf, nz_grid, cache=cache)
+    assert result['VAR0'].shape == (24, nz_grid.sizes['latitude'], nz_grid.sizes['longitude'])
+
+
+def test_regrid_weights_sparse(benchmark, wrf, nz_grid):
+    """Weight generation with the ESMF-free backend."""
+    benchmark.pedantic(interpolate_irregular_to_regular_grid, args=(wrf.isel(Time=[0]), nz_grid),
+                       kwargs={'cache': None, 'backend': 'sparse'}, rounds=3)
+
+
+def test_regrid_day_cached_sparse(benchmark, wrf, nz_grid):
+    """Regridding a day of hourly output with cached sparse weights."""
+    cache = RegridderCache()
+    interpolate_irregular_to_regular_grid(wrf.isel(Time=[0]), nz_grid, cache=cache, backend='sparse')
+    result = benchmark(interpolate_irregular_to_regular_grid, wrf, nz_grid, cache=cache, backend='sparse')
+    assert result['VAR0'].shape == (24, nz_grid.sizes['latitude'], nz_grid.sizes['longitude'])
+
+
+def test_shared_regrid_executor(benchmark, wrf, nz_grid, tmp_path):
+    """Regridding 4 files of hourly output with weights shared by 4 workers."""
+    from utils.atmos.netcdf import SharedRegridExecutor
+    for i in range(4):
+        wrf.isel(Time=slice(6 * i, 6 * i + 6)).to_netcdf(tmp_path / f'wrfout_{i}.nc')
+    with SharedRegridExecutor(wrf, nz_grid, processes=4) as executor:
+        benchmark.pedantic(executor.map, args=(str(tmp_path / 'wrfout_*.nc'), tmp_path / 'out'),
+                           kwargs={'overwrite': True}, rounds=3)
@@ -0,0 +1,34 @@
+"""General Python helpers for plotting, notebook display and histograms.
+
+The public names below are imported from their submodule on first access, so that importing
+this package does not import matplotlib, seaborn or pandas.
+"""
+import importlib
+
+_submodules = {'debug', 'display', 'histogram', 'tracing'}
+
+# Public name -> submodule defining it
+_exports = {
+    **dict.fromkeys(['sns_plot_and_save', 'hist_plot_and_save', 'plt_plot_and_save', 'plot_frames',
+                     'block_reduce'], 'debug'),
+    **dict.fromkeys(['add_caption_to_df', 'PagedDataFrame'], 'display'),
+    **dict.fromkeys(['StreamingHistogram', 'histogram_files'], 'histogram'),
+    **dict.fromkeys(['Tracer', 'trace', 'span', 'traced', 'add_bytes'], 'tracing'),
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(f'{__name__}.{_exports[name]}'), name)
+    elif name in _submodules:
+        value = importlib.import_module(f'{__name__}.{name}')
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | _submodules)
@@ -1,21 +1,132 @@
-import seaborn as sns
-import matplotlib.pyplot as plt 
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-def sns_plot_and_save(data, path='fig.png', invert_axis=True, **kwargs):
+import numpy as np
+
+from utils.python import tracing
+
+# seaborn and matplotlib are imported on first use, as they take long to import.
+
+# Above this many cells, sns_plot_and_save draws a raster image instead of a seaborn heatmap mesh
+RASTER_THRESHOLD = 10_000
+# Keyword arguments of sns.heatmap that the raster fallback also supports
+_RASTER_KWARGS = {'vmin', 'vmax', 'cmap', 'cbar', 'center'}
+
+
+def block_reduce(data, factors, how='mean'):
+    """Reduce a 2d array over non-overlapping blocks, ignoring NaNs.
+
+    Args:
+        data (2d array): data to reduce; edges that do not fill a whole block are reduced over
+            the partial block.
+        factors (tuple): block size along each axis.
+        how (str, optional): 'mean', 'max' or 'min'. Blocks that are all NaN give NaN. Defaults to 'mean'.
+    Returns:
+        numpy.ndarray: the reduced array, of shape ceil(data.shape / factors).
+    """
+    data = np.asarray(data, dtype=float)
+    fy, fx = factors
+    ny, nx = -(-data.shape[0] // fy), -(-data.shape[1] // fx)
+    if (ny * fy, nx * fx) != data.shape:
+        data = np.pad(data, ((0, ny * fy - data.shape[0]), (0, nx * fx - data.shape[1])), constant_values=np.nan)
+    blocks = data.reshape(ny, fy, nx, fx)
+    valid = np.isfinite(blocks)
+    counts = valid.sum(axis=(1, 3))
+    if how == 'mean':
+        reduced = np.where(valid, blocks, 0).sum(axis=(1, 3))
+        np.divide(reduced, counts, out=reduced, where=counts > 0)
+    elif how in ('max', 'min'):
+        fill = -np.inf if how == 'max' else np.inf
+        reduced = getattr(np.where(valid, blocks, fill), how)(axis=(1, 3))
+    else:
+        raise ValueError(f"Unknown reduction {how!r}, expected 'mean', 'max' or 'min'.")
+    reduced[counts == 0] = np.nan
+    return reduced
+
+
+def _decimate(data, shape, how='mean'):
+    """Block-reduce a 2d array or DataFrame to at most `shape`, keeping the first label of each block."""
+    factors = tuple(max(1, -(-n // m)) for n, m in zip(data.shape, shape))
+    if factors == (1, 1):
+        return data
+    import pandas as pd
+    if isinstance(data, pd.DataFrame):
+        index, columns = data.index[::factors[0]], data.columns[::factors[1]]
+    else:
+        index, columns = np.arange(data.shape[0])[::factors[0]], np.arange(data.shape[1])[::factors[1]]
+    return pd.DataFrame(block_reduce(data, factors, how), index=index, columns=columns)
+
+
+def _decimate_shape(ax, decimate):
+    """The maximum (rows, columns) to decimate to: the size of `ax` in pixels for 'auto'."""
+    if decimate == 'auto':
+        bbox = ax.get_window_extent()
+        return (max(1, int(bbox.height)), max(1, int(bbox.width)))
+    return decimate
+
+
+def _raster_heatmap(fig, ax, data, extent, vmin=None, vmax=None, cmap=None, cbar=True, center=None):
+    """Draw 2d data as a raster image coloured as sns.heatmap would, and return the image.
+
+    The default colormaps are registered by seaborn, which must have been imported.
+    """
+    values = np.ma.masked_invalid(np.asarray(data, dtype=float))
+    if center is not None:
+        # As sns.heatmap: a diverging colormap symmetric about center
+        span = max(abs((values.max() if vmax is None else vmax) - center),
+                   abs((values.min() if vmin is None else vmin) - center))
+        vmin, vmax = center - span, center + span
+    if cmap is None:
+        cmap = 'icefire' if center is not None else 'rocket'
+    image = ax.imshow(values, cmap=cmap, vmin=vmin, vmax=vmax, aspect='auto', interpolation='nearest',
+                      extent=extent)
+    if cbar:
+        fig.colorbar(image, ax=ax)
+    return image
+
+
+@tracing.traced('sns_plot_and_save', 'plot')
+def sns_plot_and_save(data, path='fig.png', invert_axis=True, decimate='auto', reduce='mean',
+                      raster_threshold=RASTER_THRESHOLD, **kwargs):
     """Plot a seaborn heatmap of 2d dataset and save to file.
 
+    Large arrays are first block-reduced to the pixel size of the axes, which is all the output
+    can show anyway, and arrays that are still large are drawn as a raster image (imshow) instead
+    of a mesh of cells, so render time depends on the output size rather than the input size.
+
     Args:
         data (2d array): data to be plotted
         path (str, optional): filepath to save plot to. Defaults to 'fig.png'.
         invert_axis (bool, optional): ax.invert_yaxis, often needed for southern hemisphere met data. Defaults to True.
+        decimate (str, tuple or None, optional): 'auto' to reduce to the axes size in pixels, a (rows, columns)
+            maximum shape, or None to plot every cell. Defaults to 'auto'.
+        reduce (str, optional): block reduction when decimating, 'mean', 'max' or 'min'. Defaults to 'mean'.
+        raster_threshold (int, optional): number of cells above which to use imshow, when all kwargs are
+            supported by it (vmin, vmax, cmap, cbar, center). Defaults to RASTER_THRESHOLD.
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     fig, ax = plt.subplots()
-    sns.heatmap(data, ax=ax, **kwargs)
+    if hasattr(data, 'dims') or not hasattr(data, 'shape'):
+        data = np.asarray(data)
+    full_shape = data.shape
+    if decimate is not None:
+        data = _decimate(data, _decimate_shape(ax, decimate), reduce)
+
+    if data.shape[0] * data.shape[1] > raster_threshold and not set(kwargs) - _RASTER_KWARGS:
+        _raster_heatmap(fig, ax, data, (0, full_shape[1], full_shape[0], 0), **kwargs)
+    else:
+        sns.heatmap(data, ax=ax, **kwargs)
     if invert_axis:
         ax.invert_yaxis()
     fig.savefig(path, bbox_inches='tight')
     plt.close(fig)
+    if tracing.enabled():
+        tracing.add_bytes(written=tracing.file_size(path))
 
+@tracing.traced('hist_plot_and_save', 'plot')
 def hist_plot_and_save(data, path='fig.png', bins=50, **kwargs):
     """Plot a matplotlib histogram of data and save to file.
 
@@ -24,11 +135,16 @@ def hist_plot_and_save(data, path='fig.png', bins=50, **kwargs):
         path (str, optional): filepath to save plot to. Defaults to 'fig.png'.
         bins (int, optional): number of histogram bins. Defaults to 50.
     """
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.hist(data, bins=bins, **kwargs)
     fig.savefig(path, bbox_inches='tight')
     plt.close(fig)
+    if tracing.enabled():
+        tracing.add_bytes(written=tracing.file_size(path))
 
+@tracing.traced('plt_plot_and_save', 'plot')
 def plt_plot_and_save(data, path='fig.png', **kwargs):
     """Ax.imshow plot of 2d data and save to file.
 
@@ -36,7 +152,178 @@ def plt_plot_and_save(data, path='fig.png', **kwargs):
         data (2d data): data to be plotted
         path (str, optional): filepath to save plot to. Defaults to 'fig.png'.
     """
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.imshow(data, cmap="viridis", **kwargs)
     fig.savefig(path, bbox_inches='tight')
-    plt.close(fig)
\ No newline at end of file
+    plt.close(fig)
+    if tracing.enabled():
+        tracing.add_bytes(written=tracing.file_size(path))
+
+
+# Preferred names of the time dimension of a DataArray passed to plot_frames
+TIME_DIMS = ('time', 'valid_time', 'Time', 'xtime')
+
+
+class _FrameRenderer:
+    """One figure, drawn once, whose artist data is updated in place for every frame.
+
+    Uses a bare Agg Figure rather than pyplot, so no global figure state is created. Heatmap frames
+    are decimated and, when large, drawn as a raster image, as by sns_plot_and_save.
+    """
+
+    def __init__(self, kind, first, vmin=None, vmax=None, bins=50, invert_axis=True, figsize=None, dpi=100,
+                 decimate='auto', reduce='mean', raster_threshold=RASTER_THRESHOLD, **kwargs):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.kind = kind
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        if kind == 'imshow':
+            self.artist = self.ax.imshow(first, cmap=kwargs.pop('cmap', 'viridis'), vmin=vmin, vmax=vmax, **kwargs)
+        elif kind == 'heatmap':
+            import seaborn as sns
+
+            self.decimate = None if decimate is None else _decimate_shape(self.ax, decimate)
+            self.reduce = reduce
+            full_shape = first.shape
+            first = self._decimated(first)
+            self.raster = first.shape[0] * first.shape[1] > raster_threshold and not set(kwargs) - _RASTER_KWARGS
+            if self.raster:
+                self.artist = _raster_heatmap(self.fig, self.ax, first, (0, full_shape[1], full_shape[0], 0),
+                                              vmin=vmin, vmax=vmax, **kwargs)
+            else:
+                sns.heatmap(np.ma.masked_invalid(np.asarray(first, dtype=float)), ax=self.ax, vmin=vmin, vmax=vmax,
+                            **kwargs)
+                self.artist = self.ax.collections[0]
+            if invert_axis:
+                self.ax.invert_yaxis()
+        elif kind == 'hist':
+            self.bins = bins
+            _, _, self.artist = self.ax.hist(first.ravel(), bins=bins, **kwargs)
+        else:
+            raise ValueError(f"Unknown plot kind {kind!r}, expected 'imshow', 'heatmap' or 'hist'.")
+        self.title = self.ax.set_title(' ')
+        self.fig.tight_layout()
+
+    def _decimated(self, frame):
+        return frame if self.decimate is None else _decimate(frame, self.decimate, self.reduce)
+
+    def update(self, frame, title=None):
+        if self.kind == 'imshow':
+            self.artist.set_data(frame)
+        elif self.kind == 'heatmap':
+            values = np.ma.masked_invalid(np.asarray(self._decimated(frame), dtype=float))
+            if self.raster:
+                self.artist.set_data(values)
+            else:
+                self.artist.set_array(values)
+        else:
+            counts, _ = np.histogram(frame[np.isfinite(frame)], bins=self.bins)
+            for patch, count in zip(self.artist, counts):
+                patch.set_height(count)
+            self.ax.set_ylim(0, max(1, counts.max()) * 1.05)
+        self.title.set_text(title or '')
+
+    def save(self, frames, paths, titles):
+        for frame, path, title in zip(frames, paths, titles):
+            self.update(frame, title)
+            self.fig.savefig(path)
+        return len(paths)
+
+
+def _render_frames(kind, frames, paths, titles, options):
+    """Worker: render a block of frames with a single figure."""
+    return _FrameRenderer(kind, frames[0], **options).save(frames, paths, titles)
+
+
+def _as_frames(data, time_dim=None):
+    """Frames and default titles from a 3d array or an xarray DataArray."""
+    if hasattr(data, 'dims') and hasattr(data, 'coords'):
+        if time_dim is None:
+            time_dim = next((d for d in TIME_DIMS if d in data.dims), data.dims[0])
+        data = data.transpose(time_dim, ...)
+        if time_dim in data.coords:
+            values = data[time_dim].values
+            labels = np.datetime_as_string(values, unit='m') if values.dtype.kind == 'M' else values.astype(str)
+            titles = [f'{time_dim} = {label}' for label in labels]
+        else:
+            titles = [f'{time_dim} = {i}' for i in range(data.sizes[time_dim])]
+        return np.asarray(data.values), titles
+    frames = np.asarray(data)
+    return frames, [str(i) for i in range(len(frames))]
+
+
+@tracing.traced('plot_frames', 'plot')
+def plot_frames(data, path='frame_{:04d}.png', kind='imshow', animation=None, fps=10, processes=None,
+                vmin=None, vmax=None, bins=50, titles=None, time_dim=None, **kwargs):
+    """Render every time step of a 3d array or xarray time series, e.g. for QA of a model run.
+
+    Instead of building and tearing down a figure per frame, each worker process draws one figure
+    and then only updates its artist data (image, heatmap mesh or histogram bar heights) before
+    saving. Frames are split in contiguous blocks across a process pool. Colour limits and histogram
+    bins are shared by all frames, so frames are comparable.
+
+    Args:
+        data (3d array or xarray.DataArray): frames along the first axis, or along `time_dim`.
+        path (str, optional): format string for the frame file names, given the frame number, or None
+            to only write the animation. Defaults to 'frame_{:04d}.png'.
+        kind (str, optional): 'imshow' (as plt_plot_and_save), 'heatmap' (as sns_plot_and_save) or
+            'hist' (as hist_plot_and_save). Defaults to 'imshow'.
+        animation (str, optional): also write an animation to this file, a GIF for the '.gif'
+            extension and otherwise an MP4 (requires ffmpeg). Defaults to None.
+        fps (int, optional): frames per second of the animation. Defaults to 10.
+        processes (int, optional): number of worker processes, 1 to render in this process.
+            Defaults to os.cpu_count().
+        vmin, vmax (float, optional): colour limits (range of the bins for 'hist'). Defaults to the
+            range of the whole series.
+        bins (int, optional): number of histogram bins for 'hist'. Defaults to 50.
+        titles (list, optional): one title per frame. Defaults to the time coordinate, or frame number.
+        time_dim (str, optional): time dimension of a DataArray. Defaults to the first of TIME_DIMS
+            present, else the first dimension.
+        **kwargs: passed to the plotting function, e.g. `cmap`, and `invert_axis`, `figsize` and `dpi`;
+            for 'heatmap' also `decimate`, `reduce` and `raster_threshold`, as in sns_plot_and_save.
+    Returns:
+        list: paths of the frames written.
+    """
+    frames, default_titles = _as_frames(data, time_dim)
+    if frames.ndim != 3:
+        raise ValueError(f"Expected a 3d array of frames, got shape {frames.shape}.")
+    titles = default_titles if titles is None else list(titles)
+    if vmin is None:
+        vmin = float(np.nanmin(frames))
+    if vmax is None:
+        vmax = float(np.nanmax(frames))
+    if kind == 'hist':
+        bins = np.histogram_bin_edges([], bins=bins, range=(vmin, vmax))
+    options = {'vmin': vmin, 'vmax': vmax, 'bins': bins, **kwargs}
+
+    paths = [str(path).format(i) for i in range(len(frames))] if path else []
+    processes = min(processes or os.cpu_count() or 1, len(paths))
+    if processes == 1:
+        _render_frames(kind, frames, paths, titles, options)
+    elif processes > 1:
+        bounds = np.linspace(0, len(paths), processes + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_render_frames, kind, frames[a:b], paths[a:b], titles[a:b], options)
+                       for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+            for future in futures:
+                future.result()
+
+    if animation is not None:
+        from matplotlib import animation as mpl_animation
+        renderer = _FrameRenderer(kind, frames[0], **options)
+        if Path(animation).suffix.lower() == '.gif':
+            writer = mpl_animation.PillowWriter(fps=fps)
+        else:
+            writer = mpl_animation.FFMpegWriter(fps=fps)
+        with writer.saving(renderer.fig, str(animation), dpi=renderer.fig.dpi):
+            for frame, title in zip(frames, titles):
+                renderer.update(frame, title)
+                writer.grab_frame()
+    if tracing.enabled():
+        tracing.add_bytes(written=sum(map(tracing.file_size, paths)) + tracing.file_size(animation))
+    return paths
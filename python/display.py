@@ -1,12 +1,151 @@
-import pandas as pd
+# pandas is only imported when needed, as it takes long to import.
 
-def add_caption_to_df(df, caption, color='black', fontsize=100):
-    """Mainly to be used for display in Jupyter notebooks."""
-    styles = [dict(selector="caption",
-                       props=[("text-align", "center"),
-                              ("font-size", "100%"),
-                              ("color", color)])]
+# Rows shown per page by PagedDataFrame, and by add_caption_to_df when given max_rows
+PAGE_SIZE = 50
+
+
+def _caption_styles(color='black', fontsize=100):
+    return [dict(selector="caption",
+                 props=[("text-align", "center"),
+                        ("font-size", f"{fontsize}%"),
+                        ("color", color)])]
+
+
+def add_caption_to_df(df, caption, color='black', fontsize=100, max_rows=None, page=0):
+    """Mainly to be used for display in Jupyter notebooks.
+
+    With `max_rows`, a DataFrame longer than that is not styled whole: only page `page` of
+    `max_rows` rows, plus the first and last rows, is rendered (see PagedDataFrame).
+    """
+    if max_rows is not None and len(df) > max_rows:
+        return PagedDataFrame(df, caption, color=color, fontsize=fontsize, page_size=max_rows).page(page)
+
+    styles = _caption_styles(color, fontsize)
 
     df = df.style.set_caption(caption).set_table_styles(styles)
 
-    return df
\ No newline at end of file
+    return df
+
+
+class PagedDataFrame:
+    """Notebook display of a large DataFrame, one page at a time.
+
+    Only the rows of the current page and the first `head` and last `tail` rows are styled and
+    rendered to HTML, and the styling is built once and reused for every page, so display cost does
+    not depend on the length of the table. Below the page, a summary (count, mean, min, max) of the
+    numeric columns over the rows not shown is given. The column counts and sums, and the min and max
+    of every block of `page_size` rows, are computed once; each page then only subtracts the rows
+    it shows and combines the block extremes, so changing page costs O(page_size + blocks).
+
+    Args:
+        df (pandas.DataFrame): the table.
+        caption (str, optional): caption, to which the rows shown are added. Defaults to None.
+        color (str, optional): caption colour. Defaults to 'black'.
+        fontsize (int, optional): caption font size in percent. Defaults to 100.
+        page_size (int, optional): rows per page. Defaults to PAGE_SIZE.
+        head, tail (int, optional): number of first and last rows always shown. Defaults to 5.
+    """
+
+    def __init__(self, df, caption=None, color='black', fontsize=100, page_size=PAGE_SIZE, head=5, tail=5):
+        self.df = df
+        self.caption = caption
+        self.page_size = page_size
+        self.head = head
+        self.tail = tail
+        self.current = 0
+        # Styling applied to every page, exported once from an empty Styler
+        self._template = df.iloc[:0].style.set_table_styles(_caption_styles(color, fontsize)).export()
+        self._summaries = {}
+        self._aggregates = None
+
+    @property
+    def n_pages(self):
+        return max(1, -(-len(self.df) // self.page_size))
+
+    def _ranges(self, n):
+        """Row ranges [start, stop) shown on page `n`, and those hidden."""
+        n_rows = len(self.df)
+        start = min(n * self.page_size, n_rows)
+        bounds = sorted([(0, min(self.head, n_rows)), (start, min(start + self.page_size, n_rows)),
+                         (max(n_rows - self.tail, 0), n_rows)])
+        shown = []
+        for a, b in bounds:
+            if shown and a <= shown[-1][1]:
+                shown[-1] = (shown[-1][0], max(shown[-1][1], b))
+            elif b > a:
+                shown.append((a, b))
+        hidden = [(a, b) for a, b in zip([0] + [b for _, b in shown], [a for a, _ in shown] + [n_rows]) if b > a]
+        return shown, hidden
+
+    def window(self, n=None):
+        """The rows shown on page `n`, as a DataFrame."""
+        import pandas as pd
+
+        shown, _ = self._ranges(self.current if n is None else n)
+        return pd.concat([self.df.iloc[a:b] for a, b in shown])
+
+    def _aggregate(self):
+        """Numeric columns, their count and sum over all rows, and their min and max per block of rows."""
+        if self._aggregates is None:
+            import numpy as np
+
+            numeric = self.df.select_dtypes('number')
+            blocks = numeric.groupby(np.arange(len(numeric)) // self.page_size)
+            self._aggregates = numeric, numeric.agg(['count', 'sum']), blocks.min(), blocks.max()
+        return self._aggregates
+
+    def _extremes(self, a, b):
+        """Min and max of the numeric columns over rows [a, b), from the whole blocks within it and the rows at its ends."""
+        numeric, _, block_min, block_max = self._aggregate()
+        first, last = -(-a // self.page_size), b // self.page_size
+        if first >= last:
+            ends = [numeric.iloc[a:b]]
+            mins, maxs = [], []
+        else:
+            ends = [numeric.iloc[a:first * self.page_size], numeric.iloc[last * self.page_size:b]]
+            mins, maxs = [block_min.iloc[first:last].min()], [block_max.iloc[first:last].max()]
+        ends = [rows for rows in ends if len(rows)]
+        return mins + [rows.min() for rows in ends], maxs + [rows.max() for rows in ends]
+
+    def summary(self, n=None):
+        """Count, mean, min and max of the numeric columns over the rows hidden on page `n`."""
+        shown, hidden = self._ranges(self.current if n is None else n)
+        key = tuple(hidden)
+        if key not in self._summaries:
+            import pandas as pd
+
+            numeric, totals, _, _ = self._aggregate()
+            if hidden:
+                totals = totals - sum(numeric.iloc[a:b].agg(['count', 'sum']) for a, b in shown)
+                count = totals.loc['count']
+                extremes = [self._extremes(a, b) for a, b in hidden]
+                summary = pd.DataFrame({
+                    'count': count,
+                    'mean': totals.loc['sum'] / count.where(count > 0),
+                    'min': pd.concat([m for mins, _ in extremes for m in mins], axis=1).min(axis=1),
+                    'max': pd.concat([m for _, maxs in extremes for m in maxs], axis=1).max(axis=1),
+                }).T
+            else:
+                summary = pd.DataFrame(index=['count', 'mean', 'min', 'max'], columns=numeric.columns)
+            self._summaries[key] = summary
+        return self._summaries[key]
+
+    def page(self, n):
+        """Styler of page `n`, with the rows shown in the caption."""
+        if not 0 <= n < self.n_pages:
+            raise IndexError(f"Page {n} out of range, the table has {self.n_pages} pages.")
+        self.current = n
+        shown, _ = self._ranges(n)
+        rows = ', '.join(f'{a + 1}-{b}' for a, b in shown)
+        caption = f"rows {rows} of {len(self.df)}"
+        if self.caption:
+            caption = f"{self.caption} ({caption})"
+        return self.window(n).style.use(self._template).set_caption(caption)
+
+    def _repr_html_(self):
+        html = self.page(self.current).to_html()
+        _, hidden = self._ranges(self.current)
+        if hidden:
+            n_hidden = sum(b - a for a, b in hidden)
+            html += self.summary().style.set_caption(f"{n_hidden} rows not shown").to_html()
+        return html
@@ -0,0 +1,237 @@
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+# Number of bins when the bin width is determined from the first chunk of data
+AUTO_BINS = 50
+# Guard against a single outlier (e.g. an unmasked fill value) growing the histogram without bound
+MAX_BINS = 10**6
+
+
+def _nice_width(span, bins=AUTO_BINS):
+    """A bin width of 1, 2 or 5 times a power of ten giving about `bins` bins over `span`."""
+    if not span > 0:
+        return 1.
+    raw = span / bins
+    power = 10 ** math.floor(math.log10(raw))
+    return next(m * power for m in (1, 2, 5, 10) if m * power >= raw)
+
+
+def _finite_values(data):
+    values = np.asarray(getattr(data, 'values', data)).ravel()
+    return values[np.isfinite(values)]
+
+
+class StreamingHistogram:
+    """Histogram accumulated one chunk at a time, for data that does not fit in memory.
+
+    Bins are either fixed `edges`, with values outside them counted in `underflow`/`overflow`, or
+    uniform bins of `width` anchored at `anchor` (edges at anchor + k * width), which grow to cover
+    whatever data is added. Because anchored bins do not depend on the data seen so far, partial
+    histograms from parallel workers, or from previous runs, can be merged exactly.
+
+    Args:
+        edges (array, optional): fixed, increasing bin edges. Defaults to None.
+        width (float, optional): width of anchored bins. Defaults to None, in which case a round
+            width giving about AUTO_BINS bins over the first chunk is used.
+        anchor (float, optional): a bin edge of the anchored bins. Defaults to 0.
+    """
+
+    def __init__(self, edges=None, width=None, anchor=0.):
+        if edges is not None and width is not None:
+            raise ValueError("Give either edges or width, not both.")
+        self.fixed_edges = None if edges is None else np.asarray(edges, dtype=float)
+        self.width = width
+        self.anchor = anchor
+        self.start = 0
+        self.counts = np.zeros(0 if edges is None else len(self.fixed_edges) - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.sources = set()
+
+    @property
+    def edges(self):
+        if self.fixed_edges is not None:
+            return self.fixed_edges
+        if self.width is None:
+            return np.zeros(0)
+        return self.anchor + self.width * np.arange(self.start, self.start + len(self.counts) + 1)
+
+    @property
+    def centers(self):
+        edges = self.edges
+        return (edges[:-1] + edges[1:]) / 2
+
+    @property
+    def total(self):
+        """Number of values added, including those outside fixed edges."""
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def _grow(self, first, last):
+        """Extend the anchored bins to cover bin indices [first, last]."""
+        if len(self.counts) == 0:
+            start, stop = first, last + 1
+        else:
+            start, stop = min(self.start, first), max(self.start + len(self.counts), last + 1)
+        if stop - start > MAX_BINS:
+            raise ValueError(f"Adding values in bins {first:.0f}..{last:.0f} would need {stop - start:.0f} bins of "
+                             f"width {self.width}, more than MAX_BINS; check for fill values or use fixed edges.")
+        start, stop = int(start), int(stop)
+        if len(self.counts) == 0:
+            self.counts = np.zeros(stop - start, dtype=np.int64)
+        elif (start, stop) != (self.start, self.start + len(self.counts)):
+            self.counts = np.pad(self.counts, (self.start - start, stop - self.start - len(self.counts)))
+        self.start = start
+
+    def add(self, data, source=None):
+        """Add a chunk of data; NaNs and infinities are ignored.
+
+        Args:
+            data (array-like or xarray.DataArray): values to add, of any shape.
+            source (str, optional): name of the file or chunk the data comes from. A source that was
+                already added is skipped. Defaults to None.
+        Returns:
+            bool: False if `source` was skipped, else True.
+        """
+        if source is not None and source in self.sources:
+            return False
+        values = _finite_values(data)
+        if values.size:
+            self._count(values)
+        # Only once its counts are in, so that a source that failed can be added again
+        if source is not None:
+            self.sources.add(source)
+        return True
+
+    def _count(self, values):
+        """Add finite values to the bins, leaving the histogram unchanged if they do not fit."""
+        if self.fixed_edges is not None:
+            counts, _ = np.histogram(values, bins=self.fixed_edges)
+            self.counts += counts
+            self.underflow += int(np.count_nonzero(values < self.fixed_edges[0]))
+            self.overflow += int(np.count_nonzero(values > self.fixed_edges[-1]))
+            return
+
+        width = self.width
+        if width is None:
+            width = _nice_width(float(values.max() - values.min()))
+        index = np.floor((values - self.anchor) / width)
+        # Check the range before casting, as values far outside it would overflow int64
+        self.width = width
+        try:
+            self._grow(float(index.min()), float(index.max()))
+        except ValueError:
+            if len(self.counts) == 0:
+                self.width = None
+            raise
+        index = index.astype(np.int64)
+        self.counts += np.bincount(index - self.start, minlength=len(self.counts))
+
+    def add_file(self, path, variable):
+        """Add `variable` from a NetCDF file, unless that file was already added."""
+        import xarray as xr
+
+        name = Path(path).name
+        if name in self.sources:
+            return False
+        with xr.open_dataset(path) as ds:
+            return self.add(ds[variable], source=name)
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same bins to this one, in place."""
+        if self.fixed_edges is not None or other.fixed_edges is not None:
+            if self.fixed_edges is None or other.fixed_edges is None or not np.array_equal(self.fixed_edges, other.fixed_edges):
+                raise ValueError("Cannot merge histograms with different bin edges.")
+            self.counts += other.counts
+        elif len(other.counts):
+            if self.width is None:
+                self.width, self.anchor = other.width, other.anchor
+            if (self.width, self.anchor) != (other.width, other.anchor):
+                raise ValueError(f"Cannot merge histograms with bins of width {self.width} anchored at {self.anchor} "
+                                 f"and width {other.width} anchored at {other.anchor}.")
+            self._grow(other.start, other.start + len(other.counts) - 1)
+            offset = other.start - self.start
+            self.counts[offset:offset + len(other.counts)] += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.sources |= other.sources
+        return self
+
+    def save(self, path):
+        """Save to a .npz file, written atomically so an interrupted run leaves the previous counts."""
+        path = Path(path)
+        meta = {'width': self.width, 'anchor': self.anchor, 'start': self.start,
+                'underflow': self.underflow, 'overflow': self.overflow, 'sources': sorted(self.sources)}
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.part')
+        with open(tmp, 'wb') as f:
+            np.savez(f, counts=self.counts, meta=json.dumps(meta),
+                     **({} if self.fixed_edges is None else {'edges': self.fixed_edges}))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            meta = json.loads(str(saved['meta']))
+            if 'edges' in saved:
+                hist = cls(edges=saved['edges'])
+            else:
+                hist = cls(width=meta['width'], anchor=meta['anchor'])
+            hist.counts = saved['counts'].astype(np.int64)
+        hist.start = meta['start']
+        hist.underflow, hist.overflow = meta['underflow'], meta['overflow']
+        hist.sources = set(meta['sources'])
+        return hist
+
+    def plot(self, path='fig.png', **kwargs):
+        """Plot with hist_plot_and_save, weighting each bin center by its count."""
+        from utils.python.debug import hist_plot_and_save
+        hist_plot_and_save(self.centers, path=path, bins=self.edges, weights=self.counts, **kwargs)
+
+
+def _histogram_of_files(files, variable, edges, width, anchor):
+    """Worker: histogram of `variable` over a group of files."""
+    hist = StreamingHistogram(edges=edges, width=width, anchor=anchor)
+    for path in files:
+        hist.add_file(path, variable)
+    return hist
+
+
+def histogram_files(files, variable, histogram=None, edges=None, width=None, anchor=0., processes=None):
+    """Histogram of a variable over many NetCDF files, one file at a time in a pool of worker processes.
+
+    Args:
+        files (list): NetCDF files, e.g. the daily ERA5 files of several years.
+        variable (str): name of the variable in the files.
+        histogram (StreamingHistogram, optional): histogram to add to, e.g. loaded from a previous run;
+            files it has already seen are skipped. Defaults to None, a new histogram.
+        edges, width, anchor: bins of a new histogram, see StreamingHistogram. Without either, the
+            width is determined from the first file.
+        processes (int, optional): number of worker processes. Defaults to os.cpu_count().
+    Returns:
+        StreamingHistogram: `histogram`, or a new histogram, with the files added.
+    """
+    if histogram is None:
+        histogram = StreamingHistogram(edges=edges, width=width, anchor=anchor)
+    files = [f for f in files if Path(f).name not in histogram.sources]
+    if not files:
+        return histogram
+    if histogram.fixed_edges is None and histogram.width is None:
+        # Every worker must use the same bins for their histograms to merge
+        histogram.add_file(files.pop(0), variable)
+
+    processes = min(processes or os.cpu_count() or 1, len(files))
+    if processes <= 1:
+        for path in files:
+            histogram.add_file(path, variable)
+        return histogram
+    groups = [files[i::processes] for i in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_histogram_of_files, group, variable, histogram.fixed_edges,
+                                   histogram.width, histogram.anchor) for group in groups]
+        for future in futures:
+            histogram.merge(future.result())
+    return histogram
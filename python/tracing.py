@@ -0,0 +1,294 @@
+"""Lightweight tracing of where the time goes in long-running jobs.
+
+Entry points across the package (CDS requests, regridding, `standardise_coords`, figure
+rendering, ...) are wrapped in named spans. Spans record their duration, the bytes read and
+written, and the peak memory of the process, and are written as a Chrome trace (open it at
+chrome://tracing or https://ui.perfetto.dev) together with a summary table per span name.
+
+Tracing is off by default, and then a span is a shared no-op object: the only cost is one
+global lookup per call. Enable it for a block of code with
+
+    with trace('trace.json') as tracer:
+        ...
+    print(tracer.format_summary())
+
+or for a whole run by setting the environment variable UTILS_TRACE to the trace file path (and
+UTILS_TRACE_MEMORY=1 to also trace Python allocations with tracemalloc, which is slower).
+Only the current process is traced; spans in pool worker processes are not recorded.
+"""
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The active tracer, None when tracing is disabled
+_tracer = None
+
+
+def _max_rss():
+    """Peak resident set size of the process in bytes, or None where unavailable."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _NullSpan:
+    """Returned by `span` when tracing is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, read=0, written=0):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """A timed section of code, created by `span` and recorded by its Tracer on exit."""
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start', 'bytes_read', 'bytes_written',
+                 'peak_memory', '_running_peak')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_memory = None
+        self._running_peak = 0
+
+    def add_bytes(self, read=0, written=0):
+        """Count bytes read and written within this span."""
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def set(self, **args):
+        """Add arguments shown with the span in the trace, e.g. a file name or a cache hit."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer._pop(self, end, failed=exc[0] is not None)
+        return False
+
+
+class Tracer:
+    """Collects finished spans, from any thread of the process.
+
+    Args:
+        memory (bool, optional): trace Python allocations with tracemalloc, giving the peak memory
+            of each span. Defaults to False, in which case only the peak resident set size of the
+            process at the end of each span is recorded.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.events = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current(self):
+        """The innermost open span of the calling thread, or None."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def span(self, name, category='utils', args=None):
+        return Span(self, name, category, dict(args or {}))
+
+    def _push(self, span):
+        stack = self._stack()
+        if self.memory:
+            import tracemalloc
+            # The peak is reset for the new span; keep the peak the parent reached so far
+            _, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]._running_peak = max(stack[-1]._running_peak, peak)
+            tracemalloc.reset_peak()
+        stack.append(span)
+
+    def _pop(self, span, end, failed=False):
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+        if self.memory:
+            import tracemalloc
+            # Not reset, so the parent's peak includes this span's
+            span.peak_memory = max(span._running_peak, tracemalloc.get_traced_memory()[1])
+        args = dict(span.args)
+        if failed:
+            args['failed'] = True
+        event = {'name': span.name, 'cat': span.category, 'ph': 'X',
+                 'ts': (span.start - self.origin) * 1e6, 'dur': (end - span.start) * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'args': {**args, 'bytes_read': span.bytes_read, 'bytes_written': span.bytes_written,
+                          'peak_memory': span.peak_memory, 'max_rss': _max_rss()}}
+        with self._lock:
+            self.events.append(event)
+
+    def chrome_trace(self) -> dict:
+        """The spans in the Chrome trace event format."""
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """Write the Chrome trace JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self) -> list:
+        """Count, total and maximum duration (s), bytes and peak memory per span name, slowest first."""
+        rows = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            row = rows.setdefault(event['name'], {'name': event['name'], 'count': 0, 'total_s': 0., 'max_s': 0.,
+                                                  'bytes_read': 0, 'bytes_written': 0, 'peak_memory': None})
+            seconds = event['dur'] / 1e6
+            row['count'] += 1
+            row['total_s'] += seconds
+            row['max_s'] = max(row['max_s'], seconds)
+            row['bytes_read'] += event['args']['bytes_read']
+            row['bytes_written'] += event['args']['bytes_written']
+            peak = event['args']['peak_memory']
+            if peak is not None:
+                row['peak_memory'] = max(row['peak_memory'] or 0, peak)
+        return sorted(rows.values(), key=lambda row: row['total_s'], reverse=True)
+
+    def format_summary(self) -> str:
+        """The summary as a text table."""
+        def mb(n):
+            return '' if n is None else f'{n / 1e6:.1f}'
+        header = f"{'span':<40} {'count':>7} {'total s':>10} {'max s':>9} {'read MB':>9} {'written MB':>11} {'peak MB':>9}"
+        lines = [header, '-' * len(header)]
+        for row in self.summary():
+            lines.append(f"{row['name']:<40} {row['count']:>7} {row['total_s']:>10.3f} {row['max_s']:>9.3f} "
+                         f"{mb(row['bytes_read']):>9} {mb(row['bytes_written']):>11} {mb(row['peak_memory']):>9}")
+        return '\n'.join(lines)
+
+
+def enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name, category='utils', **args):
+    """Context manager timing a section of code, a no-op when tracing is disabled.
+
+    Args:
+        name (str): span name, e.g. 'regrid.weights'; the summary aggregates spans by name.
+        category (str, optional): Chrome trace category. Defaults to 'utils'.
+        **args: shown with the span in the trace.
+    Returns:
+        Span, or a no-op object with the same methods.
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, category, args)
+
+
+def add_bytes(read=0, written=0):
+    """Count bytes read and written in the innermost open span of this thread, if tracing."""
+    if _tracer is not None:
+        current = _tracer.current()
+        if current is not None:
+            current.add_bytes(read, written)
+
+
+def file_size(path):
+    """Size of a file, for `add_bytes`; 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def traced(name=None, category='utils'):
+    """Decorator wrapping every call of a function in a span named after it."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace(path=None, memory=False):
+    """Enable tracing within a block, then write the trace and log the summary.
+
+    Args:
+        path (str or Path, optional): Chrome trace file to write. Defaults to None, no file.
+        memory (bool, optional): trace allocations, see Tracer. Defaults to False.
+    Yields:
+        Tracer
+    """
+    global _tracer
+    previous = _tracer
+    tracer = _tracer = Tracer(memory=memory)
+    try:
+        yield tracer
+    finally:
+        _tracer = previous
+        if memory and previous is None:
+            import tracemalloc
+            tracemalloc.stop()
+        if path is not None:
+            tracer.write(path)
+        logger.info(f"Trace summary:\n{tracer.format_summary()}")
+
+
+def _trace_from_environment():
+    """Enable tracing for the whole run if UTILS_TRACE is set, writing the trace at exit."""
+    global _tracer
+    path = os.environ.get('UTILS_TRACE')
+    if not path or _tracer is not None:
+        return
+    tracer = _tracer = Tracer(memory=os.environ.get('UTILS_TRACE_MEMORY', '') not in ('', '0'))
+
+    def finish():
+        tracer.write(path)
+        logger.info(f"Wrote trace to {path}. Summary:\n{tracer.format_summary()}")
+    atexit.register(finish)
+
+
+_trace_from_environment()
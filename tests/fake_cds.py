@@ -0,0 +1,109 @@
+"""Fake stand-in for cdsapi.Client, used to exercise the download machinery without the CDS."""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from utils.atmos.download_planner import request_dates
+
+
+class FakeRateLimitError(Exception):
+    """Mimics the error raised by cdsapi when a user has too many requests queued."""
+    def __init__(self, message="429 Client Error: Too Many Requests"):
+        super().__init__(message)
+
+
+class FakeCDSClient:
+    """Behaves like cdsapi.Client.retrieve, with configurable latency and failures.
+
+    Args:
+        latency (float or callable, optional): seconds each request takes, or a function
+            of (name, request) returning the latency. Defaults to 0.
+        rate_limit (int, optional): number of concurrent requests above which a
+            FakeRateLimitError is raised. Defaults to None (no limit).
+        failures (dict, optional): maps request 'date' to the number of times that
+            request fails before succeeding. Defaults to None.
+        payload (bytes or callable, optional): content written to the target file, or a
+            function of (name, request, target) that writes it, e.g. `write_era5_netcdf`.
+        transfer_latency (float, optional): seconds each download of a result takes. Defaults to 0.
+    """
+
+    def __init__(self, latency=0., rate_limit=None, failures=None, payload=b'CDF\x01', transfer_latency=0.):
+        self.latency = latency
+        self.transfer_latency = transfer_latency
+        self.rate_limit = rate_limit
+        self.failures = dict(failures or {})
+        self.payload = payload
+        self.calls = []
+        self.active = 0
+        self.peak_active = 0
+        self._lock = threading.Lock()
+
+    def _latency(self, name, request):
+        if callable(self.latency):
+            return self.latency(name, request)
+        return self.latency
+
+    def retrieve(self, name, request, target=None):
+        """Wait `latency` seconds, then return a FakeResult (downloaded to `target` if given)."""
+        with self._lock:
+            self.calls.append((name, request.get('date')))
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            over_limit = self.rate_limit is not None and self.active > self.rate_limit
+            fail = self.failures.get(request.get('date'), 0) > 0
+            if fail:
+                self.failures[request.get('date')] -= 1
+        try:
+            if over_limit:
+                raise FakeRateLimitError()
+            time.sleep(self._latency(name, request))
+            if fail:
+                raise RuntimeError("Connection reset by peer")
+        finally:
+            with self._lock:
+                self.active -= 1
+        result = FakeResult(self, name, request)
+        if target is not None:
+            result.download(target)
+        return result
+
+
+class FakeResult:
+    """Mimics cdsapi's Result: a completed request that can be downloaded."""
+    def __init__(self, client, name, request):
+        self.client = client
+        self.name = name
+        self.request = request
+
+    def download(self, target=None):
+        time.sleep(self.client.transfer_latency)
+        if callable(self.client.payload):
+            self.client.payload(self.name, self.request, target)
+        else:
+            with open(target, 'wb') as f:
+                f.write(self.client.payload)
+        return target
+
+
+def write_era5_netcdf(name, request, target, shape=(3, 4)):
+    """Write a small ERA5-like NetCDF file matching a CDS request (variables, levels, days, hours)."""
+    times = pd.DatetimeIndex([pd.Timestamp(day) + pd.Timedelta(hours=int(t[:2]))
+                              for day in request_dates(request) for t in request['time']])
+    north, west, south, east = request['area']
+    coords = {
+        'valid_time': times,
+        'latitude': np.linspace(north, south, shape[0]),
+        'longitude': np.linspace(west, east, shape[1]),
+    }
+    dims = ['valid_time', 'latitude', 'longitude']
+    if 'pressure_level' in request:
+        coords['pressure_level'] = np.array(request['pressure_level'], dtype=float)
+        dims.insert(1, 'pressure_level')
+    sizes = [len(coords[d]) for d in dims]
+    # Values encode the time step so tests can check data ended up in the right file.
+    values = np.broadcast_to(np.arange(len(times), dtype='float32').reshape([-1] + [1] * (len(dims) - 1)), sizes)
+    ds = xr.Dataset({v: (dims, values.copy()) for v in request['variable']}, coords=coords)
+    ds.to_netcdf(target)
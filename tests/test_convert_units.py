@@ -1,4 +1,9 @@
 import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.atmos.convert_units import apply_affine, AffineConversion, BLOCK_SIZE
+from utils.atmos.convert_units import UnitRegistry, registry, convert_dataset, canonical_units, STANDARD_GRAVITY
 from utils.atmos.convert_units import (
     kelvin_to_celsius,
     celsius_to_kelvin,
@@ -62,3 +67,160 @@ def test_kelvin_celsius_conversion(kelvin, celsius):
 def test_kelvin_fahrenheit_conversion(kelvin, fahrenheit):
     assert kelvin_to_fahrenheit(kelvin) == pytest.approx(fahrenheit, rel=1e-5)
     assert fahrenheit_to_kelvin(fahrenheit) == pytest.approx(kelvin, rel=1e-5)
+
+# Array, in-place and xarray behaviour of the conversion engine
+@pytest.fixture(params=[10, BLOCK_SIZE * 3 + 7])
+def temperature_k(request):
+    rng = np.random.default_rng(0)
+    return (rng.random((request.param,)) * 100 + 230).astype('float32')
+
+def test_float32_preserved(temperature_k):
+    result = kelvin_to_fahrenheit(temperature_k)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, (temperature_k.astype('float64') - 273.15) * 9 / 5 + 32, atol=1e-3)
+
+def test_integer_input_promoted_to_float():
+    result = celsius_to_kelvin(np.array([0, 100]))
+    assert result.dtype == np.float64
+    np.testing.assert_allclose(result, [273.15, 373.15])
+
+def test_out_in_place(temperature_k):
+    expected = kelvin_to_celsius(temperature_k.copy())
+    result = kelvin_to_celsius(temperature_k, out=temperature_k)
+    assert result is temperature_k
+    np.testing.assert_array_equal(temperature_k, expected)
+
+def test_out_wrong_shape(temperature_k):
+    with pytest.raises(ValueError):
+        kelvin_to_celsius(temperature_k, out=np.empty(3, dtype='float32'))
+
+def test_non_contiguous_input():
+    data = np.arange(20, dtype='float32').reshape(4, 5)[:, ::2]
+    np.testing.assert_allclose(celsius_to_fahrenheit(data), data * 1.8 + 32, rtol=1e-6)
+
+def test_numpy_scalar():
+    assert kelvin_to_celsius(np.float32(273.15)) == pytest.approx(0, abs=1e-4)
+
+def test_composition_and_inverse():
+    k_to_f = AffineConversion(1., -273.15).then(AffineConversion(9 / 5, 32.))
+    assert k_to_f(373.15) == pytest.approx(212)
+    assert k_to_f.inverse()(212) == pytest.approx(373.15)
+
+def test_pandas_input_keeps_type_and_labels():
+    series = pd.Series([273.15, 283.15], index=['a', 'b'], name='t2m', dtype='float32')
+    result = kelvin_to_celsius(series)
+    assert isinstance(result, pd.Series)
+    assert result.dtype == np.float32 and result.name == 't2m'
+    pd.testing.assert_index_equal(result.index, series.index)
+    np.testing.assert_allclose(result.values, [0., 10.], atol=1e-4)
+
+    frame = pd.DataFrame({'t2m': [273.15], 'd2m': [263.15]})
+    pd.testing.assert_frame_equal(kelvin_to_celsius(frame), frame - 273.15)
+
+def test_dataarray_units(temperature_k):
+    da = xr.DataArray(temperature_k, dims=['x'], attrs={'units': 'K', 'long_name': '2 metre temperature'})
+    result = kelvin_to_celsius(da)
+    assert result.attrs == {'units': 'degC', 'long_name': '2 metre temperature'}
+    assert da.attrs['units'] == 'K'
+    assert result.dtype == np.float32
+
+def test_dask_stays_lazy(temperature_k):
+    pytest.importorskip("dask")
+    da = xr.DataArray(temperature_k, dims=['x'], attrs={'units': 'K'}).chunk({'x': 1000})
+    result = kelvin_to_celsius(da)
+    assert result.chunks is not None
+    assert result.dtype == np.float32
+    assert result.attrs['units'] == 'degC'
+    np.testing.assert_allclose(result.values, temperature_k - np.float32(273.15))
+    with pytest.raises(ValueError):
+        apply_affine(da, 1., 0., out=np.empty_like(temperature_k))
+
+# Unit registry and whole-dataset conversion
+@pytest.mark.parametrize("value, from_units, to_units, expected", [
+    (101325., 'Pa', 'hPa', 1013.25),
+    (101325., 'Pa', 'kPa', 101.325),
+    (0.25, 'm', 'mm', 250.),
+    (10., 'm/s', 'knots', 19.438445),
+    (10., 'm s**-1', 'km h**-1', 36.),
+    (STANDARD_GRAVITY * 5500, 'm**2 s**-2', 'gpm', 5500.),
+    (STANDARD_GRAVITY * 5500, 'm**2 s**-2', 'dam', 550.),
+    (273.15, 'K', 'degF', 32.),
+    (212., 'degF', 'K', 373.15),
+    (0.5, '(0 - 1)', '%', 50.),
+])
+def test_registry_conversions(value, from_units, to_units, expected):
+    assert registry.convert(value, from_units, to_units) == pytest.approx(expected)
+
+def test_registry_collapses_chains():
+    conversion = registry.conversion('kPa', 'Pa')
+    assert conversion.scale == pytest.approx(1000.) and conversion.offset == 0.
+    assert conversion.units == 'Pa'
+    assert registry.conversion('kPa', 'Pa') is conversion
+
+def test_registry_unknown_conversion():
+    with pytest.raises(KeyError):
+        registry.conversion('m**2 s**-2', 'mm')
+    with pytest.raises(KeyError):
+        UnitRegistry().conversion('K', 'degC')
+
+def test_canonical_units():
+    assert canonical_units('m/s') == 'm s**-1'
+    assert canonical_units('°C') == 'degC'
+    assert canonical_units('K') == 'K'
+    # Bare letters are left alone rather than read as temperature scales
+    assert canonical_units('C') == 'C' and canonical_units('f') == 'f'
+
+@pytest.fixture
+def era5_dataset():
+    rng = np.random.default_rng(0)
+    shape = (2, 3, 4)
+    dims = ['valid_time', 'latitude', 'longitude']
+    return xr.Dataset({
+        't2m': (dims, (rng.random(shape) * 50 + 250).astype('float32'), {'units': 'K'}),
+        'msl': (dims, rng.random(shape) * 5000 + 98000, {'units': 'Pa'}),
+        # Units as written in ERA5 NetCDF files from the CDS
+        'sd': (dims, rng.random(shape).astype('float32'), {'units': 'm of water equivalent', 'long_name': 'Snow depth'}),
+        'lsm': (dims, rng.random(shape), {'units': '(0 - 1)', 'long_name': 'Land-sea mask'}),
+        'slt': (dims, rng.integers(0, 8, shape).astype('float32'), {'units': '~', 'long_name': 'Soil type'}),
+        # No units attribute, so assumed to be in ERA5 units
+        'u10': (dims, rng.random(shape) * 20),
+    })
+
+def test_convert_dataset(era5_dataset):
+    result = convert_dataset(era5_dataset)
+    assert {name: result[name].attrs.get('units') for name in ['t2m', 'msl', 'sd', 'u10', 'lsm']} == \
+        {'t2m': 'degC', 'msl': 'hPa', 'sd': 'mm', 'u10': 'kn', 'lsm': '(0 - 1)'}
+    assert result['t2m'].dtype == np.float32
+    np.testing.assert_allclose(result['msl'], era5_dataset['msl'] / 100)
+    np.testing.assert_allclose(result['sd'], era5_dataset['sd'] * 1000, rtol=1e-6)
+    np.testing.assert_allclose(result['u10'], era5_dataset['u10'] * 3600 / 1852)
+    xr.testing.assert_identical(result['lsm'], era5_dataset['lsm'])
+    xr.testing.assert_identical(result['slt'], era5_dataset['slt'])
+    assert era5_dataset['t2m'].attrs['units'] == 'K'
+
+def test_convert_dataset_era5_unit_strings(era5_dataset):
+    result = convert_dataset(era5_dataset, {'sd': 'cm', 'lsm': '%', 'slt': 'dimensionless'})
+    np.testing.assert_allclose(result['sd'], era5_dataset['sd'] * 100, rtol=1e-6)
+    np.testing.assert_allclose(result['lsm'], era5_dataset['lsm'] * 100)
+    xr.testing.assert_identical(result['slt'], era5_dataset['slt'])
+    assert canonical_units('m of water equivalent') == 'm' and canonical_units('0 - 1') == '(0 - 1)'
+
+def test_convert_dataset_explicit_units_by_cds_name(era5_dataset):
+    result = convert_dataset(era5_dataset, {'2m_temperature': 'degF', 'msl': 'kPa'})
+    np.testing.assert_allclose(result['t2m'], (era5_dataset['t2m'] - 273.15) * 1.8 + 32, atol=1e-3)
+    np.testing.assert_allclose(result['msl'], era5_dataset['msl'] / 1000)
+    assert 'units' not in result['u10'].attrs
+
+def test_convert_dataset_inplace(era5_dataset):
+    expected = convert_dataset(era5_dataset)
+    values = era5_dataset['t2m'].values
+    result = convert_dataset(era5_dataset, inplace=True)
+    assert result is era5_dataset
+    assert era5_dataset['t2m'].values is values
+    xr.testing.assert_identical(result, expected)
+
+def test_convert_dataset_dask(era5_dataset):
+    pytest.importorskip("dask")
+    result = convert_dataset(era5_dataset.chunk({'valid_time': 1}))
+    assert result['msl'].chunks is not None
+    xr.testing.assert_allclose(result.compute(), convert_dataset(era5_dataset))
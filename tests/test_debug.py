@@ -1,8 +1,14 @@
 import pytest
 import numpy as np
 import os
+import subprocess
+import sys
 import matplotlib.pyplot as plt
-from utils.python.debug import sns_plot_and_save, hist_plot_and_save, plt_plot_and_save
+import seaborn as sns
+import xarray as xr
+from PIL import Image
+from utils.python.debug import (sns_plot_and_save, hist_plot_and_save, plt_plot_and_save,
+                                plot_frames, block_reduce)
 
 # Fixture to create temporary test data
 @pytest.fixture
@@ -40,4 +46,86 @@ def test_plt_plot_and_save(test_data, temp_file):
 def test_cleanup(temp_file):
     if os.path.exists(temp_file):
         os.remove(temp_file)
-    assert not os.path.exists(temp_file), "Temporary file was not removed"
\ No newline at end of file
+    assert not os.path.exists(temp_file), "Temporary file was not removed"
+
+# Batch rendering of time series
+@pytest.fixture
+def time_series():
+    data = np.random.rand(6, 8, 10)
+    data[0, 0, 0] = np.nan
+    return xr.DataArray(data, dims=['time', 'lat', 'lon'],
+                        coords={'time': np.arange('2020-01-01T00', '2020-01-01T06', dtype='datetime64[h]')})
+
+@pytest.mark.parametrize("kind", ['imshow', 'heatmap', 'hist'])
+def test_plot_frames(time_series, tmp_path, kind):
+    paths = plot_frames(time_series, path=str(tmp_path / 'frame_{:02d}.png'), kind=kind, processes=1)
+    assert paths == [str(tmp_path / f'frame_{i:02d}.png') for i in range(6)]
+    sizes = {Image.open(p).size for p in paths}
+    assert len(sizes) == 1
+
+def test_plot_frames_process_pool(time_series, tmp_path):
+    paths = plot_frames(time_series.values, path=str(tmp_path / 'frame_{:02d}.png'), processes=3)
+    assert all(os.path.exists(p) for p in paths) and len(paths) == 6
+
+def test_plot_frames_animation(time_series, tmp_path):
+    animation = tmp_path / 'series.gif'
+    paths = plot_frames(time_series.transpose('lat', 'time', 'lon'), path=None, animation=animation, fps=5)
+    assert paths == []
+    assert Image.open(animation).n_frames == 6
+
+def test_plot_frames_rejects_2d(test_data, tmp_path):
+    with pytest.raises(ValueError):
+        plot_frames(test_data, path=str(tmp_path / 'frame_{}.png'))
+
+# Decimation of large heatmaps
+def test_block_reduce():
+    data = np.arange(20, dtype=float).reshape(4, 5)
+    data[0, 0] = np.nan
+    data[2:, 4] = np.nan
+    mean = block_reduce(data, (2, 2))
+    assert mean.shape == (2, 3)
+    np.testing.assert_allclose(mean[0], [(1 + 5 + 6) / 3, (2 + 3 + 7 + 8) / 4, (4 + 9) / 2])
+    assert np.isnan(mean[1, 2])
+    np.testing.assert_array_equal(block_reduce(data, (2, 2), 'max')[0], [6, 8, 9])
+    np.testing.assert_array_equal(block_reduce(data, (2, 2), 'min')[1], [10, 12, np.nan])
+
+def test_block_reduce_unknown():
+    with pytest.raises(ValueError):
+        block_reduce(np.zeros((2, 2)), (2, 2), 'median')
+
+def test_large_heatmap_is_decimated_and_rastered(tmp_path, monkeypatch):
+    def no_heatmap(*args, **kwargs):
+        raise AssertionError("sns.heatmap should not be used for large grids")
+    monkeypatch.setattr(sns, 'heatmap', no_heatmap)
+    data = np.random.rand(721, 1440).astype('float32')
+    data[:10] = np.nan
+    path = tmp_path / 'era5.png'
+    sns_plot_and_save(data, path=path, cmap='viridis')
+    assert path.exists()
+
+def test_decimated_heatmap(tmp_path, monkeypatch):
+    """Options only sns.heatmap supports keep the heatmap, on the decimated data."""
+    shapes = []
+    heatmap = sns.heatmap
+    def recording_heatmap(data, **kwargs):
+        shapes.append(data.shape)
+        return heatmap(data, **kwargs)
+    monkeypatch.setattr(sns, 'heatmap', recording_heatmap)
+    sns_plot_and_save(np.random.rand(300, 90), path=tmp_path / 'fig.png', decimate=(50, 50), linewidths=0)
+    assert shapes == [(50, 45)]
+
+def test_large_heatmap_frames_are_decimated_and_rastered(tmp_path, monkeypatch):
+    def no_heatmap(*args, **kwargs):
+        raise AssertionError("sns.heatmap should not be used for large frames")
+    monkeypatch.setattr(sns, 'heatmap', no_heatmap)
+    frames = np.random.rand(3, 721, 1440).astype('float32')
+    frames[:, :10] = np.nan
+    paths = plot_frames(frames, path=str(tmp_path / 'frame_{}.png'), kind='heatmap', processes=1, cmap='viridis')
+    assert len({Image.open(p).size for p in paths}) == 1
+
+def test_plot_frames_imports_seaborn_only_for_heatmaps(tmp_path):
+    code = ("import sys\nimport numpy as np\nfrom utils.python.debug import plot_frames\n"
+            f"plot_frames(np.random.rand(2, 4, 4), path={str(tmp_path / 'frame_{}.png')!r}, processes=1)\n"
+            "assert 'seaborn' not in sys.modules\n")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
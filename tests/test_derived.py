@@ -0,0 +1,120 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.atmos.convert_units import BLOCK_SIZE, STANDARD_GRAVITY, convert_dataset
+from utils.atmos.derived import plan_derived, derive, write_derived, derive_files, derived_path
+
+@pytest.fixture
+def surface():
+    """Hourly surface fields with NetCDF short names, larger than a block."""
+    rng = np.random.default_rng(0)
+    shape = (3, 90, 800)
+    assert np.prod(shape[1:]) > BLOCK_SIZE
+    dims = ['valid_time', 'latitude', 'longitude']
+    t2m = 270 + 30 * rng.random(shape)
+    return xr.Dataset({
+        'u10': (dims, rng.normal(0, 10, shape).astype('float32'), {'units': 'm s**-1'}),
+        'v10': (dims, rng.normal(0, 10, shape).astype('float32'), {'units': 'm s**-1'}),
+        't2m': (dims, t2m.astype('float32'), {'units': 'K'}),
+        'd2m': (dims, (t2m - 10 * rng.random(shape)).astype('float32'), {'units': 'K'}),
+    }, coords={'valid_time': pd.date_range('2020-01-01', periods=3, freq='h'),
+               'latitude': np.linspace(-32, -50, 90), 'longitude': np.linspace(165, 180, 800)})
+
+@pytest.fixture
+def pressure():
+    rng = np.random.default_rng(1)
+    dims = ['valid_time', 'pressure_level', 'latitude', 'longitude']
+    return xr.Dataset({'z': (dims, rng.random((2, 3, 4, 5)) * 1e5)},
+                      coords={'pressure_level': [500., 850., 1000.]})
+
+def relative_humidity(t, td):
+    def saturation(x):
+        return 611.21 * np.exp(17.502 * (x - 273.16) / (x - 32.19))
+    return 100 * saturation(td) / saturation(t)
+
+def test_plan_groups_inputs(surface):
+    plan, = plan_derived(surface)
+    assert plan.inputs == ['u10', 'v10', 't2m', 'd2m']
+    assert plan.outputs == ['10m_wind_speed', '10m_wind_direction', '2m_relative_humidity']
+    plan, = plan_derived(surface, ['wdir10', '10m_wind_speed'])
+    assert plan.inputs == ['u10', 'v10']
+
+def test_plan_errors(surface):
+    with pytest.raises(KeyError, match='dewpoint'):
+        plan_derived(surface, ['dewpoint'])
+    with pytest.raises(ValueError, match='geopotential'):
+        plan_derived(surface, ['geopotential_height'])
+
+def test_derive_matches_expressions(surface):
+    result = derive(surface)
+    assert set(result.data_vars) == {'si10', 'wdir10', 'r2'}
+    assert all(result[v].dtype == np.float32 for v in result.data_vars)
+    u, v = surface['u10'].astype(float), surface['v10'].astype(float)
+    np.testing.assert_allclose(result['si10'], np.hypot(u, v), rtol=1e-5)
+    np.testing.assert_allclose(result['wdir10'], (270 - np.degrees(np.arctan2(v, u))) % 360, atol=1e-3)
+    np.testing.assert_allclose(result['r2'], relative_humidity(surface['t2m'].astype(float), surface['d2m'].astype(float)),
+                               rtol=1e-4)
+    assert result['r2'].attrs == {'units': '%', 'long_name': '2 metre relative humidity'}
+    assert result['si10'].dims == surface['u10'].dims
+    xr.testing.assert_identical(result['si10'].latitude, surface.latitude)
+
+def test_output_dtype_per_diagnostic(surface):
+    """float32 winds give float32 wind speed even when the temperatures in the file are float64."""
+    surface['t2m'] = surface['t2m'].astype('float64')
+    plans = plan_derived(surface)
+    assert [(p.dtype, p.outputs) for p in plans] == [
+        (np.float32, ['10m_wind_speed', '10m_wind_direction']), (np.float64, ['2m_relative_humidity'])]
+    for data in (surface, surface.chunk({'valid_time': 1})):
+        result = derive(data)
+        assert (result['si10'].dtype, result['wdir10'].dtype, result['r2'].dtype) == (np.float32, np.float32, np.float64)
+        np.testing.assert_allclose(result['si10'], np.hypot(surface['u10'].astype(float), surface['v10'].astype(float)),
+                                   rtol=1e-5)
+
+def test_wind_direction_convention():
+    ds = xr.Dataset({'u10': ('x', [0., 1., 0., -1.]), 'v10': ('x', [-1., 0., 1., 0.])})
+    # Northerly, westerly, southerly and easterly winds
+    np.testing.assert_allclose(derive(ds, ['wdir10'])['wdir10'], [0., 270., 180., 90.], atol=1e-9)
+
+def test_geopotential_height(pressure):
+    result = derive(pressure)
+    assert list(result.data_vars) == ['gh']
+    assert result['gh'].attrs['units'] == 'gpm'
+    np.testing.assert_allclose(result['gh'], pressure['z'] / STANDARD_GRAVITY)
+
+def test_unit_conversions(surface):
+    """Inputs in other units are converted back as they are read, outputs to the units asked for."""
+    converted = convert_dataset(surface, {'t2m': 'degC', 'd2m': 'degF', 'u10': 'kn', 'v10': 'kn'})
+    expected = derive(surface)
+    result = derive(converted, units={'10m_wind_speed': 'km h**-1'})
+    assert result['si10'].attrs['units'] == 'km h**-1'
+    np.testing.assert_allclose(result['si10'], expected['si10'] * 3.6, rtol=1e-4)
+    np.testing.assert_allclose(result['r2'], expected['r2'], rtol=1e-3)
+
+def test_derive_dask_single_task_per_chunk(surface):
+    pytest.importorskip("dask")
+    lazy = surface.chunk({'valid_time': 1})
+    result = derive(lazy)
+    assert result['si10'].chunks is not None
+    # All diagnostics of a chunk come from the same fused tasks
+    fused = [name for name in result['si10'].data.dask.layers if name.startswith('_fused_block')]
+    assert len(fused) == 1 and fused[0] in result['r2'].data.dask.layers
+    xr.testing.assert_allclose(result.compute(), derive(surface))
+
+def test_write_derived_alongside(surface, tmp_path):
+    pytest.importorskip("dask")
+    paths = []
+    for i in range(2):
+        path = tmp_path / f'ERA5_2020010{i + 1}_surface.nc'
+        surface.isel(valid_time=[i]).to_netcdf(path)
+        paths.append(path)
+    outputs = derive_files(paths, names=['10m_wind_speed'], processes=1)
+    assert outputs == [tmp_path / 'ERA5_20200101_surface_derived.nc', tmp_path / 'ERA5_20200102_surface_derived.nc']
+    assert derived_path(paths[0]) == outputs[0]
+    with xr.open_dataset(outputs[1]) as ds:
+        assert list(ds.data_vars) == ['si10']
+        np.testing.assert_allclose(ds['si10'], derive(surface.isel(valid_time=[1]))['si10'])
+
+    # Files without inputs give no output
+    xr.Dataset({'msl': ('x', [1.])}).to_netcdf(tmp_path / 'ERA5_20200101_other.nc')
+    assert write_derived(tmp_path / 'ERA5_20200101_other.nc') is None
@@ -1,6 +1,7 @@
 import pytest
+import numpy as np
 import pandas as pd
-from utils.python.display import add_caption_to_df
+from utils.python.display import add_caption_to_df, PagedDataFrame
 
 @pytest.fixture
 def sample_df():
@@ -47,3 +48,55 @@ def test_add_caption_invalid_df():
     """Tests that passing an invalid dataframe raises an error."""
     with pytest.raises(AttributeError):
         add_caption_to_df(None, "Invalid Test")  # Should fail because None is not a DataFrame
+
+@pytest.fixture
+def large_df():
+    n = 100_000
+    return pd.DataFrame({"station": np.arange(n) % 7, "t2m": np.arange(n, dtype=float), "name": "x"})
+
+def test_add_caption_max_rows(large_df):
+    styled_df = add_caption_to_df(large_df, "Stations", max_rows=20, page=2)
+    assert isinstance(styled_df, pd.io.formats.style.Styler)
+    assert list(styled_df.data.index) == list(range(5)) + list(range(40, 60)) + list(range(99_995, 100_000))
+    assert styled_df.caption == "Stations (rows 1-5, 41-60, 99996-100000 of 100000)"
+    assert any(style['selector'] == 'caption' for style in styled_df.table_styles)
+
+def test_add_caption_max_rows_short_df(sample_df):
+    styled_df = add_caption_to_df(sample_df, "Short", max_rows=20)
+    assert styled_df.data is sample_df
+
+def test_paged_windows_merge(large_df):
+    paged = PagedDataFrame(large_df.iloc[:12], page_size=5, head=3, tail=3)
+    assert paged.n_pages == 3
+    assert list(paged.window(0).index) == [0, 1, 2, 3, 4, 9, 10, 11]
+    assert list(paged.window(2).index) == [0, 1, 2, 9, 10, 11]
+    with pytest.raises(IndexError):
+        paged.page(3)
+
+def test_hidden_summary(large_df):
+    paged = PagedDataFrame(large_df, page_size=10)
+    summary = paged.summary(1)
+    hidden = large_df.drop(index=paged.window(1).index)
+    assert list(summary.columns) == ["station", "t2m"]
+    assert summary.loc['count', 't2m'] == len(hidden)
+    assert summary.loc['mean', 't2m'] == pytest.approx(hidden['t2m'].mean())
+    assert summary.loc['min', 't2m'] == 5 and summary.loc['max', 't2m'] == 99_994
+    assert paged.summary(1) is summary
+
+def test_hidden_summary_matches_direct_aggregation():
+    """Pages not aligned with the blocks, missing values and integer columns give the same summary."""
+    rng = np.random.default_rng(0)
+    values = rng.random(1000)
+    values[rng.random(1000) < 0.1] = np.nan
+    df = pd.DataFrame({"count": rng.integers(-50, 50, 1000), "value": values})
+    paged = PagedDataFrame(df, page_size=30, head=7, tail=11)
+    for n in [0, 1, 16, paged.n_pages - 1]:
+        shown, hidden = paged._ranges(n)
+        expected = pd.concat([df.iloc[a:b] for a, b in hidden]).agg(['count', 'mean', 'min', 'max'])
+        pd.testing.assert_frame_equal(paged.summary(n).astype(float), expected.astype(float))
+
+def test_repr_html_renders_only_window(large_df):
+    paged = PagedDataFrame(large_df, "Stations", page_size=10)
+    html = paged._repr_html_()
+    assert html.count("<tr>") < 40
+    assert "99985 rows not shown" in html
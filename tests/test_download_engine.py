@@ -0,0 +1,76 @@
+import json
+import threading
+import pytest
+from utils.atmos.download_engine import ClientPool, DownloadEngine
+from utils.atmos.download_scheduler import AdaptiveScheduler
+from utils.tests.fake_cds import FakeCDSClient
+
+DATASET = 'reanalysis-era5-single-levels'
+
+@pytest.fixture
+def metrics_path(tmp_path):
+    return tmp_path / 'metrics.jsonl'
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def test_client_pool_reuses_one_client_per_thread():
+    pool = ClientPool(factory=FakeCDSClient)
+    clients = []
+    def worker():
+        clients.append(pool.get())
+        clients.append(pool.get())
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert pool.created == 3
+    assert len({id(c) for c in clients}) == 3
+
+def test_retrieve_records_queue_and_transfer_time(tmp_path, metrics_path):
+    engine = DownloadEngine(client_factory=lambda: FakeCDSClient(latency=0.05, transfer_latency=0.02, payload=b'x' * 1000),
+                            metrics_path=metrics_path)
+    request = {'date': '20200101', 'variable': ['2m_temperature']}
+    engine.enqueue(DATASET, request)
+    engine.retrieve(DATASET, request, tmp_path / 'out.nc')
+
+    events = read_events(metrics_path)
+    assert [e['event'] for e in events] == ['queued', 'running', 'downloading', 'done']
+    done = events[-1]
+    assert done['bytes'] == 1000
+    assert done['queue_time'] >= 0.05
+    assert 0.02 <= done['transfer_time'] < done['queue_time']
+    assert done['bytes_per_s'] == pytest.approx(1000 / done['transfer_time'])
+
+    progress = engine.progress()
+    assert progress['done'] == 1 and progress['queued'] == 0
+    assert progress['bytes'] == 1000
+
+def test_failures_are_recorded(tmp_path, metrics_path):
+    engine = DownloadEngine(client_factory=lambda: FakeCDSClient(failures={'20200101': 1}), metrics_path=metrics_path)
+    with pytest.raises(RuntimeError):
+        engine.retrieve(DATASET, {'date': '20200101'}, tmp_path / 'out.nc')
+
+    assert read_events(metrics_path)[-1]['event'] == 'failed'
+    assert engine.progress()['failed'] == 1
+
+def test_engine_with_scheduler(tmp_path, metrics_path):
+    """Workers share pooled clients, and every request ends up in the metrics log."""
+    engine = DownloadEngine(client_factory=lambda: FakeCDSClient(latency=0.01), metrics_path=metrics_path)
+    requests = [{'date': f'202001{d:02d}'} for d in range(1, 13)]
+    for request in requests:
+        engine.enqueue(DATASET, request)
+    tasks = [(engine.retrieve, DATASET, request, tmp_path / f"{request['date']}.nc") for request in requests]
+
+    scheduler = AdaptiveScheduler(max_in_flight=3, initial_in_flight=3)
+    assert scheduler.run(tasks) == []
+    summary = engine.close()
+
+    assert summary['done'] == 12
+    assert summary['clients'] <= 3
+    events = read_events(metrics_path)
+    assert sum(e['event'] == 'done' for e in events) == 12
+    assert events[-1]['event'] == 'summary'
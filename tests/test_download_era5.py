@@ -0,0 +1,10 @@
+import os
+import subprocess
+import sys
+
+def test_cli_help():
+    """The command line in the module header runs, without cdsapi being needed for --help."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    result = subprocess.run([sys.executable, '-m', 'utils.atmos.download_era5', '--help'],
+                            env=env, capture_output=True, text=True, check=True)
+    assert '--zarr_store' in result.stdout
@@ -0,0 +1,113 @@
+import threading
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.atmos.download_manifest import (DownloadManifest,
+                                           request_hash,
+                                           atomic_target)
+
+DATASET = 'reanalysis-era5-single-levels'
+
+class FakeClient:
+    """Stand-in for cdsapi.Client that writes a small file instead of downloading."""
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    def retrieve(self, name, request, target):
+        self.calls += 1
+        with open(target, 'wb') as f:
+            f.write(b'x' * 100)
+        if self.fail:
+            raise RuntimeError("connection dropped")
+
+@pytest.fixture
+def request_dict():
+    return {
+        'variable': ['2m_temperature'],
+        'date': '20200101',
+        'area': [-32, 165, -50, 180],
+        'time': ['00:00', '01:00'],
+    }
+
+@pytest.fixture
+def manifest(tmp_path):
+    return DownloadManifest(tmp_path / 'manifest.json')
+
+def test_request_hash_is_stable(request_dict):
+    """Hash should not depend on key order, and should change with the request."""
+    reordered = dict(reversed(list(request_dict.items())))
+    assert request_hash(DATASET, request_dict) == request_hash(DATASET, reordered)
+    changed = dict(request_dict, date='20200102')
+    assert request_hash(DATASET, request_dict) != request_hash(DATASET, changed)
+
+def test_retrieve_marks_complete_and_persists(tmp_path, manifest, request_dict):
+    """A finished download is recorded, and the record survives reloading the manifest."""
+    target = tmp_path / 'surface' / 'ERA5_20200101_surface.nc'
+    manifest.retrieve(FakeClient(), DATASET, request_dict, target)
+
+    assert target.is_file()
+    assert manifest.is_complete(DATASET, request_dict, target, verify_checksum=True)
+    reloaded = DownloadManifest(manifest.path)
+    assert reloaded.status(DATASET, request_dict, target) == 'complete'
+
+def test_failed_download_is_partial(tmp_path, manifest, request_dict):
+    """An interrupted download leaves neither the target nor a temporary file behind."""
+    target = tmp_path / 'ERA5_20200101_surface.nc'
+    with pytest.raises(RuntimeError):
+        manifest.retrieve(FakeClient(fail=True), DATASET, request_dict, target)
+
+    assert not target.exists()
+    assert list(tmp_path.glob('*.part')) == []
+    assert manifest.status(DATASET, request_dict, target) == 'partial'
+    assert not manifest.is_complete(DATASET, request_dict, target)
+
+def test_corrupt_file_detected(tmp_path, manifest, request_dict):
+    """Size and checksum changes mark the file as corrupt."""
+    target = tmp_path / 'ERA5_20200101_surface.nc'
+    manifest.retrieve(FakeClient(), DATASET, request_dict, target)
+
+    target.write_bytes(b'y' * 100)
+    assert manifest.status(DATASET, request_dict, target) == 'complete'
+    assert manifest.status(DATASET, request_dict, target, verify_checksum=True) == 'corrupt'
+
+    target.write_bytes(b'y' * 10)
+    assert manifest.status(DATASET, request_dict, target) == 'corrupt'
+
+def test_untracked_files_are_adopted(tmp_path, manifest, request_dict):
+    """Valid files from before the manifest existed are adopted, unreadable ones are not."""
+    target = tmp_path / 'ERA5_20200101_surface.nc'
+    ds = xr.Dataset({'t2m': (['time'], np.arange(2.0))},
+                    coords={'time': pd.date_range('2020-01-01', periods=2, freq='h')})
+    ds.to_netcdf(target)
+    assert manifest.is_complete(DATASET, request_dict, target)
+    assert manifest.status(DATASET, request_dict, target) == 'complete'
+
+    other = dict(request_dict, date='20200102')
+    junk = tmp_path / 'ERA5_20200102_surface.nc'
+    junk.write_bytes(b'not a netcdf file')
+    assert not manifest.is_complete(DATASET, other, junk)
+
+def test_atomic_target(tmp_path):
+    """The final file only appears once the block has finished."""
+    target = tmp_path / 'out.txt'
+    with atomic_target(target) as tmp:
+        tmp.write_text('done')
+        assert not target.exists()
+    assert target.read_text() == 'done'
+
+def test_concurrent_saves_keep_latest(tmp_path, manifest, request_dict):
+    """Updates from many threads all reach the manifest on disk, whatever order the saves finish in."""
+    def worker(i):
+        for day in range(10):
+            request = dict(request_dict, date=f'2020{i + 1:02d}{day + 1:02d}')
+            manifest.mark_partial(DATASET, request, tmp_path / f"{request['date']}.nc")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(manifest.entries) == 80
+    assert DownloadManifest(manifest.path).entries == manifest.entries
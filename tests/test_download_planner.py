@@ -0,0 +1,152 @@
+import datetime
+import pytest
+import numpy as np
+import xarray as xr
+from utils.atmos.download_era5 import pressure_request
+from utils.atmos.download_manifest import DownloadManifest
+from utils.atmos.download_planner import (plan_requests,
+                                          count_fields,
+                                          request_dates,
+                                          download_chunk,
+                                          shard_request,
+                                          download_shard,
+                                          ShardedRequest)
+from utils.tests.fake_cds import FakeCDSClient, write_era5_netcdf
+
+@pytest.fixture
+def cfg(tmp_path):
+    return {
+        'download_dir': tmp_path,
+        'Nort': -32, 'West': 165, 'Sout': -50, 'East': 180,
+        'pressure_var': ['temperature', 'geopotential'],
+        'pressure_levels': ['500', '850', '1000'],
+    }
+
+def days_between(start, n):
+    return [start + datetime.timedelta(days=i) for i in range(n)]
+
+def test_count_fields(cfg):
+    _, request, _ = pressure_request(datetime.datetime(2020, 1, 1), cfg)
+    assert count_fields(request) == 2 * 3 * 24
+
+def test_request_dates():
+    assert request_dates({'date': '20200130/20200202'}) == days_between(datetime.datetime(2020, 1, 30), 4)
+    assert request_dates({'date': '2020-01-30/to/2020-01-31'}) == days_between(datetime.datetime(2020, 1, 30), 2)
+    assert request_dates({'year': '2021', 'month': '02', 'day': ['27', '28', '29']}) == days_between(datetime.datetime(2021, 2, 27), 2)
+
+def test_plan_respects_field_limit_and_months(cfg):
+    """Requests stay under the field limit and never span a month boundary."""
+    days = days_between(datetime.datetime(2020, 1, 20), 20)  # 20 Jan - 8 Feb
+    chunks = plan_requests(days, pressure_request, cfg, max_fields=144 * 5)
+
+    assert sum(len(c.days) for c in chunks) == 20
+    assert [len(c.days) for c in chunks] == [5, 5, 2, 5, 3]
+    for chunk in chunks:
+        assert count_fields(chunk.request) <= 144 * 5
+        assert len({(d.year, d.month) for d in chunk.days}) == 1
+        assert request_dates(chunk.request) == chunk.days
+
+def test_plan_skips_gaps_without_splitting(cfg):
+    """Non-contiguous days in the same month still go in one request."""
+    days = [datetime.datetime(2020, 1, d) for d in (2, 5, 9)]
+    chunks = plan_requests(days, pressure_request, cfg)
+    assert len(chunks) == 1
+    assert chunks[0].request['day'] == ['02', '05', '09']
+
+def test_download_chunk_splits_into_daily_files(cfg):
+    days = days_between(datetime.datetime(2020, 1, 1), 3)
+    chunk, = plan_requests(days, pressure_request, cfg)
+    manifest = DownloadManifest(cfg['download_dir'] / 'manifest.json')
+    client = FakeCDSClient(payload=write_era5_netcdf)
+
+    download_chunk(client, chunk, manifest)
+
+    assert len(client.calls) == 1
+    assert not chunk.chunk_file.exists()
+    for i, day in enumerate(days):
+        dataset, request, target = pressure_request(day, cfg)
+        assert manifest.is_complete(dataset, request, target, verify_checksum=True)
+        with xr.open_dataset(target) as ds:
+            assert ds.sizes['valid_time'] == 24
+            assert ds.sizes['pressure_level'] == 3
+            assert (ds['valid_time'].dt.day == day.day).all()
+            np.testing.assert_array_equal(ds['temperature'].isel(pressure_level=0, latitude=0, longitude=0),
+                                          np.arange(24 * i, 24 * (i + 1)))
+
+def test_leftover_chunk_is_not_downloaded_again(cfg):
+    """A chunk downloaded before a crash is split without another CDS request."""
+    days = days_between(datetime.datetime(2020, 1, 1), 2)
+    chunk, = plan_requests(days, pressure_request, cfg)
+    manifest = DownloadManifest(cfg['download_dir'] / 'manifest.json')
+    client = FakeCDSClient(payload=write_era5_netcdf)
+    manifest.retrieve(client, chunk.dataset, chunk.request, chunk.chunk_file)
+
+    download_chunk(client, chunk, manifest)
+    assert len(client.calls) == 1
+    assert all(target.is_file() for _, _, target in chunk.daily)
+
+def write_gridded_netcdf(name, request, target):
+    """Like write_era5_netcdf, on the 0.25 degree grid of the requested area, with values that
+    depend on the position, level and time step."""
+    north, west, south, east = request['area']
+    shape = (int(round((north - south) / 0.25)) + 1, int(round((east - west) / 0.25)) + 1)
+    write_era5_netcdf(name, request, target, shape=shape)
+    with xr.open_dataset(target) as ds:
+        ds = ds.load()
+    for v in request['variable']:
+        ds[v] = ds[v] + 1000 * ds['latitude'] + ds['longitude'] + len(v)
+        if 'pressure_level' in ds.dims:
+            ds[v] = ds[v] + 1e5 * ds['pressure_level']
+    ds.to_netcdf(target)
+
+def test_shard_by_variables_and_levels(cfg):
+    dataset, request, target = pressure_request(datetime.datetime(2020, 1, 1), cfg)
+    # 2 variables x 3 levels x 24 hours = 144 fields
+    sharded = shard_request(dataset, request, target, max_fields=80)
+    assert [r['variable'] for r, _ in sharded.shards] == [['temperature'], ['geopotential']]
+    sharded = shard_request(dataset, request, target, max_fields=48)
+    assert [(r['variable'], r['pressure_level']) for r, _ in sharded.shards] == [
+        (['temperature'], ['500', '850']), (['temperature'], ['1000']),
+        (['geopotential'], ['500', '850']), (['geopotential'], ['1000'])]
+    assert all(count_fields(r) <= 48 for r, _ in sharded.shards)
+    assert len({f for _, f in sharded.shards}) == 4
+
+def test_shard_tiles_cover_area_without_overlap(cfg):
+    dataset, request, target = pressure_request(datetime.datetime(2020, 1, 1), cfg)
+    sharded = shard_request(dataset, request, target, tiles=(2, 3))
+    areas = [r['area'] for r, _ in sharded.shards]
+    assert len(areas) == 6
+    norths, souths = sorted({a[0] for a in areas}, reverse=True), sorted({a[2] for a in areas}, reverse=True)
+    wests, easts = sorted({a[1] for a in areas}), sorted({a[3] for a in areas})
+    assert (norths[0], souths[-1], wests[0], easts[-1]) == (-32, -50, 165, 180)
+    # Adjacent tiles are one grid step apart
+    np.testing.assert_allclose(np.array(souths[:-1]) - np.array(norths[1:]), 0.25)
+    np.testing.assert_allclose(np.array(wests[1:]) - np.array(easts[:-1]), 0.25)
+
+def test_plan_shards_days_over_the_limit(cfg):
+    days = days_between(datetime.datetime(2020, 1, 1), 2)
+    chunks = plan_requests(days, pressure_request, cfg, max_fields=100)
+    assert [type(c) for c in chunks] == [ShardedRequest, ShardedRequest]
+    assert [len(c.shards) for c in chunks] == [2, 2]
+    assert plan_requests(days, pressure_request, cfg, tiles=(2, 2))[0].shards[3][0]['area'][2] == -50
+
+def test_download_shards_merge_into_daily_file(cfg):
+    day = datetime.datetime(2020, 1, 1)
+    dataset, request, target = pressure_request(day, cfg)
+    sharded = shard_request(dataset, request, target, max_fields=48, tiles=(2, 2))
+    manifest = DownloadManifest(cfg['download_dir'] / 'manifest.json')
+    client = FakeCDSClient(payload=write_gridded_netcdf)
+
+    for i in range(len(sharded.shards)):
+        assert not target.exists()
+        download_shard(client, sharded, i, manifest)
+    assert len(client.calls) == 16
+    assert manifest.is_complete(dataset, request, target, verify_checksum=True)
+    assert not any(f.exists() for _, f in sharded.shards)
+    assert len(manifest.entries) == 1
+
+    expected = cfg['download_dir'] / 'expected.nc'
+    write_gridded_netcdf(dataset, request, expected)
+    with xr.open_dataset(target) as result, xr.open_dataset(expected) as expected:
+        assert dict(result.sizes) == dict(expected.sizes)
+        xr.testing.assert_allclose(result.transpose(*expected['temperature'].dims), expected)
@@ -0,0 +1,87 @@
+import time
+import pytest
+from utils.atmos.download_scheduler import (AdaptiveScheduler,
+                                            backoff_delay,
+                                            is_rate_limit_error)
+from utils.tests.fake_cds import FakeCDSClient, FakeRateLimitError
+
+def fetch(date, client, out_dir):
+    """Download task in the same (function, *args) form used by download_era5.py."""
+    client.retrieve('reanalysis-era5-single-levels', {'date': date}, out_dir / f'ERA5_{date}_surface.nc')
+
+def make_tasks(client, out_dir, n):
+    return [(fetch, f'2020{i:04d}', client, out_dir) for i in range(n)]
+
+def test_all_tasks_complete(tmp_path):
+    client = FakeCDSClient(latency=0.01)
+    scheduler = AdaptiveScheduler(max_in_flight=4, backoff_base=0.01)
+    failed = scheduler.run(make_tasks(client, tmp_path, 12))
+
+    assert failed == []
+    assert scheduler.stats['completed'] == 12
+    assert len(list(tmp_path.glob('*.nc'))) == 12
+    assert client.peak_active <= 4
+
+def test_slow_request_does_not_stall_others(tmp_path):
+    """Slow requests spread across what used to be separate batches should overlap."""
+    slow = {'20200000', '20200004', '20200008'}
+    client = FakeCDSClient(latency=lambda name, request: 0.3 if request['date'] in slow else 0.01)
+    scheduler = AdaptiveScheduler(max_in_flight=4, initial_in_flight=4)
+
+    start = time.monotonic()
+    assert scheduler.run(make_tasks(client, tmp_path, 12)) == []
+    # A batch-and-wait loop of size 4 would take at least 3 x 0.3s here.
+    assert time.monotonic() - start < 0.6
+
+def test_failed_requests_are_retried(tmp_path):
+    client = FakeCDSClient(failures={'20200001': 2})
+    scheduler = AdaptiveScheduler(max_in_flight=2, backoff_base=0.01, max_retries=3)
+    failed = scheduler.run(make_tasks(client, tmp_path, 3))
+
+    assert failed == []
+    assert scheduler.stats['retried'] == 2
+    assert [d for _, d in client.calls].count('20200001') == 3
+
+def test_gives_up_after_max_retries(tmp_path):
+    client = FakeCDSClient(failures={'20200001': 10})
+    scheduler = AdaptiveScheduler(max_in_flight=2, backoff_base=0.01, max_retries=2)
+    failed = scheduler.run(make_tasks(client, tmp_path, 3))
+
+    assert len(failed) == 1
+    assert failed[0][0][1] == '20200001'
+    assert scheduler.stats['completed'] == 2
+
+def test_rate_limit_reduces_concurrency(tmp_path):
+    client = FakeCDSClient(latency=0.02, rate_limit=2)
+    scheduler = AdaptiveScheduler(max_in_flight=8, initial_in_flight=8, backoff_base=0.01, max_retries=20)
+    failed = scheduler.run(make_tasks(client, tmp_path, 16))
+
+    assert failed == []
+    assert scheduler.stats['rate_limited'] > 0
+    assert scheduler.stats['completed'] == 16
+
+def test_high_latency_reduces_concurrency(tmp_path):
+    client = FakeCDSClient(latency=0.02)
+    scheduler = AdaptiveScheduler(max_in_flight=6, initial_in_flight=6, target_latency=0.001)
+    scheduler.run(make_tasks(client, tmp_path, 12))
+    assert scheduler.limit == scheduler.min_in_flight
+
+def test_low_latency_grows_concurrency(tmp_path):
+    client = FakeCDSClient(latency=0.001)
+    scheduler = AdaptiveScheduler(max_in_flight=6, initial_in_flight=1, target_latency=1.)
+    scheduler.run(make_tasks(client, tmp_path, 12))
+    assert scheduler.limit == scheduler.max_in_flight
+
+def test_backoff_delay_bounds():
+    for attempt in range(1, 10):
+        delay = backoff_delay(attempt, base=1., cap=60.)
+        expected = min(60., 2. ** (attempt - 1))
+        assert expected / 2 <= delay <= expected
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(FakeRateLimitError())
+    assert not is_rate_limit_error(RuntimeError("Connection reset by peer"))
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        AdaptiveScheduler(max_in_flight=2, min_in_flight=3)
@@ -0,0 +1,116 @@
+import datetime
+import pytest
+import numpy as np
+from pathlib import Path
+from utils.atmos.download_manifest import DownloadManifest
+from utils.atmos.download_planner import plan_requests, download_chunk
+from utils.atmos.era5_catalogue import ERA5Catalogue, CATALOGUE_NAME
+from utils.tests.fake_cds import FakeCDSClient, write_era5_netcdf
+
+pytest.importorskip("dask")
+
+AREA = [-32, 165, -50, 180]
+
+def day_request(day, level_type):
+    """Request and target laid out as by download_era5.pressure_request/surface_request."""
+    date = day.strftime('%Y%m%d')
+    request = {'date': date, 'area': AREA, 'time': [f'{h:02d}:00' for h in range(24)]}
+    if level_type == 'pressure':
+        request.update(variable=['t', 'z'], pressure_level=['500', '850'])
+        dataset = 'reanalysis-era5-pressure-levels'
+    else:
+        request.update(variable=['t2m', 'msl'])
+        dataset = 'reanalysis-era5-single-levels'
+    target = Path(level_type) / str(day.year) / f'{day.month:02d}' / f'ERA5_{date}_{level_type}.nc'
+    return dataset, request, target
+
+@pytest.fixture
+def archive(tmp_path):
+    """Five days of surface and pressure-level files."""
+    for i in range(5):
+        day = datetime.datetime(2020, 1, 30) + datetime.timedelta(days=i)
+        for level_type in ('surface', 'pressure'):
+            dataset, request, target = day_request(day, level_type)
+            (tmp_path / target).parent.mkdir(parents=True, exist_ok=True)
+            write_era5_netcdf(dataset, request, tmp_path / target)
+    return tmp_path
+
+@pytest.fixture
+def catalogue(archive):
+    with ERA5Catalogue(archive / CATALOGUE_NAME) as catalogue:
+        catalogue.update()
+        yield catalogue
+
+def test_update_indexes_archive(catalogue, archive):
+    assert len(catalogue) == 10
+    record, = catalogue.query('2020-02-01', '2020-02-01', level_type='pressure')
+    assert record['path'] == archive / 'pressure/2020/02/ERA5_20200201_pressure.nc'
+    assert record['variables'] == ['t', 'z']
+    assert record['levels'] == [500., 850.]
+    assert (record['lat_min'], record['lat_max'], record['lon_min'], record['lon_max']) == (-50, -32, 165, 180)
+    assert record['n_times'] == 24
+
+def test_update_only_opens_new_files(catalogue, archive, monkeypatch):
+    import utils.atmos.era5_catalogue as era5_catalogue
+    opened = []
+    read = era5_catalogue.read_file_record
+    monkeypatch.setattr(era5_catalogue, 'read_file_record', lambda path: opened.append(path) or read(path))
+
+    assert catalogue.update() == 0
+    dataset, request, target = day_request(datetime.datetime(2020, 2, 4), 'surface')
+    write_era5_netcdf(dataset, request, archive / target)
+    (archive / 'surface/2020/01/ERA5_20200130_surface.nc').unlink()
+    assert catalogue.update() == 1
+    assert opened == [archive / target]
+    assert len(catalogue) == 10
+
+def test_query(catalogue):
+    assert len(catalogue.query(start='20200201')) == 6
+    assert len(catalogue.query(datetime.date(2020, 1, 30), datetime.date(2020, 1, 31))) == 4
+    assert {r['level_type'] for r in catalogue.query(variables=['2m_temperature'])} == {'surface'}
+    assert len(catalogue.query(area=[-40, 170, -45, 175])) == 10
+    assert catalogue.query(area=[10, 0, 0, 10]) == []
+
+def test_open_time_range_variables_area(catalogue):
+    ds = catalogue.open('2020-01-31', '2020-02-02', variables=['2m_temperature', 't'],
+                        area=[-35, 170, -45, 180], levels=[850])
+    assert set(ds.data_vars) == {'t2m', 't'}
+    assert ds['t2m'].chunks is not None
+    assert ds.sizes['valid_time'] == 72
+    assert str(ds['valid_time'].values[0])[:13] == '2020-01-31T00'
+    assert str(ds['valid_time'].values[-1])[:13] == '2020-02-02T23'
+    assert ds['latitude'].values.max() <= -35 and ds['latitude'].values.min() >= -45
+    assert ds['pressure_level'].values.tolist() == [850.]
+    # write_era5_netcdf encodes the time step within the request in the values
+    np.testing.assert_array_equal(ds['t2m'].isel(latitude=0, longitude=0).values, np.tile(np.arange(24), 3))
+
+def test_open_no_match(catalogue):
+    with pytest.raises(FileNotFoundError):
+        catalogue.open('2021-01-01', '2021-01-02')
+
+def test_manifest_adds_completed_downloads(tmp_path):
+    catalogue = ERA5Catalogue(tmp_path / CATALOGUE_NAME)
+    manifest = DownloadManifest(tmp_path / 'manifest.json', catalogue=catalogue)
+    dataset, request, target = day_request(datetime.datetime(2020, 3, 1), 'surface')
+    manifest.retrieve(FakeCDSClient(payload=write_era5_netcdf), dataset, request, tmp_path / target)
+
+    record, = catalogue.query()
+    assert record['path'] == tmp_path / target
+    assert record['sha256'] == manifest.entries[next(iter(manifest.entries))]['sha256']
+    manifest.forget(dataset, request)
+    assert len(catalogue) == 0
+
+def test_chunked_download_catalogues_daily_files(tmp_path):
+    """The planner's chunk file goes through the manifest too, but only the daily files are catalogued."""
+    def surface_request(day, cfg):
+        dataset, request, target = day_request(day, 'surface')
+        return dataset, request, cfg['download_dir'] / target
+
+    days = [datetime.datetime(2020, 1, d) for d in (1, 2, 3)]
+    chunk, = plan_requests(days, surface_request, {'download_dir': tmp_path})
+    with ERA5Catalogue(tmp_path / CATALOGUE_NAME) as catalogue:
+        manifest = DownloadManifest(tmp_path / 'manifest.json', catalogue=catalogue)
+        download_chunk(FakeCDSClient(payload=write_era5_netcdf), chunk, manifest)
+
+        assert [r['date'] for r in catalogue.query()] == ['2020-01-01', '2020-01-02', '2020-01-03']
+        assert manifest.is_complete(*surface_request(days[0], {'download_dir': tmp_path}))
@@ -0,0 +1,99 @@
+import datetime
+import pytest
+import numpy as np
+import xarray as xr
+from utils.atmos.download_era5 import surface_request, constants_request, get_constants_file
+from utils.atmos.download_manifest import DownloadManifest
+from utils.atmos.era5_catalogue import ERA5Catalogue, CATALOGUE_NAME
+from utils.atmos.era5_constants import split_static, constants_path, find_constants, add_constants, open_day
+from utils.tests.fake_cds import FakeCDSClient, write_era5_netcdf
+
+@pytest.fixture
+def cfg(tmp_path):
+    return {
+        'download_dir': tmp_path,
+        'Nort': -32, 'West': 165, 'Sout': -50, 'East': 180,
+        'surface_var': ['2m_temperature', 'land_sea_mask', 'mean_sea_level_pressure', 'soil_type'],
+    }
+
+def write_constants(cfg, values=None):
+    """Constants file as downloaded by get_constants_file, with fields varying in space."""
+    dataset, request, target = constants_request(cfg)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    write_era5_netcdf(dataset, request, target)
+    with xr.open_dataset(target) as ds:
+        ds = ds.load()
+    ds['lsm'] = ds['land_sea_mask'] + np.arange(4)
+    ds = ds.drop_vars(['land_sea_mask', 'soil_type']).assign(slt=ds['lsm'] * 2)
+    ds.to_netcdf(target)
+    return target
+
+def write_day(cfg, day):
+    """Daily file named as downloaded; the fake CDS names variables as requested."""
+    dataset, request, target = surface_request(day, cfg)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    write_era5_netcdf(dataset, request, target)
+    return target
+
+def test_split_static():
+    assert split_static(['2m_temperature', 'land_sea_mask', 'soil_type', 'sea_ice_cover']) == \
+        (['2m_temperature', 'sea_ice_cover'], ['land_sea_mask', 'soil_type'])
+
+def test_surface_request_strips_static_fields(cfg):
+    _, request, _ = surface_request(datetime.datetime(2020, 1, 1), cfg)
+    assert request['variable'] == ['2m_temperature', 'mean_sea_level_pressure']
+
+    dataset, request, target = constants_request(cfg)
+    assert dataset == 'reanalysis-era5-single-levels'
+    assert request['variable'] == ['land_sea_mask', 'soil_type']
+    assert request['time'] == ['00:00']
+    assert target == cfg['download_dir'] / 'constants' / 'ERA5_constants_-32_165_-50_180.nc'
+    # The same request every run, so the manifest skips it once downloaded
+    assert constants_request(dict(cfg, start_date='20210101')) == (dataset, request, target)
+
+def test_keep_static(cfg):
+    cfg['keep_static'] = True
+    assert surface_request(datetime.datetime(2020, 1, 1), cfg)[1]['variable'] == cfg['surface_var']
+    assert constants_request(cfg) is None
+    assert constants_request(dict(cfg, keep_static=False, surface_var=['2m_temperature'])) is None
+
+def test_constants_file_is_not_catalogued(cfg, tmp_path):
+    with ERA5Catalogue(tmp_path / CATALOGUE_NAME) as catalogue:
+        manifest = DownloadManifest(tmp_path / 'manifest.json', catalogue=catalogue)
+        client = FakeCDSClient(payload=write_era5_netcdf)
+        get_constants_file(cfg, manifest, client)
+        assert manifest.is_complete(*constants_request(cfg))
+        assert len(catalogue) == 0
+
+def test_open_day_broadcasts_constants(cfg):
+    constants = write_constants(cfg)
+    path = write_day(cfg, datetime.datetime(2020, 1, 1))
+    with open_day(path) as ds:
+        assert set(ds.data_vars) == {'2m_temperature', 'mean_sea_level_pressure', 'lsm', 'slt'}
+        assert ds['lsm'].dims == ('valid_time', 'latitude', 'longitude')
+        assert ds['lsm'].shape == ds['2m_temperature'].shape
+        with xr.open_dataset(constants) as c:
+            for t in (0, 23):
+                np.testing.assert_array_equal(ds['lsm'].isel(valid_time=t).values, c['lsm'].isel(valid_time=0).values)
+    with open_day(path, constants=False) as ds:
+        assert 'lsm' not in ds
+
+def test_find_constants_matches_area(cfg):
+    write_constants(cfg)
+    world = dict(cfg, Nort=90, West=-180, Sout=-90, East=180)
+    write_constants(world)
+    inside = xr.Dataset(coords={'latitude': [-40., -45.], 'longitude': [170., 175.]})
+    elsewhere = xr.Dataset(coords={'latitude': [10.], 'longitude': [0.]})
+    assert find_constants(cfg['download_dir'], inside) == constants_path(cfg['download_dir'], [-32, 165, -50, 180])
+    assert find_constants(cfg['download_dir'], elsewhere) == constants_path(cfg['download_dir'], [90, -180, -90, 180])
+
+def test_add_constants_subset_keeps_existing(cfg):
+    constants = write_constants(cfg)
+    with xr.open_dataset(write_day(cfg, datetime.datetime(2020, 1, 1))) as ds:
+        # Files from before the split already have the static fields; theirs are kept
+        day = ds.isel(latitude=[1], longitude=[2, 3]).load().assign(lsm=lambda d: d['2m_temperature'] * 0 - 1)
+    result = add_constants(day, constants)
+    assert (result['lsm'] == -1).all()
+    with xr.open_dataset(constants) as c:
+        np.testing.assert_array_equal(result['slt'].isel(valid_time=5).values,
+                                      c['slt'].isel(valid_time=0, latitude=[1], longitude=[2, 3]).values)
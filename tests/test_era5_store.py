@@ -0,0 +1,94 @@
+import pytest
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+pytest.importorskip("zarr")
+pytest.importorskip("dask")
+
+from utils.atmos.era5_store import append_to_store, resolve_chunks
+
+def write_day(path, day, shape=(5, 6)):
+    """Daily surface file with 24 hourly steps, values equal to hours since 2020-01-01."""
+    times = pd.date_range(day, periods=24, freq='h')
+    hours = ((times - pd.Timestamp('2020-01-01')) / pd.Timedelta(hours=1)).values.astype('float32')
+    data = np.broadcast_to(hours[:, None, None], (24,) + shape).copy()
+    ds = xr.Dataset({'t2m': (['valid_time', 'latitude', 'longitude'], data),
+                     'msl': (['valid_time', 'latitude', 'longitude'], data + 1000)},
+                    coords={'valid_time': times,
+                            'latitude': np.linspace(-32, -50, shape[0]),
+                            'longitude': np.linspace(165, 180, shape[1])})
+    ds.to_netcdf(path)
+    return path
+
+@pytest.fixture
+def daily_files(tmp_path):
+    return [write_day(tmp_path / f'ERA5_{day:%Y%m%d}_surface.nc', day)
+            for day in pd.date_range('2020-01-01', periods=5)]
+
+def check_store(store, n_days):
+    with xr.open_zarr(store) as ds:
+        assert ds.sizes['valid_time'] == 24 * n_days
+        assert pd.Index(ds['valid_time'].values).is_monotonic_increasing
+        np.testing.assert_array_equal(ds['t2m'].isel(latitude=2, longitude=3).values, np.arange(24 * n_days))
+        np.testing.assert_array_equal(ds['msl'].isel(latitude=0, longitude=0).values, np.arange(24 * n_days) + 1000)
+
+def test_resolve_chunks(daily_files):
+    with xr.open_dataset(daily_files[0]) as ds:
+        assert resolve_chunks(ds, 'timeseries') == {'valid_time': 744, 'latitude': 5, 'longitude': 6}
+        assert resolve_chunks(ds, 'map') == {'valid_time': 1, 'latitude': 5, 'longitude': 6}
+        assert resolve_chunks(ds, {'time': 10, 'latitude': 2}) == {'valid_time': 10, 'latitude': 2, 'longitude': 6}
+
+@pytest.mark.parametrize("layout", ['map', {'time': 36, 'latitude': 2, 'longitude': 3}])
+def test_append_to_new_store(tmp_path, daily_files, layout):
+    store = tmp_path / 'surface.zarr'
+    assert append_to_store(daily_files, store, layout=layout, processes=2) == 24 * 5
+    check_store(store, 5)
+
+def test_incremental_append(tmp_path, daily_files):
+    """Later runs only append the new days, including into a partially filled time chunk."""
+    store = tmp_path / 'surface.zarr'
+    layout = {'time': 36, 'latitude': -1, 'longitude': -1}
+    assert append_to_store(daily_files[:2], store, layout=layout, processes=2) == 48
+    assert append_to_store(daily_files, store, processes=2) == 72
+    check_store(store, 5)
+    assert append_to_store(daily_files, store, processes=2) == 0
+    with xr.open_zarr(store) as ds:
+        assert ds['t2m'].encoding['chunks'] == (36, 5, 6)
+
+def test_stored_days_are_not_reopened(tmp_path, daily_files, monkeypatch):
+    """Files named for days before the end of the store are skipped without opening them."""
+    store = tmp_path / 'surface.zarr'
+    append_to_store(daily_files[:3], store, processes=1)
+
+    opened = []
+    import utils.atmos.era5_store as era5_store
+    original = era5_store._file_times
+    monkeypatch.setattr(era5_store, '_file_times', lambda path, name: opened.append(path) or original(path, name))
+    append_to_store(daily_files, store, processes=1)
+    assert [p.name for p in opened] == [f.name for f in daily_files[2:]]
+    check_store(store, 5)
+
+def test_gap_is_reported(tmp_path, daily_files):
+    """Days 1 and 3 without day 2 are refused, naming the missing day."""
+    store = tmp_path / 'surface.zarr'
+    with pytest.raises(ValueError, match='2020-01-02'):
+        append_to_store([daily_files[0], daily_files[2]], store, processes=1)
+    assert not store.exists()
+
+def test_late_day_is_reported(tmp_path, daily_files):
+    """A day whose download was retried after later days were stored is not silently dropped."""
+    store = tmp_path / 'surface.zarr'
+    append_to_store(daily_files[:1], store, processes=1)
+    with pytest.raises(ValueError, match='2020-01-02'):
+        append_to_store([daily_files[0], daily_files[2]], store, processes=1)
+    # Once the retried day is there, the days continue on from the store
+    assert append_to_store(daily_files[:3], store, processes=1) == 48
+    check_store(store, 3)
+
+    # A store written with a hole in it (days 1 and 3) names the day that arrived late
+    holed = tmp_path / 'holed.zarr'
+    with xr.open_mfdataset([daily_files[0], daily_files[2]], combine='nested', concat_dim='valid_time') as ds:
+        ds.to_zarr(holed)
+    with pytest.raises(ValueError, match='2020-01-02'):
+        append_to_store(daily_files[:3], holed, processes=1)
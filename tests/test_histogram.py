@@ -0,0 +1,116 @@
+import pytest
+import numpy as np
+import xarray as xr
+from utils.python.histogram import StreamingHistogram, histogram_files, MAX_BINS
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(0)
+    return rng.normal(280, 10, 10_000)
+
+@pytest.fixture
+def daily_files(tmp_path, values):
+    paths = []
+    for i, chunk in enumerate(np.split(values, 5)):
+        path = tmp_path / f'ERA5_2020010{i + 1}_surface.nc'
+        xr.Dataset({'t2m': (['valid_time', 'latitude'], chunk.reshape(20, 100))}).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+def test_chunks_match_numpy(values):
+    hist = StreamingHistogram(width=2.)
+    for chunk in np.array_split(values, 7):
+        hist.add(chunk)
+    expected, edges = np.histogram(values, bins=hist.edges)
+    assert hist.edges[0] <= values.min() and hist.edges[-1] > values.max()
+    assert np.all(np.isclose(np.round(hist.edges / 2.), hist.edges / 2.))
+    np.testing.assert_array_equal(hist.counts, expected)
+    assert hist.total == values.size
+
+def test_auto_width_and_nans():
+    hist = StreamingHistogram()
+    hist.add(np.array([0., 1., 9.9, np.nan, np.inf]))
+    assert hist.width == 0.2
+    assert hist.total == 3
+
+def test_fixed_edges_count_outside_values(values):
+    hist = StreamingHistogram(edges=np.linspace(270, 290, 21))
+    hist.add(values[:5000])
+    hist.add(xr.DataArray(values[5000:]))
+    np.testing.assert_array_equal(hist.counts, np.histogram(values, bins=hist.edges)[0])
+    assert hist.underflow == np.count_nonzero(values < 270)
+    assert hist.overflow == np.count_nonzero(values > 290)
+    assert hist.total == values.size
+
+def test_merge_equals_single_pass(values):
+    single = StreamingHistogram(width=0.5)
+    single.add(values)
+    a, b = StreamingHistogram(width=0.5), StreamingHistogram(width=0.5)
+    a.add(values[values < 275])
+    b.add(values[values >= 275])
+    merged = StreamingHistogram().merge(a).merge(b)
+    np.testing.assert_array_equal(merged.edges, single.edges)
+    np.testing.assert_array_equal(merged.counts, single.counts)
+
+def test_merge_mismatched_bins():
+    a, b = StreamingHistogram(width=1.), StreamingHistogram(width=2.)
+    a.add([1.])
+    b.add([1.])
+    with pytest.raises(ValueError):
+        a.merge(b)
+    with pytest.raises(ValueError):
+        StreamingHistogram(edges=[0, 1]).merge(a)
+
+def test_outlier_guard():
+    hist = StreamingHistogram(width=0.1)
+    hist.add([0.])
+    with pytest.raises(ValueError):
+        hist.add([9.96921e36])
+
+def test_failed_source_can_be_retried(values):
+    """A source whose data did not fit is not marked as added, so it can be added again once fixed."""
+    hist = StreamingHistogram(width=1.)
+    hist.add(values[:100], source='a')
+    bad = values[100:200].copy()
+    bad[0] = hist.edges[0] + (MAX_BINS + 1) * hist.width
+    with pytest.raises(ValueError):
+        hist.add(bad, source='b')
+    assert hist.sources == {'a'} and hist.total == 100
+    assert hist.add(values[100:200], source='b')
+    assert hist.total == 200
+
+def test_save_load_skips_known_sources(tmp_path, values):
+    hist = StreamingHistogram(width=1.)
+    assert hist.add(values[:100], source='day1')
+    path = tmp_path / 'hist.npz'
+    hist.save(path)
+
+    loaded = StreamingHistogram.load(path)
+    assert not loaded.add(values[:100], source='day1')
+    assert loaded.add(values[100:200], source='day2')
+    assert loaded.total == 200
+    np.testing.assert_array_equal(StreamingHistogram.load(path).counts, hist.counts)
+
+    fixed = StreamingHistogram(edges=[0, 280, 300])
+    fixed.add(values)
+    fixed.save(path)
+    assert StreamingHistogram.load(path).total == values.size
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_histogram_files(daily_files, values, processes):
+    hist = histogram_files(daily_files, 't2m', width=1., processes=processes)
+    np.testing.assert_array_equal(hist.counts, np.histogram(values, bins=hist.edges)[0])
+    assert len(hist.sources) == 5
+
+def test_histogram_files_incremental(daily_files, values, tmp_path):
+    hist = histogram_files(daily_files[:3], 't2m', processes=2)
+    hist.save(tmp_path / 'hist.npz')
+    hist = histogram_files(daily_files, 't2m', histogram=StreamingHistogram.load(tmp_path / 'hist.npz'), processes=2)
+    assert hist.total == values.size
+    np.testing.assert_array_equal(hist.counts, np.histogram(values, bins=hist.edges)[0])
+
+def test_plot(values, tmp_path):
+    hist = StreamingHistogram(width=1.)
+    hist.add(values)
+    hist.plot(tmp_path / 'hist.png')
+    assert (tmp_path / 'hist.png').exists()
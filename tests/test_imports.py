@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import pytest
+import utils
+import utils.atmos
+import utils.python
+
+# Heavy dependencies each module must not import when it is itself imported.
+# Import-time budgets are checked in benchmarks/test_imports.py, away from the unit suite.
+FORBIDDEN = {
+    'utils': ['numpy'],
+    'utils.atmos': ['numpy'],
+    'utils.python': ['numpy'],
+    'utils.atmos.convert_units': ['numpy', 'xarray'],
+    'utils.atmos.download_manifest': ['numpy', 'xarray'],
+    'utils.atmos.download_scheduler': ['numpy', 'xarray'],
+    'utils.atmos.download_engine': ['numpy', 'xarray', 'cdsapi'],
+    'utils.atmos.download_planner': ['xarray', 'cdsapi'],
+    'utils.atmos.download_era5': ['xarray', 'cdsapi'],
+    'utils.atmos.netcdf': ['xesmf', 'ESMF', 'esmpy', 'dask'],
+    'utils.atmos.era5_catalogue': ['numpy', 'xarray'],
+    'utils.atmos.derived': ['xarray', 'dask'],
+    'utils.atmos.era5_constants': ['numpy', 'xarray'],
+    'utils.atmos.era5_store': ['zarr', 'dask'],
+    'utils.python.debug': ['matplotlib', 'seaborn', 'pandas'],
+    'utils.python.display': ['pandas'],
+    'utils.python.histogram': ['matplotlib', 'xarray'],
+    'utils.python.tracing': ['numpy', 'tracemalloc'],
+}
+
+CHECK = """
+import sys
+import {module}
+print(*[m for m in {forbidden!r} if m in sys.modules])
+"""
+
+@pytest.mark.parametrize("module", FORBIDDEN)
+def test_no_heavy_imports(module):
+    # In a fresh interpreter, as this one has imported everything already
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    out = subprocess.run([sys.executable, '-c', CHECK.format(module=module, forbidden=FORBIDDEN[module])],
+                         env=env, capture_output=True, text=True, check=True).stdout.split()
+    assert out == [], f"{module} imports {out}"
+
+@pytest.mark.parametrize("package", [utils.atmos, utils.python])
+def test_lazy_exports_resolve(package):
+    for name in package.__all__:
+        assert getattr(package, name) is getattr(sys.modules[f'{package.__name__}.{package._exports[name]}'], name)
+    assert set(package.__all__) <= set(dir(package))
+
+def test_lazy_submodules():
+    assert utils.atmos.convert_units.kelvin_to_celsius(273.15) == pytest.approx(0)
+    assert utils.python is sys.modules['utils.python']
+
+def test_unknown_attribute():
+    with pytest.raises(AttributeError):
+        utils.atmos.not_a_function
+    with pytest.raises(AttributeError):
+        utils.nothing
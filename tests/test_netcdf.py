@@ -1,10 +1,18 @@
 import pytest
 import xarray as xr
 import numpy as np
-import xesmf as xe
 import pandas as pd
+import importlib.util
 from utils.atmos.netcdf import (standardise_coords, 
-                                interpolate_irregular_to_regular_grid)
+                                interpolate_irregular_to_regular_grid,
+                                RegridderCache,
+                                SparseRegridder,
+                                SharedRegridExecutor,
+                                horizontal_grid,
+                                regrid_files)
+
+# Regridding needs xesmf (and ESMF), which is only imported when first used
+requires_xesmf = pytest.mark.skipif(importlib.util.find_spec('xesmf') is None, reason="xesmf is not installed")
 
 # Define the test datasets
 @pytest.fixture
@@ -31,6 +39,34 @@ def regular_data():
     ds = xr.Dataset({'var': (['time', 'latitude', 'longitude'], data)}, coords=coords)
     return ds
 
+@pytest.fixture
+def multi_time_data():
+    # Several time steps, levels and variables on the irregular grid
+    rng = np.random.default_rng(0)
+    coords = {
+        'lat': [0, 1, 2, 3],
+        'lon': [0, 1, 2, 3, 4],
+        'level': [500, 850, 1000],
+        'time': pd.date_range('2023-01-01', periods=6, freq='h'),
+    }
+    dims = ['time', 'level', 'lat', 'lon']
+    return xr.Dataset({'t': (dims, rng.random((6, 3, 4, 5))),
+                       'q': (dims, rng.random((6, 3, 4, 5))),
+                       't2': (['time', 'lat', 'lon'], rng.random((6, 4, 5)))}, coords=coords)
+
+@pytest.fixture
+def wrf_data():
+    # WRF-style curvilinear grid, with XLAT/XLONG repeated along Time
+    rng = np.random.default_rng(1)
+    lon2d, lat2d = np.meshgrid(np.linspace(0, 4, 5), np.linspace(0, 3, 4))
+    lat2d = lat2d + 0.05 * lon2d
+    xlat = np.broadcast_to(lat2d, (3, 4, 5))
+    xlong = np.broadcast_to(lon2d, (3, 4, 5))
+    dims = ['Time', 'south_north', 'west_east']
+    return xr.Dataset({'T2': (dims, rng.random((3, 4, 5)) + 280)},
+                      coords={'XLAT': (dims, xlat), 'XLONG': (dims, xlong),
+                              'XTIME': ('Time', pd.date_range('2023-01-01', periods=3, freq='h'))})
+
 def test_standardise_coords(irregular_data):
     """Test the standardisation of coordinate names."""
     # Check that the coordinates are correctly renamed
@@ -48,6 +84,41 @@ def test_standardise_coords(irregular_data):
     assert 'xlat' not in ds_standardised.coords, "xlat found in coords"
     assert 'xlon' not in ds_standardised.coords, "xlon found in coords"
 
+@pytest.mark.parametrize("lon_name", ['xlong_v', 'long', 'LONG'])
+def test_standardise_coords_aliases(lon_name):
+    """Every alias is recognised, whatever its case."""
+    ds = xr.Dataset(coords={lon_name: [0, 1, 2]})
+    assert list(standardise_coords(ds).coords) == ['longitude']
+
+def test_standardise_coords_wrf(wrf_data):
+    """WRF datasets with several aliases of the same name standardise without clashes."""
+    wrf_data = wrf_data.assign_coords(XLAT_U=(('Time', 'south_north', 'west_east_stag'), np.zeros((3, 4, 6))))
+    wrf_data['T2'].attrs['coordinates'] = 'XLONG XLAT XTIME'
+    ds = standardise_coords(wrf_data)
+
+    assert {'latitude', 'longitude', 'time', 'XLAT_U'} <= set(ds.coords)
+    assert ds['latitude'].dims == ('time', 'south_north', 'west_east')
+    # XTIME lies along Time, so it becomes the time index
+    assert 'time' in ds.indexes
+    assert ds.sel(time='2023-01-01T01')['T2'].shape == (4, 5)
+    assert ds['T2'].attrs['coordinates'] == 'longitude latitude time'
+    assert wrf_data['T2'].attrs['coordinates'] == 'XLONG XLAT XTIME'
+
+def test_standardise_dims_without_coords():
+    ds = xr.Dataset({'var': (['Lat', 'lon'], np.zeros((2, 3)))})
+    assert standardise_coords(ds)['var'].dims == ('latitude', 'longitude')
+
+def test_standardise_coords_shares_data(irregular_data):
+    """The data arrays are not copied."""
+    result = standardise_coords(irregular_data)
+    assert {'latitude', 'longitude', 'time'} == set(result.coords)
+    assert result['var'].dims == ('time', 'latitude', 'longitude')
+    # The data is shared, not copied
+    assert np.shares_memory(result['var'].values, irregular_data['var'].values)
+    # Already standard: nothing to do
+    assert standardise_coords(result) is result
+
+@requires_xesmf
 def test_interpolate_irregular_to_regular_grid(irregular_data, regular_data):
     """Test the interpolation of irregular to regular grid."""
     # Call the function to interpolate data
@@ -67,3 +138,210 @@ def test_interpolate_irregular_to_regular_grid(irregular_data, regular_data):
     # You can check the values to confirm interpolation, but generally it's harder to validate numerically
     # without specific known data. This test checks the shape and basic functionality.
 
+@requires_xesmf
+def test_regridder_cache_hits(irregular_data, regular_data):
+    """Repeated calls on the same grids reuse the regridder."""
+    cache = RegridderCache()
+    first = interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=cache)
+    second = interpolate_irregular_to_regular_grid(irregular_data * 2, regular_data, cache=cache)
+    assert cache.stats == {'memory_hits': 1, 'disk_hits': 0, 'misses': 1}
+    np.testing.assert_allclose(second['var'].values, 2 * first['var'].values)
+
+    # A different method is a different regridder
+    interpolate_irregular_to_regular_grid(irregular_data, regular_data, {'method': 'nearest_s2d'}, cache=cache)
+    assert cache.stats['misses'] == 2
+
+@requires_xesmf
+def test_regridder_cache_lru_eviction(irregular_data, regular_data):
+    cache = RegridderCache(maxsize=1)
+    interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=cache)
+    interpolate_irregular_to_regular_grid(irregular_data, regular_data, {'method': 'nearest_s2d'}, cache=cache)
+    interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=cache)
+    assert cache.stats['misses'] == 3
+
+@requires_xesmf
+def test_regridder_cache_disk_tier(irregular_data, regular_data, tmp_path):
+    """A new cache (e.g. in another process) reads the weights written by the first."""
+    cache = RegridderCache(weights_dir=tmp_path)
+    expected = interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=cache)
+    assert len(list(tmp_path.glob('bilinear_*.nc'))) == 1
+
+    new_cache = RegridderCache(weights_dir=tmp_path)
+    result = interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=new_cache)
+    assert new_cache.stats == {'memory_hits': 0, 'disk_hits': 1, 'misses': 0}
+    np.testing.assert_allclose(result['var'].values, expected['var'].values)
+
+@requires_xesmf
+def test_regrid_kwargs_not_modified(irregular_data, regular_data):
+    """The caller's kwargs dict is not mutated."""
+    regrid_kwargs = {}
+    interpolate_irregular_to_regular_grid(irregular_data, regular_data, regrid_kwargs, cache=None)
+    assert regrid_kwargs == {}
+
+def test_horizontal_grid(wrf_data):
+    grid = horizontal_grid(standardise_coords(wrf_data))
+    assert set(grid.coords) == {'latitude', 'longitude'}
+    assert grid['latitude'].dims == ('south_north', 'west_east')
+
+@requires_xesmf
+def test_regrid_all_timesteps_and_variables(multi_time_data, regular_data):
+    """All time steps, levels and variables are regridded in one call."""
+    result = interpolate_irregular_to_regular_grid(multi_time_data, regular_data, cache=RegridderCache())
+    assert result['t'].shape == (6, 3, 5, 6)
+    assert result['q'].shape == (6, 3, 5, 6)
+    assert result['t2'].shape == (6, 5, 6)
+
+    # Same answer as regridding a single time step on its own
+    single = interpolate_irregular_to_regular_grid(multi_time_data.isel(time=[2]), regular_data, cache=RegridderCache())
+    np.testing.assert_allclose(result['t'].isel(time=2).values, single['t'].isel(time=0).values)
+
+@requires_xesmf
+def test_regrid_wrf_all_timesteps(wrf_data, regular_data):
+    """XLAT/XLONG with a Time dimension no longer need an isel({'Time': 0})."""
+    result = interpolate_irregular_to_regular_grid(wrf_data, regular_data, cache=RegridderCache())
+    assert result['T2'].shape == (3, 5, 6)
+    first = interpolate_irregular_to_regular_grid(wrf_data.isel(Time=0), regular_data, cache=RegridderCache())
+    np.testing.assert_allclose(result['T2'].isel(time=0).values, first['T2'].values)
+
+@requires_xesmf
+def test_regrid_dask_input_stays_lazy(multi_time_data, regular_data):
+    pytest.importorskip("dask")
+    lazy = multi_time_data.chunk({'time': 2, 'lat': 2})
+    result = interpolate_irregular_to_regular_grid(lazy, regular_data, cache=RegridderCache())
+    assert result['t'].chunks is not None
+    expected = interpolate_irregular_to_regular_grid(multi_time_data, regular_data, cache=RegridderCache())
+    np.testing.assert_allclose(result['t'].values, expected['t'].values)
+
+@requires_xesmf
+def test_regrid_files(multi_time_data, regular_data, tmp_path):
+    """Multi-file archives are regridded file by file, matching in-memory regridding."""
+    pytest.importorskip("dask")
+    for i in range(3):
+        multi_time_data.isel(time=slice(2 * i, 2 * i + 2)).to_netcdf(tmp_path / f'wrfout_{i}.nc')
+
+    outputs = regrid_files(str(tmp_path / 'wrfout_*.nc'), regular_data, tmp_path / 'out',
+                           time_chunk=1, processes=2)
+    assert [p.name for p in outputs] == [f'wrfout_{i}_regridded.nc' for i in range(3)]
+
+    expected = interpolate_irregular_to_regular_grid(multi_time_data, regular_data, cache=RegridderCache())
+    with xr.open_mfdataset(outputs, combine='nested', concat_dim='time') as result:
+        np.testing.assert_allclose(result['t'].values, expected['t'].values)
+
+    # Finished outputs are not regridded again
+    mtime = outputs[0].stat().st_mtime_ns
+    regrid_files(str(tmp_path / 'wrfout_*.nc'), regular_data, tmp_path / 'out', processes=2)
+    assert outputs[0].stat().st_mtime_ns == mtime
+
+def _linear_field(ds):
+    """A field linear in latitude and longitude, which bilinear interpolation reproduces exactly."""
+    grid = standardise_coords(ds)
+    return 2 * grid['latitude'] - 3 * grid['longitude'] + 1
+
+def test_sparse_bilinear_reproduces_linear_field(irregular_data, regular_data):
+    source = irregular_data.assign(var=_linear_field(irregular_data).expand_dims(time=irregular_data.time))
+    result = interpolate_irregular_to_regular_grid(source, regular_data, cache=None, backend='sparse')
+    assert result['var'].dims == ('time', 'latitude', 'longitude')
+    expected = _linear_field(regular_data).transpose('latitude', 'longitude')
+    np.testing.assert_allclose(result['var'].isel(time=0).values, expected.values)
+
+def test_sparse_bilinear_curvilinear(wrf_data, regular_data):
+    """WRF XLAT/XLONG grids; target points outside the source grid are NaN."""
+    source = wrf_data.assign(T2=(2 * wrf_data.XLAT - 3 * wrf_data.XLONG + 1))
+    result = interpolate_irregular_to_regular_grid(source, regular_data, cache=None, backend='sparse')
+    assert result['T2'].shape == (3, 5, 6)
+    lon2d, lat2d = np.meshgrid(regular_data.longitude, regular_data.latitude)
+    values = result['T2'].isel(time=1).values
+    inside = np.isfinite(values)
+    # The source grid is sheared northwards, so its south-east corner is not covered
+    assert not inside.all() and inside.sum() > inside.size / 2
+    assert np.isfinite(values[-1, -1]) and np.isnan(values[0, -1])
+    np.testing.assert_allclose(values[inside], (2 * lat2d - 3 * lon2d + 1)[inside])
+
+@pytest.mark.parametrize('method', ['nearest_s2d', 'idw'])
+def test_sparse_methods(irregular_data, regular_data, method):
+    regridder = SparseRegridder(standardise_coords(irregular_data), regular_data, method)
+    np.testing.assert_allclose(regridder.weights.sum(axis=1), 1)
+    result = regridder(standardise_coords(irregular_data))['var']
+    source = irregular_data['var'].values
+    assert source.min() <= result.min() and result.max() <= source.max()
+    if method == 'nearest_s2d':
+        assert set(np.unique(result.values)) <= set(np.unique(source))
+
+def test_sparse_invalid_method(irregular_data, regular_data):
+    with pytest.raises(ValueError, match='conservative'):
+        SparseRegridder(standardise_coords(irregular_data), regular_data, 'conservative')
+    with pytest.raises(ValueError, match='backend'):
+        interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=None, backend='esmpy')
+
+def test_sparse_dask_input_stays_lazy(multi_time_data, regular_data):
+    pytest.importorskip("dask")
+    lazy = multi_time_data.chunk({'time': 2, 'lat': 2})
+    result = interpolate_irregular_to_regular_grid(lazy, regular_data, cache=None, backend='sparse')
+    assert result['t'].chunks is not None
+    assert result['t'].shape == (6, 3, 5, 6)
+    expected = interpolate_irregular_to_regular_grid(multi_time_data, regular_data, cache=None, backend='sparse')
+    np.testing.assert_allclose(result['t'].values, expected['t'].values)
+
+def test_sparse_regridder_cache_disk_tier(irregular_data, regular_data, tmp_path):
+    cache = RegridderCache(weights_dir=tmp_path)
+    expected = interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=cache, backend='sparse')
+    assert len(list(tmp_path.glob('sparse-bilinear_*.nc'))) == 1
+
+    new_cache = RegridderCache(weights_dir=tmp_path)
+    result = interpolate_irregular_to_regular_grid(irregular_data, regular_data, cache=new_cache, backend='sparse')
+    assert new_cache.stats == {'memory_hits': 0, 'disk_hits': 1, 'misses': 0}
+    np.testing.assert_array_equal(result['var'].values, expected['var'].values)
+
+def test_sparse_regrid_files(multi_time_data, regular_data, tmp_path):
+    pytest.importorskip("dask")
+    for i in range(2):
+        multi_time_data.isel(time=slice(3 * i, 3 * i + 3)).to_netcdf(tmp_path / f'wrfout_{i}.nc')
+    outputs = regrid_files(str(tmp_path / 'wrfout_*.nc'), regular_data, tmp_path / 'out',
+                           processes=1, backend='sparse')
+    expected = interpolate_irregular_to_regular_grid(multi_time_data, regular_data, cache=None, backend='sparse')
+    with xr.open_mfdataset(outputs, combine='nested', concat_dim='time') as result:
+        np.testing.assert_allclose(result['t'].values, expected['t'].values)
+
+@requires_xesmf
+@pytest.mark.parametrize('method', ['bilinear', 'nearest_s2d'])
+def test_sparse_agrees_with_xesmf(wrf_data, regular_data, method):
+    """Inside the source grid, the sparse backend matches xesmf."""
+    kwargs = {'method': method}
+    sparse = interpolate_irregular_to_regular_grid(wrf_data, regular_data, kwargs, cache=None, backend='sparse')
+    esmf = interpolate_irregular_to_regular_grid(wrf_data, regular_data, dict(kwargs, unmapped_to_nan=True), cache=None)
+    inside = np.isfinite(sparse['T2'].values) & np.isfinite(esmf['T2'].values)
+    assert inside.any()
+    np.testing.assert_allclose(sparse['T2'].values[inside], esmf['T2'].values[inside], rtol=1e-6)
+
+def test_sparse_regridder_memmap(multi_time_data, regular_data, tmp_path):
+    source = standardise_coords(multi_time_data)
+    regridder = SparseRegridder(horizontal_grid(source), regular_data)
+    regridder.to_memmap(tmp_path)
+    mapped = SparseRegridder.from_memmap(tmp_path)
+    # Read-only views of the mapped files, not copies
+    assert not mapped.weights.data.flags.writeable and not mapped.weights.indices.flags.writeable
+    xr.testing.assert_identical(mapped(source), regridder(source))
+
+def test_shared_regrid_executor(multi_time_data, regular_data, tmp_path):
+    pytest.importorskip("dask")
+    for i in range(4):
+        multi_time_data.isel(time=slice(i, i + 1)).to_netcdf(tmp_path / f'wrfout_{i}.nc')
+    with SharedRegridExecutor(multi_time_data, regular_data, processes=2) as executor:
+        directory = executor.directory
+        outputs = executor.map(str(tmp_path / 'wrfout_[0-3].nc'), tmp_path / 'out', files_per_task=2)
+        assert [p.name for p in outputs] == ['wrfout_0_regridded.nc', 'wrfout_2_regridded.nc']
+        assert sum(s['files'] for s in executor.throughput.values()) == 2
+        assert sum(s['time_steps'] for s in executor.throughput.values()) == 4
+
+        # Files on another grid are refused
+        multi_time_data.isel(lon=slice(1, None)).to_netcdf(tmp_path / 'other.nc')
+        with pytest.raises(ValueError, match='grid'):
+            executor.map([tmp_path / 'other.nc'], tmp_path / 'out')
+        with pytest.raises(FileNotFoundError, match='missing_'):
+            executor.map(str(tmp_path / 'missing_*.nc'), tmp_path / 'out')
+    assert not directory.exists()
+
+    expected = interpolate_irregular_to_regular_grid(multi_time_data.isel(time=slice(0, 4)), regular_data,
+                                                     cache=None, backend='sparse')
+    with xr.open_mfdataset(outputs, combine='nested', concat_dim='time') as result:
+        np.testing.assert_allclose(result['t'].values, expected['t'].values)
@@ -0,0 +1,111 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import numpy as np
+import xarray as xr
+from utils.python import tracing
+from utils.python.tracing import add_bytes, span, trace, traced
+from utils.tests.fake_cds import FakeCDSClient
+
+def by_name(tracer):
+    return {e['name']: e for e in tracer.chrome_trace()['traceEvents']}
+
+def test_disabled_spans_are_shared_no_ops():
+    assert not tracing.enabled()
+    assert span('a') is span('b', x=1)
+    with span('a') as s:
+        s.add_bytes(read=10)
+        s.set(x=1)
+    add_bytes(written=10)
+
+def test_spans_nest_and_record_bytes(tmp_path):
+    with trace(tmp_path / 'trace.json') as tracer:
+        with span('outer', file='a.nc') as outer:
+            with span('inner'):
+                add_bytes(read=100)
+                time.sleep(0.01)
+            outer.add_bytes(written=50)
+        with pytest.raises(ValueError), span('failing'):
+            raise ValueError
+    assert not tracing.enabled()
+
+    events = by_name(tracer)
+    outer, inner = events['outer'], events['inner']
+    assert outer['ts'] <= inner['ts'] and inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    assert inner['dur'] >= 1e4
+    assert inner['args']['bytes_read'] == 100 and outer['args']['bytes_read'] == 0
+    assert outer['args']['bytes_written'] == 50 and outer['args']['file'] == 'a.nc'
+    assert events['failing']['args']['failed']
+
+    # The trace file is valid Chrome trace JSON
+    written = json.loads((tmp_path / 'trace.json').read_text())
+    assert {e['ph'] for e in written['traceEvents']} == {'X'}
+    assert len(written['traceEvents']) == 3
+
+def test_threads_have_their_own_stack():
+    barrier = threading.Barrier(4)
+
+    def worker(i):
+        with span('worker'):
+            # All four spans are open at once
+            barrier.wait()
+            add_bytes(read=i)
+
+    with trace() as tracer:
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(1, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    events = tracer.chrome_trace()['traceEvents']
+    assert sorted(e['args']['bytes_read'] for e in events) == [1, 2, 3, 4]
+    assert len({e['tid'] for e in events}) == 4
+
+def test_summary_and_peak_memory():
+    @traced('allocate')
+    def allocate(n):
+        return np.ones(n).sum()
+
+    with trace(memory=True) as tracer:
+        with span('outer'):
+            allocate(1_000_000)
+            allocate(10)
+    rows = {row['name']: row for row in tracer.summary()}
+    assert rows['allocate']['count'] == 2
+    assert rows['allocate']['total_s'] >= rows['allocate']['max_s'] > 0
+    # The 8 MB array counts towards the peak of both the function and its caller
+    assert rows['allocate']['peak_memory'] >= 8e6
+    assert rows['outer']['peak_memory'] >= rows['allocate']['peak_memory']
+    assert 'allocate' in tracer.format_summary()
+
+def test_hooks_record_spans(tmp_path):
+    from utils.atmos.download_engine import DownloadEngine
+    from utils.atmos.netcdf import interpolate_irregular_to_regular_grid
+    from utils.python.debug import hist_plot_and_save
+
+    source = xr.Dataset({'var': (['lat', 'lon'], np.random.rand(4, 5))}, coords={'lat': np.arange(4.), 'lon': np.arange(5.)})
+    target = xr.Dataset(coords={'latitude': np.linspace(0, 3, 5), 'longitude': np.linspace(0, 4, 6)})
+    engine = DownloadEngine(client_factory=lambda: FakeCDSClient(payload=b'x' * 1000))
+
+    with trace() as tracer:
+        interpolate_irregular_to_regular_grid(source, target, {'method': 'bilinear'}, cache=None, backend='sparse')
+        hist_plot_and_save(np.random.rand(100), path=tmp_path / 'hist.png')
+        engine.retrieve('reanalysis-era5-single-levels', {'date': '20200101'}, tmp_path / 'out.nc')
+
+    events = by_name(tracer)
+    assert {'standardise_coords', 'regrid.weights', 'regrid.apply', 'hist_plot_and_save',
+            'cds.queue', 'cds.download'} <= set(events)
+    assert events['regrid.weights']['args']['backend'] == 'sparse'
+    assert events['hist_plot_and_save']['args']['bytes_written'] == os.path.getsize(tmp_path / 'hist.png')
+    assert events['cds.download']['args']['bytes_written'] == 1000
+
+def test_enabled_by_environment_variable(tmp_path):
+    path = tmp_path / 'trace.json'
+    code = "from utils.python.tracing import span\nwith span('job'):\n    pass\n"
+    env = dict(os.environ, UTILS_TRACE=str(path), PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
+    assert [e['name'] for e in json.loads(path.read_text())['traceEvents']] == ['job']